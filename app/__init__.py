@@ -31,6 +31,42 @@ def create_app():
     app.config['ARTIFACTS_OWNER_UID'] = int(owner_uid) if owner_uid is not None else None
     app.config['ARTIFACTS_OWNER_GID'] = int(owner_gid) if owner_gid is not None else None
 
+    # Staging area for finished downloads. It must sit on the same mount as the artifact store (or the music
+    # library when DELIVER_TO_LIBRARY is on) so files can be renamed/hardlinked instead of copied.
+    music_dir = os.environ.get('MUSIC_DIR') or None
+    deliver_to_library = bool(music_dir) and os.environ.get('DELIVER_TO_LIBRARY', 'false').lower() == 'true'
+    app.config['MUSIC_DIR'] = music_dir
+    app.config['DELIVER_TO_LIBRARY'] = deliver_to_library
+    default_staging = os.path.join(music_dir, '.flaccy-staging') if deliver_to_library else os.path.join(artifacts_dir, '.staging')
+    app.config['STAGING_DIR'] = os.environ.get('STAGING_DIR') or default_staging
+
+    # Per-job scratch space for downloader temp files (defaults to the system temp dir).
+    # Small intermediates can be kept on a tmpfs mount, bounded per job by SCRATCH_TMPFS_MAX_BYTES.
+    app.config['SCRATCH_DIR'] = os.environ.get('SCRATCH_DIR') or None
+    app.config['SCRATCH_TMPFS_DIR'] = os.environ.get('SCRATCH_TMPFS_DIR') or None
+    app.config['SCRATCH_TMPFS_MAX_BYTES'] = int(os.environ.get('SCRATCH_TMPFS_MAX_BYTES', 64 * 1024**2))
+
+    # Shared cache of fetched (and already resized) cover art, LRU-trimmed to ARTWORK_CACHE_MAX_BYTES (0 disables it).
+    app.config['ARTWORK_CACHE_DIR'] = os.environ.get('ARTWORK_CACHE_DIR') or os.path.join(app.instance_path, 'artwork_cache')
+    app.config['ARTWORK_CACHE_MAX_BYTES'] = int(os.environ.get('ARTWORK_CACHE_MAX_BYTES', 512 * 1024**2))
+
+    # Track previews: seconds (0 disables them), the quality tier their stream is fetched at, previews streaming at once
+    # per process, and a cache of finished previews, LRU-trimmed to PREVIEW_CACHE_MAX_BYTES (0 disables it).
+    app.config['PREVIEW_SECONDS'] = int(os.environ.get('PREVIEW_SECONDS', 30))
+    app.config['PREVIEW_QUALITY'] = os.environ.get('PREVIEW_QUALITY', 'high')
+    app.config['PREVIEW_MAX_CONCURRENT'] = int(os.environ.get('PREVIEW_MAX_CONCURRENT', 4))
+    app.config['PREVIEW_CACHE_DIR'] = os.environ.get('PREVIEW_CACHE_DIR') or os.path.join(app.instance_path, 'preview_cache')
+    app.config['PREVIEW_CACHE_MAX_BYTES'] = int(os.environ.get('PREVIEW_CACHE_MAX_BYTES', 256 * 1024**2))
+
+    # Tracks of an album/playlist whose metadata, stream URLs, lyrics and credits are resolved ahead (0 disables it).
+    app.config['TRACK_PREFETCH_DEPTH'] = int(os.environ.get('TRACK_PREFETCH_DEPTH', 2))
+
+    # Concurrent ffmpeg encodes for codec conversions, run while the next tracks download (unset: one per core, 0: inline).
+    app.config['TRANSCODE_WORKERS'] = int(os.environ['TRANSCODE_WORKERS']) if os.environ.get('TRANSCODE_WORKERS') else None
+
+    # Share of jobs run under the sampling profiler (0..1); a job can also ask for it with options.profile.
+    app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+
     # Configure logging
     logging.basicConfig(level=logging.INFO, format="%(message)s")
     structlog.configure(
@@ -68,6 +104,36 @@ def create_app():
     app.redis = redis.from_url(os.environ.get('REDIS_URL', 'redis://localhost:6379/0'))
     from . import events
     events.initialize(app.redis)
+    from . import cancellation
+    cancellation.initialize(app.redis)
+    from . import metrics
+    metrics.initialize(app.redis)
+    from . import preview
+    preview.initialize(app.config['PREVIEW_CACHE_DIR'], app.config['PREVIEW_CACHE_MAX_BYTES'],
+                       app.config['PREVIEW_SECONDS'], app.config['PREVIEW_QUALITY'], app.config['PREVIEW_MAX_CONCURRENT'])
+
+    # Upstream request budgets shared by all workers, requests/second per service and class,
+    # e.g. RATE_LIMITS="qobuz:metadata=8,qobuz:transfer=4" (unlisted ones keep their defaults, 0 disables).
+    from . import ratelimit
+    app.config['RATE_LIMITS'] = ratelimit.parse_rates(os.environ.get('RATE_LIMITS'))
+    ratelimit.initialize(app.redis, app.config['RATE_LIMITS'])
+
+    # Where module logins and tokens are kept: "file" (loginstorage.bin, the default) or "redis" (shared by all hosts).
+    from . import login_storage
+    app.config['SESSION_STORE'] = os.environ.get('SESSION_STORE', 'file').lower()
+    login_storage.initialize(app.redis, app.config['SESSION_STORE'])
+
+    # Jobs per service that may download at the same time across all worker processes,
+    # e.g. SERVICE_SLOTS="tidal=1,qobuz=0" (0: unlimited; Tidal defaults to one stream per account).
+    from . import slots
+    app.config['SERVICE_SLOTS'] = slots.parse_limits(os.environ.get('SERVICE_SLOTS'))
+    slots.initialize(app.redis, app.config['SERVICE_SLOTS'])
+
+    # Weights of the scheduler lanes (share of free workers each gets while several have waiting jobs),
+    # e.g. LANE_WEIGHTS="track=8,album=4,playlist=2,artist=1".
+    from . import scheduler
+    app.config['LANE_WEIGHTS'] = scheduler.parse_weights(os.environ.get('LANE_WEIGHTS'))
+    scheduler.initialize(app.redis, app.config['LANE_WEIGHTS'])
 
     # Ensure the instance folder exists
     try:
@@ -0,0 +1,177 @@
+import errno
+import hashlib
+import mimetypes
+import os
+import re
+import unicodedata
+from datetime import datetime, timezone
+from urllib.parse import quote
+
+from flask import Response, request
+from werkzeug.http import http_date, is_resource_modified
+from werkzeug.wsgi import wrap_file
+
+from . import db
+from .models import Artifact
+
+"""
+Artifacts module.
+
+Serves the artifact store directly, for deployments without Nginx in front (USE_X_ACCEL_REDIRECT=false). Every
+stored artifact is indexed with its download name, size, mtime and a strong ETag, so /files/<filename> is one
+primary-key lookup instead of scans over every job manifest.
+
+Responses are conditional (If-None-Match, If-Modified-Since) and ranged: a single byte range (Range, honoured only
+while If-Range still matches) is answered with 206, an unsatisfiable one with 416, so interrupted downloads of large
+album zips resume where they stopped. The body is the open file at the range's start, handed to the server's
+wsgi.file_wrapper with the range's Content-Length; gunicorn writes such a body with sendfile() and stops at
+Content-Length. Artifact names carry a random uuid and their contents never change, so they are cached for a year.
+
+gevent's socket.sendfile() copies through user space with send() calls; install_sendfile() replaces it with a
+cooperative os.sendfile() loop, so the gevent worker sends files zero-copy as well.
+
+API:
+ - register(job_id, artifacts_dir, files): index stored files ({'name', 'filename'} dicts), committed with the job
+ - lookup(filename): the Artifact row or None
+ - response(path, artifact): the direct-serve response for the current request
+ - install_sendfile(): make gevent sockets send files with os.sendfile()
+"""
+
+# Stored names: "<job id>_<uuid hex>_<name>" for files and profiles, "<uuid hex>_<album>.zip" for album zips
+IMMUTABLE_NAME = re.compile(r'(^|_)[0-9a-f]{32}_')
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+# Upper bound of one os.sendfile() call, so a cold page cache does not hold up the worker's other greenlets for long
+SENDFILE_BLOCK = 4 * 1024**2
+# Read size when the server has no wsgi.file_wrapper (werkzeug's development server)
+CHUNK_SIZE = 256 * 1024
+
+
+def _etag(filename, st):
+    # The stored name is unique and never rewritten, size and mtime change with any replacement of the file
+    return hashlib.sha256(f'{filename}\0{st.st_size}\0{st.st_mtime_ns}'.encode()).hexdigest()[:32]
+
+
+def register(job_id, artifacts_dir, files):
+    for f in files:
+        try:
+            st = os.stat(os.path.join(artifacts_dir, f['filename']))
+        except OSError:
+            continue
+        db.session.merge(Artifact(filename=f['filename'], job_id=job_id, name=f.get('name') or f['filename'],
+                                  size=st.st_size, mtime_ns=st.st_mtime_ns, etag=_etag(f['filename'], st)))
+
+
+def lookup(filename):
+    return db.session.get(Artifact, filename)
+
+
+def _content_disposition(name):
+    # Non-ASCII names go in filename* (RFC 6266), with an ASCII approximation for old clients
+    try:
+        name.encode('ascii')
+        return f'attachment; filename="{name}"'
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', name).encode('ascii', 'ignore').decode('ascii')
+        return f"attachment; filename=\"{simple}\"; filename*=UTF-8''{quote(name, safe='!#$&+^`|~')}"
+
+
+def _byte_range(size, etag, last_modified):
+    """
+    The (start, stop) to send, None for the whole file, or False when the range cannot be satisfied. Several ranges
+    and a stale If-Range get the whole file.
+    """
+    if 'Range' not in request.headers or request.range is None or len(request.range.ranges) != 1:
+        return None
+    if_range = request.headers.get('If-Range')
+    if if_range:
+        # Strong comparison: a weak validator never matches; a date must be the exact Last-Modified
+        if if_range.startswith('"'):
+            if if_range.strip('"') != etag: return None
+        elif if_range.startswith('W/') or request.if_range.date is None:
+            return None
+        elif request.if_range.date != last_modified:
+            return None
+    return request.range.range_for_length(size) or False
+
+
+def _chunks(f, length):
+    try:
+        while length > 0:
+            data = f.read(min(CHUNK_SIZE, length))
+            if not data: break
+            length -= len(data)
+            yield data
+    finally:
+        f.close()
+
+
+def response(path, artifact):
+    st = os.stat(path)
+    etag = artifact.etag if artifact.etag and (artifact.size, artifact.mtime_ns) == (st.st_size, st.st_mtime_ns) \
+        else _etag(artifact.filename, st)
+    name = artifact.name or artifact.filename
+    last_modified = datetime.fromtimestamp(int(st.st_mtime), timezone.utc)
+    headers = {'Accept-Ranges': 'bytes', 'Content-Disposition': _content_disposition(name),
+               'ETag': f'"{etag}"', 'Last-Modified': http_date(last_modified)}
+    if IMMUTABLE_NAME.search(artifact.filename):
+        headers['Cache-Control'] = f'private, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        headers['Cache-Control'] = 'private, no-cache'
+
+    if request.method in ('GET', 'HEAD') and not is_resource_modified(request.environ, etag=etag,
+                                                                      last_modified=last_modified):
+        return Response(status=304, headers=headers)
+    byte_range = _byte_range(st.st_size, etag, last_modified)
+    if byte_range is False:
+        headers['Content-Range'] = f'bytes */{st.st_size}'
+        return Response(status=416, headers=headers)
+    start, stop = byte_range or (0, st.st_size)
+    if byte_range:
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{st.st_size}'
+
+    f = open(path, 'rb')
+    f.seek(start)
+    # The server's file wrapper sends from the current offset up to Content-Length (gunicorn: with sendfile)
+    body = wrap_file(request.environ, f) if 'wsgi.file_wrapper' in request.environ else _chunks(f, stop - start)
+    resp = Response(body, status=206 if byte_range else 200, headers=headers, direct_passthrough=True,
+                    mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+    resp.content_length = stop - start
+    return resp
+
+
+def _sendfile(self, file, offset=0, count=None):
+    # gevent.socket.socket.sendfile with os.sendfile(): the socket is non-blocking underneath, so a full send buffer
+    # means waiting for it to drain in the hub, as gevent's own send() does
+    self._check_sendfile_params(file, offset, count)
+    if self.gettimeout() == 0:
+        raise ValueError("non-blocking sockets are not supported")
+    try:
+        fileno = file.fileno()
+        remaining = os.fstat(fileno).st_size - offset
+    except (AttributeError, OSError, ValueError):
+        return self._sendfile_use_send(file, offset, count)
+    if count: remaining = min(remaining, count)
+    sent_total = 0
+    try:
+        while sent_total < remaining:
+            try:
+                sent = os.sendfile(self.fileno(), fileno, offset + sent_total, min(remaining - sent_total, SENDFILE_BLOCK))
+            except BlockingIOError:
+                self._wait(self._write_event)
+                continue
+            except OSError as e:
+                # Not a regular file after all (or no sendfile for this socket): the plain path
+                if sent_total == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK):
+                    return self._sendfile_use_send(file, offset, count)
+                raise
+            if sent == 0: break  # EOF
+            sent_total += sent
+        return sent_total
+    finally:
+        if sent_total > 0 and hasattr(file, 'seek'): file.seek(offset + sent_total)
+
+
+def install_sendfile():
+    if not hasattr(os, 'sendfile'): return
+    import gevent.socket
+    gevent.socket.socket.sendfile = _sendfile
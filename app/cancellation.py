@@ -0,0 +1,69 @@
+import logging
+from threading import Lock
+
+from OrpheusDL.utils.cancellation import CancelToken
+
+"""
+Cancellation module.
+
+Cancel requests are flags in Redis ('cancel:{job_id}'), so the web process can cancel a job that runs in any worker.
+The worker runs the download with a token for its job (see OrpheusDL.utils.cancellation): the downloader checks it
+between chunks, DASH segments and tracks, and the token looks at the flag at most every 0.25 s, so a cancelled job
+stops and frees its worker within about a second.
+
+API:
+ - initialize(redis_client): call once with a redis.Redis instance; without it flags are kept per process.
+ - request_cancel(job_id)
+ - is_requested(job_id)
+ - token_for(job_id): a CancelToken for the job's download.
+
+Flags expire after a day.
+"""
+
+_FLAG_TTL = 24 * 3600
+
+_requested = set()  # in-memory fallback
+_lock = Lock()
+
+_redis = None
+
+def initialize(redis_client):
+    """
+    Enable Redis-backed cancel flags. Call from app initialization.
+    """
+    global _redis
+    _redis = redis_client
+
+def _key(job_id):
+    return f"cancel:{job_id}"
+
+def request_cancel(job_id):
+    if _redis is not None:
+        _redis.set(_key(job_id), 1, ex=_FLAG_TTL)
+    else:
+        with _lock:
+            _requested.add(job_id)
+
+def is_requested(job_id):
+    if _redis is not None:
+        try:
+            return bool(_redis.exists(_key(job_id)))
+        except Exception as e:
+            # A download must not fail because the flag could not be read; it is read again shortly
+            logging.warning(f"Cancellation: failed to read flag of {job_id}: {e}")
+            return False
+    with _lock:
+        return job_id in _requested
+
+
+class JobCancelToken(CancelToken):
+    def __init__(self, job_id):
+        super().__init__()
+        self.job_id = job_id
+
+    def _poll(self):
+        return is_requested(self.job_id)
+
+
+def token_for(job_id):
+    return JobCancelToken(job_id)
@@ -4,8 +4,10 @@ from typing import List, Tuple
 
 ARTIFACTS_SUBDIR = 'artifacts'
 
-def _file_mtime(path: str) -> float:
-    return os.path.getmtime(path)
+def _file_stored_at(path: str) -> float:
+    # When the file entered the store: an artifact linked from the music library keeps the library file's old mtime,
+    # but the link (and the rename into the store) updates the inode's ctime
+    return os.stat(path).st_ctime
 
 def _file_size(path: str) -> int:
     return os.path.getsize(path)
@@ -42,16 +44,16 @@ def cleanup_artifacts(base_instance_path: str, ttl_minutes: int = 1440, max_tota
         if not os.path.isfile(path):
             continue
         try:
-            mtime = _file_mtime(path)
+            stored_at = _file_stored_at(path)
             size = _file_size(path)
         except OSError:
             # Skip files we cannot stat
             continue
-        files_info.append({'name': name, 'path': path, 'mtime': mtime, 'size': size})
+        files_info.append({'name': name, 'path': path, 'stored_at': stored_at, 'size': size})
         total_size += size
 
-    # Sort by mtime ascending (oldest first)
-    files_info.sort(key=lambda x: x['mtime'])
+    # Sort by storage time ascending (oldest first)
+    files_info.sort(key=lambda x: x['stored_at'])
 
     deleted_files = []
     freed_bytes = 0
@@ -60,7 +62,7 @@ def cleanup_artifacts(base_instance_path: str, ttl_minutes: int = 1440, max_tota
     # First pass: delete files older than TTL
     to_keep = []
     for info in files_info:
-        age = now - info['mtime']
+        age = now - info['stored_at']
         if age > ttl_seconds:
             try:
                 os.remove(info['path'])
@@ -76,8 +78,8 @@ def cleanup_artifacts(base_instance_path: str, ttl_minutes: int = 1440, max_tota
 
     # Second pass: enforce max total size by deleting oldest remaining files
     if total_size > max_total_bytes:
-        # sort to_keep ascending by mtime (oldest first) - already.sorted, but ensure
-        to_keep.sort(key=lambda x: x['mtime'])
+        # sort to_keep ascending by storage time (oldest first) - already.sorted, but ensure
+        to_keep.sort(key=lambda x: x['stored_at'])
         idx = 0
         while total_size > max_total_bytes and idx < len(to_keep):
             info = to_keep[idx]
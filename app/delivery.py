@@ -0,0 +1,88 @@
+import errno
+import os
+import shutil
+import sys
+
+"""
+Delivery module.
+
+Moves finished downloads out of a job's staging directory into the artifact store and, optionally, the music
+library, without copying file contents whenever the filesystem allows it.
+
+Strategy, cheapest first:
+ - rename: same filesystem, the file simply changes its name (only when the source may go away).
+ - hardlink: same filesystem, a second name for the same inode (used to keep a library copy and an artifact).
+ - reflink: copy-on-write clone (btrfs, XFS, ...), shares data blocks even across directories that cannot be
+   hardlinked.
+ - copy: plain byte copy, only when nothing else worked (e.g. staging and destination on different mounts).
+
+Note that bind mounts count as different mounts for rename/link purposes even when they are backed by the same
+host filesystem, so staging should live inside the same mount as its destination.
+"""
+
+# ioctl request number for FICLONE on Linux (_IOW(0x94, 9, int))
+_FICLONE = 0x40049409
+_CROSS_DEVICE_ERRORS = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP, errno.EACCES}
+
+
+def same_filesystem(path_a, path_b):
+    """Return True when both (existing) paths live on the same device."""
+    try:
+        return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+    except OSError:
+        return False
+
+
+def _reflink(src, dst):
+    import fcntl
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+        except OSError:
+            fdst.close()
+            os.remove(dst)
+            raise
+    shutil.copystat(src, dst)
+
+
+def deliver_file(src, dst, keep_source=False):
+    """
+    Place src at dst without copying data where possible and return the method used
+    ('rename', 'hardlink', 'reflink' or 'copy').
+
+    With keep_source=False the source is gone afterwards; with keep_source=True it stays in place and dst shares
+    its data (hardlink/reflink) or is a copy of it.
+    """
+    if not keep_source:
+        try:
+            os.rename(src, dst)
+            return 'rename'
+        except OSError as e:
+            if e.errno not in _CROSS_DEVICE_ERRORS:
+                raise
+
+    method = None
+    try:
+        os.link(src, dst)
+        method = 'hardlink'
+    except OSError as e:
+        if e.errno not in _CROSS_DEVICE_ERRORS:
+            raise
+
+    if method is None and sys.platform.startswith('linux'):
+        try:
+            _reflink(src, dst)
+            method = 'reflink'
+        except (OSError, ImportError):
+            method = None
+
+    if method is None:
+        shutil.copy2(src, dst)
+        method = 'copy'
+
+    if not keep_source:
+        try:
+            os.remove(src)
+        except OSError:
+            pass
+    return method
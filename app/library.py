@@ -0,0 +1,354 @@
+import os
+import re
+import time
+import unicodedata
+
+from OrpheusDL.utils.models import CodecEnum, QualityEnum, codec_data
+
+from . import db
+from . import delivery
+from .models import LibraryTrack
+
+"""
+Library module.
+
+Index of what is already in the music library (MUSIC_DIR), kept in the LibraryTrack table: ISRC, UPC, artist, album,
+title and audio quality (codec, bit depth, sample rate, bitrate) of every audio file. A scan walks the library with
+os.scandir and reads tags and stream info with mutagen only for files that are new or whose size or mtime changed
+since they were indexed; rows of files that are gone are dropped. Hidden directories (the staging area) are skipped.
+
+The index answers two questions without touching the library:
+ - search: is a result already owned (a copy at the same or a better quality is in the library), or only
+   upgradeable (the library copy is of a lower quality)?
+ - jobs: a track that would be downloaded at no better quality than its library copy is taken from the library
+   instead (linked, or copied when the library is on another filesystem), so the job still delivers it.
+
+Tracks are matched by ISRC, albums by UPC, and both by normalized artist and title (case, accents, punctuation and
+featured artists ignored) when the files carry no such code. Quality order: a lossless copy covers any lossy one and
+a lossless one of at most its bit depth and sample rate; a lossy copy covers a lossy one of about its bitrate or less.
+Spatial (Dolby Atmos, 360) and stereo releases never cover each other.
+
+API:
+ - scan(music_dir): incremental scan, returns counts
+ - index_files(music_dir, paths): (re)index files, e.g. the ones a job has just delivered to the library
+ - covers(track, codec, bit_depth, sample_rate, bitrate), copies(isrc, artist, title)
+ - default_codec(download_quality): the codec assumed for results that do not state their quality
+ - annotate_tracks(results, codec), annotate_albums(results, codec): add a 'library' entry to search results
+ - skipper(music_dir, taken): skip_track hook for a job's downloader
+ - stats()
+"""
+
+AUDIO_EXTENSIONS = ('.flac', '.m4a', '.mp4', '.mp3', '.ogg', '.opus', '.wav', '.aif', '.aiff')
+# Rows written (or looked up) per statement and commit
+BATCH_SIZE = 500
+# A lossy copy counts as the same quality down to this share of the offered bitrate (VBR files vary)
+BITRATE_TOLERANCE = 0.9
+# Redis keys: the lock that keeps scans from overlapping and the last scan's counts; a scan may take this long
+SCAN_LOCK_KEY = 'flaccy:library:scan'
+LAST_SCAN_KEY = 'flaccy:library:last_scan'
+SCAN_TIMEOUT = 6 * 3600
+
+_FIELDS = ('isrc', 'upc', 'title', 'artist', 'album_artist', 'album', 'track_key', 'album_key', 'codec', 'lossless',
+           'spatial', 'bit_depth', 'sample_rate', 'bitrate', 'duration')
+# Tag names per field in Vorbis comments, ID3 frames and MP4 atoms, in lower case
+_TAGS = {
+    'isrc': ('isrc', 'tsrc', '----:com.apple.itunes:isrc'),
+    'upc': ('upc', 'barcode', 'txxx:barcode', 'txxx:upc', '----:com.apple.itunes:upc', '----:com.apple.itunes:barcode'),
+    'title': ('title', 'tit2', '\xa9nam'),
+    'artist': ('artist', 'tpe1', '\xa9art'),
+    'album_artist': ('albumartist', 'album artist', 'tpe2', 'aart'),
+    'album': ('album', 'talb', '\xa9alb'),
+}
+_FILE_CODECS = {'FLAC': CodecEnum.FLAC, 'OggFLAC': CodecEnum.FLAC, 'MP3': CodecEnum.MP3, 'OggOpus': CodecEnum.OPUS,
+                'OggVorbis': CodecEnum.VORBIS, 'WAVE': CodecEnum.WAV, 'AIFF': CodecEnum.WAV}
+_MP4_CODECS = {'alac': CodecEnum.ALAC, 'flac': CodecEnum.FLAC, 'mp4a.40.5': CodecEnum.HEAAC,
+               'mp4a.40.29': CodecEnum.HEAAC, 'ec-3': CodecEnum.EAC3, 'ac-3': CodecEnum.AC3, 'ac-4': CodecEnum.AC4}
+_FEATURING = re.compile(r'\s*[(\[](?:feat|ft|featuring|with)\.?\s[^)\]]*[)\]]|\s+(?:feat|ft|featuring)\.?\s.*$', re.I)
+
+
+def normalize(text):
+    # Case, accents, punctuation and featured artists do not tell two releases apart
+    text = _FEATURING.sub('', unicodedata.normalize('NFKD', str(text or '')))
+    text = ''.join(c for c in text if not unicodedata.combining(c)).casefold()
+    return re.sub(r'[\W_]+', '', text)
+
+
+def _key(artist, name):
+    artist, name = normalize(artist), normalize(name)
+    return f'{artist}|{name}'[:512] if artist and name else None
+
+
+def _isrc(value):
+    return re.sub(r'[^0-9A-Za-z]', '', str(value or '')).upper()[:16] or None
+
+
+def _upc(value):
+    # UPC-A and EAN-13 forms of one barcode differ by a leading zero
+    return re.sub(r'\D', '', str(value or '')).lstrip('0')[:20] or None
+
+
+def _text(value):
+    value = getattr(value, 'text', value)  # ID3 frames
+    if isinstance(value, (list, tuple)): value = value[0] if value else None
+    if isinstance(value, bytes): value = value.decode('utf-8', 'replace')  # MP4 freeform atoms
+    if value is None: return None
+    return str(value).strip()[:512] or None
+
+
+def read_file(path):
+    """Tags and stream info of an audio file as LibraryTrack fields ({} when mutagen cannot read it)."""
+    import mutagen
+    try:
+        audio = mutagen.File(path)
+    except Exception:
+        return {}
+    if audio is None: return {}
+    tags = {}
+    for key in (audio.tags.keys() if audio.tags else ()):
+        tags.setdefault(key.lower(), audio.tags[key])
+    values = {field: next((_text(tags[name]) for name in names if name in tags), None) for field, names in _TAGS.items()}
+
+    info = audio.info
+    if type(audio).__name__ == 'MP4':
+        name = (getattr(info, 'codec', '') or '').lower()
+        codec = _MP4_CODECS.get(name, CodecEnum.AAC if name.startswith('mp4a') else None)
+    else:
+        codec = _FILE_CODECS.get(type(audio).__name__)
+    data = codec_data.get(codec)
+    return {
+        **values,
+        'isrc': _isrc(values['isrc']),
+        'upc': _upc(values['upc']),
+        'track_key': _key(values['artist'], values['title']),
+        'album_key': _key(values['album_artist'] or values['artist'], values['album']),
+        'codec': codec.name if codec else None,
+        'lossless': data.lossless if data else None,
+        'spatial': data.spatial if data else None,
+        'bit_depth': getattr(info, 'bits_per_sample', None) or None,
+        'sample_rate': getattr(info, 'sample_rate', None) or None,
+        'bitrate': round(info.bitrate / 1000) if getattr(info, 'bitrate', None) else None,
+        'duration': round(info.length) if getattr(info, 'length', None) else None,
+    }
+
+
+def _walk(music_dir):
+    # Audio files under music_dir with their stat, depth-first with one directory open at a time
+    pending = [music_dir]
+    while pending:
+        try:
+            entries = os.scandir(pending.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.name.startswith('.'): continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in AUDIO_EXTENSIONS:
+                        yield entry.path, entry.stat()
+                except OSError:
+                    continue
+
+
+def _record(relative, path, stat, merge):
+    # Unreadable files get a row too (without quality), so they are not read again until they change
+    fields = {**dict.fromkeys(_FIELDS), **read_file(path)}
+    track = LibraryTrack(path=relative, size=stat.st_size, mtime_ns=stat.st_mtime_ns, **fields)
+    if merge:
+        db.session.merge(track)
+    else:
+        db.session.add(track)
+    return fields['codec'] is not None
+
+
+def scan(music_dir, batch_size=BATCH_SIZE):
+    """
+    Bring the index up to date with music_dir: read new and changed files, drop the rows of files that are gone.
+    Returns the files seen, added, updated, removed and unreadable, and the seconds it took.
+    """
+    if not os.path.isdir(music_dir):
+        raise FileNotFoundError(f'Music library {music_dir} does not exist')
+    started = time.monotonic()
+    known = {path: (size, mtime_ns) for path, size, mtime_ns in
+             db.session.query(LibraryTrack.path, LibraryTrack.size, LibraryTrack.mtime_ns)}
+    counts = {'files': 0, 'added': 0, 'updated': 0, 'removed': 0, 'unreadable': 0}
+    pending = 0
+    for path, stat in _walk(music_dir):
+        counts['files'] += 1
+        relative = os.path.relpath(path, music_dir)
+        previous = known.pop(relative, None)
+        if previous == (stat.st_size, stat.st_mtime_ns): continue
+        if not _record(relative, path, stat, merge=previous is not None): counts['unreadable'] += 1
+        counts['updated' if previous else 'added'] += 1
+        pending += 1
+        if pending >= batch_size:
+            db.session.commit()
+            pending = 0
+    # An empty library while the index has files is taken for a volume that is not mounted: nothing is dropped
+    gone = list(known) if counts['files'] else []
+    for i in range(0, len(gone), batch_size):
+        LibraryTrack.query.filter(LibraryTrack.path.in_(gone[i:i + batch_size])).delete(synchronize_session=False)
+    counts['removed'] = len(gone)
+    db.session.commit()
+    counts['seconds'] = round(time.monotonic() - started, 2)
+    return counts
+
+
+def index_files(music_dir, paths):
+    """(Re)index the given files of music_dir, e.g. the ones a job has just delivered there."""
+    for path in paths:
+        relative = os.path.relpath(path, music_dir)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            LibraryTrack.query.filter_by(path=relative).delete()
+            continue
+        if os.path.splitext(path)[1].lower() in AUDIO_EXTENSIONS:
+            _record(relative, path, stat, merge=True)
+    db.session.commit()
+
+
+def _rank(track):
+    return bool(track.lossless), track.bit_depth or 0, track.sample_rate or 0, track.bitrate or 0
+
+
+def covers(track, codec=None, bit_depth=None, sample_rate=None, bitrate=None):
+    """
+    Whether the library copy is as good as a download of the given quality: codec a CodecEnum or its name,
+    sample_rate in Hz, bitrate in kbps, None where unknown. Without a codec, a bit depth or sample rate means a
+    lossless release. A file that could not be read covers nothing.
+    """
+    if track.codec is None: return False
+    if isinstance(codec, str): codec = CodecEnum.__members__.get(codec.upper())
+    offered = codec_data.get(codec)
+    if offered and offered.spatial != bool(track.spatial): return False
+    lossless = offered.lossless if offered else bool(bit_depth or sample_rate)
+    if lossless:
+        return bool(track.lossless) and (track.bit_depth or 16) >= (bit_depth or 16) and \
+            (track.sample_rate or 44100) >= (sample_rate or 44100)
+    return bool(track.lossless) or not bitrate or (track.bitrate or 0) >= bitrate * BITRATE_TOLERANCE
+
+
+def _lookup(column, values):
+    # Rows whose column is one of values, grouped by that value
+    found = {}
+    values = list({value for value in values if value})
+    for i in range(0, len(values), BATCH_SIZE):
+        for track in LibraryTrack.query.filter(column.in_(values[i:i + BATCH_SIZE])):
+            found.setdefault(getattr(track, column.key), []).append(track)
+    return found
+
+
+def copies(isrc=None, artist=None, title=None):
+    """Library files of a track: those with its ISRC or, when none has it, those with its artist and title."""
+    isrc, key = _isrc(isrc), _key(artist, title)
+    return (_lookup(LibraryTrack.isrc, [isrc]).get(isrc) if isrc else None) or \
+        (_lookup(LibraryTrack.track_key, [key]).get(key) if key else None) or []
+
+
+def default_codec(download_quality):
+    # What a release that does not state its quality is assumed to come in, from the download_quality setting
+    quality = QualityEnum.__members__.get(str(download_quality or '').upper())
+    return CodecEnum.FLAC if quality in (QualityEnum.LOSSLESS, QualityEnum.HIFI) else None
+
+
+def _album_quality(label, codec):
+    # Offered quality from an album's quality label, e.g. "24bit/96kHz" (Qobuz) or "Dolby Atmos" (Tidal)
+    label = str(label or '')
+    if 'atmos' in label.lower(): return {'codec': CodecEnum.EAC3}
+    if label == '360': return {'codec': CodecEnum.MHA1}
+    bits, khz = re.search(r'(\d+)\s*-?\s*bit', label, re.I), re.search(r'(\d+(?:\.\d+)?)\s*khz', label, re.I)
+    if bits or khz:
+        return {'bit_depth': int(bits.group(1)) if bits else None,
+                'sample_rate': round(float(khz.group(1)) * 1000) if khz else None}
+    return {'codec': codec}
+
+
+def annotate_tracks(results, codec=None):
+    """
+    Add 'library' to track search results (dicts with 'title', 'performer': {'name': ...} and, where known, 'isrc',
+    'codec', 'bit_depth' and 'sample_rate' in kHz): None when the track is not in the library, otherwise its status,
+    'owned' or 'upgradeable', and the codec, bit depth and sample rate of the best copy. codec is the quality
+    assumed for results that do not state their own (see default_codec).
+    """
+    isrcs = [_isrc(result.get('isrc')) for result in results]
+    keys = [_key((result.get('performer') or {}).get('name'), result.get('title')) for result in results]
+    by_isrc, by_key = _lookup(LibraryTrack.isrc, isrcs), _lookup(LibraryTrack.track_key, keys)
+    for result, isrc, key in zip(results, isrcs, keys):
+        tracks = [t for t in by_isrc.get(isrc) or by_key.get(key) or [] if t.codec]
+        if not tracks:
+            result['library'] = None
+            continue
+        sample_rate = result.get('sample_rate')
+        offered = {'codec': result.get('codec') or codec, 'bit_depth': result.get('bit_depth'),
+                   'sample_rate': round(sample_rate * 1000) if sample_rate else None}
+        best = max(tracks, key=_rank)
+        result['library'] = {'status': 'owned' if any(covers(t, **offered) for t in tracks) else 'upgradeable',
+                             'codec': best.codec, 'bit_depth': best.bit_depth,
+                             'sample_rate': best.sample_rate / 1000 if best.sample_rate else None}
+    return results
+
+
+def annotate_albums(results, codec=None):
+    """
+    Add 'library' to album search results (dicts with 'title', 'artist': {'name': ...} and, where known, 'upc',
+    'quality' and 'track_count'): None when none of its tracks is in the library, otherwise the number of its tracks
+    that are and a status: 'partial' while tracks are missing, else 'owned' or 'upgradeable'.
+    """
+    upcs = [_upc(result.get('upc')) for result in results]
+    keys = [_key((result.get('artist') or {}).get('name'), result.get('title')) for result in results]
+    by_upc, by_key = _lookup(LibraryTrack.upc, upcs), _lookup(LibraryTrack.album_key, keys)
+    for result, upc, key in zip(results, upcs, keys):
+        # The best copy of each song
+        songs = {}
+        for track in by_upc.get(upc) or by_key.get(key) or []:
+            if not track.codec: continue
+            song = track.isrc or track.track_key or track.path
+            if song not in songs or _rank(track) > _rank(songs[song]): songs[song] = track
+        if not songs:
+            result['library'] = None
+            continue
+        offered = _album_quality(result.get('quality'), codec)
+        if result.get('track_count') and len(songs) < result['track_count']:
+            status = 'partial'
+        else:
+            status = 'owned' if all(covers(t, **offered) for t in songs.values()) else 'upgradeable'
+        result['library'] = {'status': status, 'tracks': len(songs)}
+    return results
+
+
+def skipper(music_dir, taken):
+    """
+    skip_track hook for a job's downloader (see orpheus_core_download): a track whose library copy is as good as what
+    would be downloaded is linked, or copied, from the library to where the download would have gone instead. taken
+    collects each such file with its library path (relative to music_dir).
+    """
+    def skip_track(track_info, location):
+        offered = {'codec': track_info.codec, 'bit_depth': track_info.bit_depth, 'bitrate': track_info.bitrate,
+                   'sample_rate': round(track_info.sample_rate * 1000) if track_info.sample_rate else None}
+        artist = track_info.artists[0] if track_info.artists else None
+        for track in sorted(copies(track_info.tags.isrc, artist, track_info.name), key=_rank, reverse=True):
+            if not covers(track, **offered): continue
+            source = os.path.join(music_dir, track.path)
+            try:
+                stat = os.stat(source)
+            except OSError:
+                continue
+            # Changed since it was indexed: the next scan reads it again
+            if (stat.st_size, stat.st_mtime_ns) != (track.size, track.mtime_ns): continue
+            destination = location + os.path.splitext(track.path)[1]
+            delivery.deliver_file(source, destination, keep_source=True)
+            taken[os.path.normpath(destination)] = track.path
+            return destination
+        return None
+    return skip_track
+
+
+def stats():
+    files, readable, size, indexed = db.session.query(
+        db.func.count(LibraryTrack.path), db.func.count(LibraryTrack.codec), db.func.sum(LibraryTrack.size),
+        db.func.max(LibraryTrack.scanned_at)).one()
+    lossless = LibraryTrack.query.filter(LibraryTrack.lossless.is_(True)).count()
+    return {'files': files, 'unreadable': files - readable, 'lossless': lossless, 'bytes': int(size or 0),
+            'last_indexed': indexed.isoformat() if indexed else None}
@@ -0,0 +1,108 @@
+import contextlib
+import logging
+import os
+import pickle
+
+import redis
+from OrpheusDL.utils.session_store import SessionStore, set_session_store
+
+"""
+Login storage module.
+
+OrpheusDL keeps module logins (tokens, refresh tokens, custom data) in loginstorage.bin. By default that file is the
+store, shared by every process that sees it: reads come from memory while it is unchanged, writes are locked and
+atomic (see OrpheusDL/utils/session_store.py). With SESSION_STORE=redis the storage lives in Redis instead, for
+workers that do not share a filesystem: whatever one process stores (a refreshed token) every other one reads, and
+the locks, including the one a Tidal token refresh runs under, hold across the whole cluster. Until the first write
+the Redis storage is seeded from the local file.
+
+Reads cost one GET of a version counter while the cached copy is current. When Redis is unreachable the local file
+store is used.
+
+API:
+ - initialize(redis_client, backend): call once; 'redis' installs the Redis store, anything else the file store.
+ - store: the installed store (None before initialize).
+"""
+
+KEY_PREFIX = 'flaccy:loginstorage'
+# A lock holder that died frees the lock after this long; a token refresh is a single HTTP request
+LOCK_TIMEOUT = 60
+# How long a process waits for a lock before giving up with an error
+LOCK_WAIT = 90
+
+store = None
+
+
+class RedisSessionStore(SessionStore):
+    def __init__(self, redis_client, prefix=KEY_PREFIX):
+        super().__init__()
+        self.redis = redis_client
+        self.prefix = prefix
+        self.local = SessionStore()  # the file: seeds the storage, and stands in while Redis is unreachable
+        self._versions = {}  # key -> (version, pickled bytes)
+
+    def _key(self, location):
+        # By file name, not path: processes on different hosts share the storage
+        return f'{self.prefix}:{os.path.basename(location)}'
+
+    def _fetch(self, key):
+        data, version = self.redis.mget(key, f'{key}:version')
+        if data is not None: self._versions[key] = (version, data)
+        return data
+
+    def load(self, location):
+        key = self._key(location)
+        try:
+            version, cached = self.redis.get(f'{key}:version'), self._versions.get(key)
+            data = cached[1] if cached and version is not None and cached[0] == version else self._fetch(key)
+        except redis.exceptions.ConnectionError as e:
+            logging.warning(f'Login storage: Redis unavailable ({e}), using the local file')
+            return self.local.load(location)
+        return pickle.loads(data) if data is not None else self.local.load(location)
+
+    def update(self, location, function):
+        key = self._key(location)
+        try:
+            with self.lock(location):
+                data = self._fetch(key)
+                new = function(pickle.loads(data) if data is not None else self.local.load(location))
+                if data is None or new != pickle.loads(data):
+                    data = pickle.dumps(new)
+                    pipe = self.redis.pipeline()
+                    pipe.set(key, data)
+                    pipe.incr(f'{key}:version')
+                    _, version = pipe.execute()
+                    self._versions[key] = (str(version).encode(), data)
+                return new
+        except redis.exceptions.ConnectionError as e:
+            logging.warning(f'Login storage: Redis unavailable ({e}), using the local file')
+            return self.local.update(location, function)
+
+    @contextlib.contextmanager
+    def lock(self, location, name=None):
+        key = self._key(location)
+        lock = self.redis.lock(f'{key}:{name}:lock' if name else f'{key}:lock', timeout=LOCK_TIMEOUT,
+                               blocking_timeout=LOCK_WAIT)
+        try:
+            acquired = lock.acquire()
+        except redis.exceptions.ConnectionError as e:
+            logging.warning(f'Login storage: Redis unavailable ({e}), locking the local file')
+            with self.local.lock(location, name):
+                yield
+            return
+        if not acquired:
+            raise TimeoutError(f'Login storage: gave up waiting for {lock.name} after {LOCK_WAIT}s')
+        try:
+            yield
+        finally:
+            try:
+                lock.release()
+            except redis.exceptions.LockError:
+                # Held past LOCK_TIMEOUT, so it already expired
+                logging.warning(f'Login storage: {lock.name} expired before it was released')
+
+
+def initialize(redis_client, backend='file'):
+    global store
+    store = RedisSessionStore(redis_client) if backend == 'redis' and redis_client is not None else SessionStore()
+    set_session_store(store)
@@ -0,0 +1,269 @@
+import atexit
+import logging
+import os
+import socket
+import threading
+import time
+
+from OrpheusDL.utils.telemetry import Telemetry, set_telemetry
+
+"""
+Metrics module.
+
+Prometheus-style counters, gauges and histograms for the web processes and the workers. Instruments are cheap
+in-process increments (a dict update under a lock); a background thread in every process adds the accumulated
+deltas to one Redis hash every few seconds, so /metrics on any web process renders the totals of the whole
+deployment. Job processes (RQ forks one per job) flush once more when their job ends.
+
+Values computed at scrape time (queue depth, slot use, artifact store size) are passed to render() instead of
+being stored. Process gauges (open SSE streams) are absolute values, not deltas: each process writes its own to a
+Redis hash that expires unless the flusher refreshes it, and render() sums the live ones, so a process that dies
+with streams open drops out of the total within PROCESS_TTL.
+
+Without Redis, each process serves only its own values.
+
+API:
+ - initialize(redis_client): call once; also installs the OrpheusDL telemetry hook.
+ - inc(name, value=1, **labels), observe(name, value, **labels)
+ - gauge_add(name, value, **labels): change a process gauge of this process
+ - flush(): push pending deltas to Redis now.
+ - render(collected): Prometheus text exposition; collected maps a gauge name to [(labels, value), ...].
+ - directory_usage(path): (bytes, files) of a directory's files, cached briefly.
+"""
+
+# Metric definitions: name -> (type, help, histogram buckets)
+_JOB_BUCKETS = (5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+_WAIT_BUCKETS = (0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+_LATENCY_BUCKETS = (0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+METRICS = {
+    'flaccy_http_requests_total': ('counter', 'HTTP requests served, by endpoint, method and status', None),
+    'flaccy_http_request_duration_seconds': ('histogram', 'Time to produce an HTTP response (SSE: until the stream starts)', _LATENCY_BUCKETS),
+    'flaccy_sse_connections': ('gauge', 'Open server-sent event streams', None),
+    'flaccy_queue_waiting_jobs': ('gauge', 'Jobs waiting in the scheduler, by lane', None),
+    'flaccy_rq_queued_jobs': ('gauge', 'Jobs dispatched to the RQ queue and not yet started', None),
+    'flaccy_queue_wait_seconds': ('histogram', 'Time from submission to start of a job, by lane', _WAIT_BUCKETS),
+    'flaccy_service_slots_in_use': ('gauge', 'Concurrency slots held, by service', None),
+    'flaccy_jobs_total': ('counter', 'Finished jobs, by media type, service and status', None),
+    'flaccy_job_duration_seconds': ('histogram', 'Job run time, by media type, service and status', _JOB_BUCKETS),
+    'flaccy_transfer_bytes_total': ('counter', 'File bytes received from upstream, by service', None),
+    'flaccy_transfer_seconds_total': ('counter', 'Time spent receiving file bodies, by service', None),
+    'flaccy_upstream_requests_total': ('counter', 'Upstream HTTP requests, by service, endpoint and status (429: throttled)', None),
+    'flaccy_upstream_request_seconds': ('histogram', 'Upstream time to response headers, by service and endpoint', _LATENCY_BUCKETS),
+    'flaccy_cache_lookups_total': ('counter', 'Cache lookups, by cache and result (hit/miss)', None),
+    'flaccy_artifact_store_bytes': ('gauge', 'Bytes in the artifact store', None),
+    'flaccy_artifact_store_files': ('gauge', 'Files in the artifact store', None),
+}
+
+FLUSH_INTERVAL = 5
+_REDIS_KEY = 'metrics'
+# Process gauges: one hash per process, gone PROCESS_TTL after its last refresh
+_PROCESS_KEY = 'metrics:process:'
+PROCESS_TTL = 3 * FLUSH_INTERVAL
+PROCESS_GAUGES = ('flaccy_sse_connections',)
+
+_redis = None
+_lock = threading.Lock()
+_pending = {}  # series -> delta not yet in Redis
+_local = {}  # series -> value, when there is no Redis
+_gauges = {}  # series -> current value of this process's gauges
+_flusher_pid = None
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _series(name, labels):
+    if not labels: return name
+    return name + '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items())) + '}'
+
+def _add(series, value):
+    with _lock:
+        _pending[series] = _pending.get(series, 0) + value
+    if _redis is not None and _flusher_pid != os.getpid(): _start_flusher()
+
+def inc(name, value=1, **labels):
+    _add(_series(name, labels), value)
+
+def observe(name, value, **labels):
+    buckets = METRICS[name][2]
+    with _lock:
+        # Every bucket is touched, so a series never misses some of its buckets
+        for bound in buckets:
+            series = _series(name + '_bucket', {**labels, 'le': bound})
+            _pending[series] = _pending.get(series, 0) + (1 if value <= bound else 0)
+        for suffix, delta in (('_bucket', 1), ('_sum', value), ('_count', 1)):
+            series = _series(name + suffix, {**labels, 'le': '+Inf'} if suffix == '_bucket' else labels)
+            _pending[series] = _pending.get(series, 0) + delta
+    if _redis is not None and _flusher_pid != os.getpid(): _start_flusher()
+
+def gauge_add(name, value, **labels):
+    series = _series(name, labels)
+    with _lock:
+        _gauges[series] = _gauges.get(series, 0) + value
+    if _redis is not None:
+        if _flusher_pid != os.getpid(): _start_flusher()
+        _publish_gauges()
+
+def _process_key():
+    return f'{_PROCESS_KEY}{socket.gethostname()}:{os.getpid()}'
+
+def _publish_gauges():
+    with _lock:
+        gauges = dict(_gauges)
+    if not gauges: return
+    try:
+        pipe = _redis.pipeline(transaction=True)
+        pipe.hset(_process_key(), mapping=gauges)
+        pipe.expire(_process_key(), PROCESS_TTL)
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"Metrics: failed to publish process gauges: {e}")
+
+def _drop_gauges():
+    if _redis is None or not _gauges: return
+    try:
+        _redis.delete(_process_key())
+    except Exception:
+        pass
+
+def flush():
+    global _pending
+    if _redis is not None: _publish_gauges()
+    with _lock:
+        pending, _pending = _pending, {}
+    if not pending: return
+    if _redis is None:
+        for series, delta in pending.items():
+            _local[series] = _local.get(series, 0) + delta
+        return
+    try:
+        pipe = _redis.pipeline(transaction=False)
+        for series, delta in pending.items():
+            pipe.hincrbyfloat(_REDIS_KEY, series, delta)
+        pipe.execute()
+    except Exception as e:
+        # Put the deltas back for the next attempt
+        with _lock:
+            for series, delta in pending.items():
+                _pending[series] = _pending.get(series, 0) + delta
+        logging.warning(f"Metrics: flush failed: {e}")
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+def _start_flusher():
+    # One flusher per process; a forked child (RQ work horse) starts its own
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid(): return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+
+# atexit runs in reverse order: flush (which republishes the gauges) before dropping them
+atexit.register(_drop_gauges)
+atexit.register(flush)
+
+
+class _OrpheusTelemetry(Telemetry):
+    def request(self, service, kind, endpoint, status_code, seconds):
+        inc('flaccy_upstream_requests_total', service=service, endpoint=endpoint, status=status_code or 'error')
+        observe('flaccy_upstream_request_seconds', seconds, service=service, endpoint=endpoint)
+
+    def transfer(self, service, nbytes, seconds):
+        inc('flaccy_transfer_bytes_total', nbytes, service=service)
+        inc('flaccy_transfer_seconds_total', seconds, service=service)
+
+    def cache(self, name, hit):
+        inc('flaccy_cache_lookups_total', cache=name, result='hit' if hit else 'miss')
+
+
+def initialize(redis_client):
+    """
+    Aggregate metrics in Redis and feed the OrpheusDL telemetry into them. Call from app initialization.
+    """
+    global _redis
+    _redis = redis_client
+    set_telemetry(_OrpheusTelemetry())
+
+def _number(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+def _sort_key(series):
+    # Histogram buckets in ascending order of their bound
+    name, _, labels = series.partition('{')
+    le = None
+    for part in labels.rstrip('}').split(','):
+        if part.startswith('le="'): le = part[4:-1]
+    rest = ','.join(p for p in labels.rstrip('}').split(',') if not p.startswith('le="'))
+    return name, rest, float('inf') if le == '+Inf' else float(le or 0)
+
+def _live_gauges():
+    # Sum of the process gauges of every process still refreshing its hash
+    totals = {}
+    try:
+        for key in _redis.scan_iter(match=_PROCESS_KEY + '*', count=100):
+            for series, value in _redis.hgetall(key).items():
+                series = series.decode() if isinstance(series, bytes) else series
+                totals[series] = totals.get(series, 0) + float(value)
+    except Exception as e:
+        logging.warning(f"Metrics: failed to read process gauges: {e}")
+    return totals
+
+def render(collected=None):
+    flush()
+    if _redis is not None:
+        try:
+            values = {k.decode() if isinstance(k, bytes) else k: float(v) for k, v in _redis.hgetall(_REDIS_KEY).items()}
+            # Deltas of process gauges left in the shared hash by older versions are not totals of anything
+            values = {k: v for k, v in values.items() if k.partition('{')[0] not in PROCESS_GAUGES}
+        except Exception as e:
+            logging.warning(f"Metrics: failed to read from Redis: {e}")
+            values = {}
+        values.update(_live_gauges())
+    else:
+        values = dict(_local)
+        values.update(_gauges)
+    for name, samples in (collected or {}).items():
+        for labels, value in samples:
+            values[_series(name, labels)] = value
+
+    by_metric = {}
+    for series, value in values.items():
+        base = series.partition('{')[0]
+        for suffix in ('_bucket', '_sum', '_count'):
+            if base.endswith(suffix) and base[:-len(suffix)] in METRICS and METRICS[base[:-len(suffix)]][0] == 'histogram':
+                base = base[:-len(suffix)]
+                break
+        by_metric.setdefault(base, []).append(series)
+
+    lines = []
+    for name, (kind, help_text, _) in METRICS.items():
+        if name not in by_metric: continue
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} {kind}')
+        for series in sorted(by_metric[name], key=_sort_key):
+            lines.append(f'{series} {_number(values[series])}')
+    return '\n'.join(lines) + '\n'
+
+_usage_cache = {}
+
+def directory_usage(path, max_age=30):
+    now = time.monotonic()
+    cached = _usage_cache.get(path)
+    if cached and now - cached[0] < max_age: return cached[1]
+    total = files = 0
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                        files += 1
+                except OSError:
+                    pass
+    except OSError:
+        pass
+    _usage_cache[path] = (now, (total, files))
+    return total, files
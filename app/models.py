@@ -23,3 +23,56 @@ class Job(db.Model):
 
     def __repr__(self):
         return f"<Job {self.id}>"
+
+
+class JobTrace(db.Model):
+    # Phase timings of a job's run, in the compact form of OrpheusDL.utils.trace.Trace.to_dict()
+    job_id = db.Column(db.String(36), db.ForeignKey('job.id', ondelete='CASCADE'), primary_key=True)
+    data = db.Column(db.JSON)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    def __repr__(self):
+        return f"<JobTrace {self.job_id}>"
+
+
+class LibraryTrack(db.Model):
+    # An audio file of the music library (MUSIC_DIR) as last read by app.library; re-read when its size or mtime changes
+    path = db.Column(db.String(1024), primary_key=True)  # relative to MUSIC_DIR
+    size = db.Column(db.BigInteger)
+    mtime_ns = db.Column(db.BigInteger)
+    isrc = db.Column(db.String(16), index=True)
+    upc = db.Column(db.String(20), index=True)
+    title = db.Column(db.String(512))
+    artist = db.Column(db.String(512))
+    album_artist = db.Column(db.String(512))
+    album = db.Column(db.String(512))
+    # Normalized "artist|title" and "album artist|album", for matching releases that have no ISRC/UPC
+    track_key = db.Column(db.String(512), index=True)
+    album_key = db.Column(db.String(512), index=True)
+    # CodecEnum name; None when the file could not be read
+    codec = db.Column(db.String(10))
+    lossless = db.Column(db.Boolean)
+    spatial = db.Column(db.Boolean)
+    bit_depth = db.Column(db.Integer)
+    sample_rate = db.Column(db.Integer)  # Hz
+    bitrate = db.Column(db.Integer)  # kbps
+    duration = db.Column(db.Integer)  # seconds
+    scanned_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+    def __repr__(self):
+        return f"<LibraryTrack {self.path}>"
+
+
+class Artifact(db.Model):
+    # A file of the artifact store, indexed when its job stores it; /files/<filename> looks it up instead of the job
+    # manifests, and serves the ETag kept here while the file's size and mtime are unchanged
+    filename = db.Column(db.String(512), primary_key=True)  # stored name inside ARTIFACTS_DIR
+    job_id = db.Column(db.String(36), db.ForeignKey('job.id', ondelete='CASCADE'), index=True)
+    name = db.Column(db.String(512))  # download name
+    size = db.Column(db.BigInteger)
+    mtime_ns = db.Column(db.BigInteger)
+    etag = db.Column(db.String(64))
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+
+    def __repr__(self):
+        return f"<Artifact {self.filename}>"
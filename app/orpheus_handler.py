@@ -1,13 +1,27 @@
 import sys
+import threading
 from OrpheusDL.orpheus.core import Orpheus
 from OrpheusDL.utils.models import ModuleModes
 
-orpheus_session = Orpheus(private_mode=False)
+_orpheus_session = None
+_orpheus_session_lock = threading.Lock()
 loaded_modules = {}
 
+def get_orpheus_session():
+    """
+    The process's Orpheus session, built on first use. Its set-up reads and rewrites the module logins, so it must
+    not run before create_app() has installed the session store (SESSION_STORE).
+    """
+    global _orpheus_session
+    with _orpheus_session_lock:
+        if _orpheus_session is None:
+            _orpheus_session = Orpheus(private_mode=False)
+        return _orpheus_session
+
 def initialize_modules():
     """Loads and logs in to all available modules from settings."""
     global loaded_modules
+    orpheus_session = get_orpheus_session()
     for service_name in ['qobuz', 'tidal', 'kkbox']:
         try:
             if service_name in orpheus_session.settings['modules']:
@@ -39,7 +53,7 @@ def get_module(service_name):
 def construct_third_party_modules(service=None):
     """Constructs third-party modules dictionary for OrpheusDL."""
     third_party_modules = {}
-    default_modules = orpheus_session.settings['global']['module_defaults']
+    default_modules = get_orpheus_session().settings['global']['module_defaults']
     required_modes = {
         'lyrics': ModuleModes.lyrics,
         'covers': ModuleModes.covers,
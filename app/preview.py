@@ -0,0 +1,193 @@
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import threading
+import uuid
+
+from OrpheusDL.utils.lru_directory import LruDirectory
+from OrpheusDL.utils.models import CodecEnum, CodecOptions, DownloadEnum, QualityEnum
+
+from . import metrics
+from . import slots
+
+"""
+Preview module.
+
+Previews are the first few seconds of a track, streamed to the browser as MP3 while they are fetched. The track's
+stream URL is resolved through its module at a lossy quality tier (PREVIEW_QUALITY, MP3 320 on Qobuz). ffmpeg then
+reads only as much of the stream as the preview needs and writes MP3 to a pipe, and every chunk is sent on as soon as
+it arrives. An MP3 stream is copied as it is; anything else is encoded on the fly. Tidal's MPEG-DASH streams are fed
+to ffmpeg segment by segment, until ffmpeg has enough.
+
+A preview holds a concurrency slot of its service (see app/slots.py) while it streams, so it never opens a stream a
+download job is entitled to (Tidal allows one per account), and at most PREVIEW_MAX_CONCURRENT previews stream per
+process. Over either limit a preview is refused with PreviewBusy instead of waiting.
+
+Every complete preview is also written to an on-disk cache, so repeating a preview costs no upstream request. Entries
+are written to a temp name and renamed into place. The least recently used entries are evicted once the cache exceeds
+its size limit (see OrpheusDL's LruDirectory, which the artwork cache uses as well). A preview the listener abandons is not cached.
+
+API:
+ - initialize(cache_dir, max_bytes, seconds, quality, max_concurrent): call once; seconds=0 disables previews
+ - enabled(), cached(service, track_id): path of the cached preview or None
+ - open_stream(module, service, track_id): take a slot, resolve the stream and start ffmpeg, returns a generator of
+   MP3 chunks; raises PreviewUnavailable, or PreviewBusy at a limit
+"""
+
+# ffmpeg's encoder settings for streams that are not MP3 already
+MP3_BITRATE = '192k'
+# Largest chunk handed to the response at once; smaller ones go out as soon as ffmpeg writes them
+CHUNK_SIZE = 64 * 1024
+
+_cache_dir = None
+_entries = None  # LruDirectory of the cache
+_seconds = 30
+_quality = QualityEnum.HIGH
+_streams = threading.BoundedSemaphore(4)
+
+
+class PreviewUnavailable(Exception):
+    pass
+
+
+class PreviewBusy(PreviewUnavailable):
+    pass
+
+
+def initialize(cache_dir, max_bytes, seconds=30, quality='high', max_concurrent=4):
+    global _cache_dir, _entries, _seconds, _quality, _streams
+    _cache_dir = os.path.abspath(cache_dir) if cache_dir and max_bytes > 0 else None
+    _entries = LruDirectory(_cache_dir, max_bytes, name='Preview cache') if _cache_dir else None
+    _seconds = seconds
+    _quality = QualityEnum[str(quality).upper()]
+    _streams = threading.BoundedSemaphore(max(1, int(max_concurrent)))
+
+
+def enabled():
+    return _seconds > 0
+
+
+def _path(service, track_id):
+    key = hashlib.sha256(f'{service}\0{track_id}\0{_seconds}\0{_quality.name}'.encode()).hexdigest()
+    return os.path.join(_cache_dir, key[:2], f'{key}.mp3')
+
+
+def cached(service, track_id):
+    if not _cache_dir: return None
+    path = _path(service, track_id)
+    try:
+        _entries.touch(path)
+    except OSError:
+        metrics.inc('flaccy_cache_lookups_total', cache='preview', result='miss')
+        return None
+    metrics.inc('flaccy_cache_lookups_total', cache='preview', result='hit')
+    return path
+
+
+def _source(module, track_id):
+    # What ffmpeg reads: a URL or file (with request headers), or segment URLs to feed it, and the stream's codec
+    codec_options = CodecOptions(proprietary_codecs=False, spatial_codecs=False)
+    track_info = module.get_track_info(track_id, _quality, codec_options)
+    if track_info.error: raise PreviewUnavailable(track_info.error)
+    kwargs = track_info.download_extra_kwargs or {}
+    audio_track = kwargs.get('audio_track')
+    if getattr(audio_track, 'urls', None):
+        return {'segments': audio_track.urls, 'codec': audio_track.codec}
+    download_info = module.get_track_download(**kwargs)
+    if download_info.download_type is DownloadEnum.URL:
+        return {'input': download_info.file_url, 'headers': download_info.file_url_headers, 'codec': track_info.codec}
+    return {'input': download_info.temp_file_path, 'temporary': True,
+            'codec': download_info.different_codec or track_info.codec}
+
+
+def _command(source):
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error']
+    if source.get('headers'):
+        command += ['-headers', ''.join(f'{name}: {value}\r\n' for name, value in source['headers'].items())]
+    if source.get('segments'): command += ['-f', 'mp4']  # the segments form one fragmented MP4
+    command += ['-i', source.get('input') or 'pipe:0', '-t', str(_seconds), '-vn', '-map_metadata', '-1']
+    command += ['-c:a', 'copy'] if source['codec'] == CodecEnum.MP3 else ['-c:a', 'libmp3lame', '-b:a', MP3_BITRATE]
+    return command + ['-f', 'mp3', 'pipe:1']
+
+
+def _feed(process, urls):
+    # Segments go in until ffmpeg has read enough and closes its end of the pipe
+    from OrpheusDL.utils.ratelimit import TRANSFER, limited_request, service_for_url
+    from OrpheusDL.utils.utils import r_session
+    try:
+        for url in urls:
+            r = limited_request(r_session, 'GET', url, service_for_url(url), TRANSFER, stream=True, verify=False)
+            r.raise_for_status()
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                process.stdin.write(chunk)
+    except (OSError, ValueError):
+        pass
+    except Exception as e:
+        logging.warning(f'Preview: fetching a segment failed: {e}')
+    finally:
+        try:
+            process.stdin.close()
+        except OSError:
+            pass
+
+
+def open_stream(module, service, track_id):
+    """
+    Take a slot of the service, resolve the track's stream and start ffmpeg on it; errors up to here are raised, so
+    the caller can answer with an error instead of an empty stream. Returns a generator of MP3 chunks that also fills
+    the cache, and gives the slot back when it ends or is closed.
+    """
+    if shutil.which('ffmpeg') is None: raise PreviewUnavailable('FFmpeg is not installed')
+    streams = _streams
+    if not streams.acquire(blocking=False): raise PreviewBusy('Too many previews are playing')
+    slot = None
+    try:
+        slot = slots.try_acquire(service, f'preview:{uuid.uuid4().hex}', queue=False)
+        if slot is None: raise PreviewBusy(f'Every {service} stream is in use')
+        source = _source(module, track_id)
+        process = subprocess.Popen(_command(source), stdin=subprocess.PIPE if source.get('segments') else subprocess.DEVNULL,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except BaseException:
+        if slot: slot.release()
+        streams.release()
+        raise
+    if source.get('segments'):
+        threading.Thread(target=_feed, args=(process, source['segments']), daemon=True).start()
+    chunks = _pump(process, source, _path(service, track_id) if _cache_dir else None, slot, streams)
+    # Run it up to its first yield, inside its try: closing a generator that never started skips its finally, and
+    # the response may be closed before it is read
+    next(chunks)
+    return chunks
+
+
+def _pump(process, source, path, slot, streams):
+    temp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.part' if path else None
+    cache_file = None
+    try:
+        yield b''
+        if temp_path:
+            os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+            cache_file = open(temp_path, 'wb')
+        while True:
+            chunk = process.stdout.read1(CHUNK_SIZE)
+            if not chunk: break
+            if cache_file: cache_file.write(chunk)
+            yield chunk
+        if process.wait() != 0:
+            logging.warning(f'Preview: ffmpeg failed: {process.stderr.read().decode(errors="replace").strip()}')
+        elif cache_file and cache_file.tell():
+            cache_file.close()
+            os.replace(temp_path, path)
+            _entries.added(path)
+    finally:
+        # Also when the listener went away mid-stream: ffmpeg stops and the partial preview is dropped
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        if cache_file: cache_file.close()
+        if temp_path and os.path.exists(temp_path): os.remove(temp_path)
+        if source.get('temporary') and os.path.exists(source['input']): os.remove(source['input'])
+        slot.release()
+        streams.release()
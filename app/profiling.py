@@ -0,0 +1,101 @@
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+"""
+Profiling module.
+
+An opt-in sampling profiler for download jobs, for reproducing why one particular release is slow (many discs, DASH
+segments, conversions) without running it locally. A background thread records the stack of every thread of the
+job process (the job thread and its enrichment, prefetch and transcoding pools) every SAMPLE_INTERVAL seconds, so
+it is wall-clock: time spent waiting on the network or on ffmpeg shows up where it is waited for. It adds no
+instrumentation to the code itself, and jobs that are not profiled do not start it at all.
+
+The samples are written in the collapsed stack format ("thread;outer;...;inner count" per line), which
+flamegraph.pl, speedscope and similar tools read directly.
+
+API:
+ - wanted(options, sample_rate): whether to profile a job (options.profile, or a sample_rate share of jobs)
+ - SamplingProfiler(interval): start(), stop(), write(path), summary(top)
+"""
+
+SAMPLE_INTERVAL = 0.01
+# Functions listed in the job trace's profile summary
+TOP_FUNCTIONS = 25
+
+
+def wanted(options, sample_rate=0):
+    if isinstance(options, dict) and options.get('profile'):
+        return True
+    return sample_rate > 0 and random.random() < sample_rate
+
+
+def _label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class SamplingProfiler:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.stacks = Counter()  # (thread name, frame labels outermost first) -> samples
+        self._stop = threading.Event()
+        self._thread = None
+        self._started = None
+        self.duration = 0.0
+
+    def start(self):
+        self._started = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is None: return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        self.duration = time.monotonic() - self._started
+
+    def _run(self):
+        own = threading.get_ident()
+        labels = {}  # code object -> label, computed once
+        names, names_at = {}, 0
+        while not self._stop.wait(self.interval):
+            now = time.monotonic()
+            if now - names_at > 1:
+                names, names_at = {t.ident: t.name for t in threading.enumerate()}, now
+            for ident, frame in sys._current_frames().items():
+                if ident == own: continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None: label = labels[code] = _label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stack.reverse()
+                self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+            self.samples += 1
+
+    def write(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for (thread, stack), count in self.stacks.most_common():
+                f.write(';'.join((thread.replace(';', '_'),) + stack) + f' {count}\n')
+
+    def summary(self, top=TOP_FUNCTIONS):
+        """
+        Hottest functions by samples spent in the function itself (self) and with it on the stack (total).
+        """
+        own, total = Counter(), Counter()
+        for (_, stack), count in self.stacks.items():
+            if not stack: continue
+            own[stack[-1]] += count
+            for label in set(stack):
+                total[label] += count
+        functions = [{'function': label, 'self': count, 'total': total[label]} for label, count in own.most_common(top)]
+        return {'samples': self.samples, 'interval_ms': self.interval * 1000, 'duration_s': round(self.duration, 3),
+                'top': functions}
@@ -0,0 +1,225 @@
+import logging
+import threading
+import time
+
+from OrpheusDL.utils.cancellation import CANCEL_POLL_INTERVAL, check_cancelled
+from OrpheusDL.utils.ratelimit import RateLimiter, set_rate_limiter
+
+"""
+Rate limit module.
+
+One token bucket per upstream service and request class (metadata API calls vs file transfers), kept in Redis so
+every web and worker process draws from the same budget instead of each backing off on its own.
+
+Adaptation is AIMD: each bucket refills at a current rate that starts at its configured ceiling, grows by a small
+step after every successful request (up to the ceiling) and is halved on a 429. A 429 with Retry-After pauses the
+whole bucket until then (1 second without one), for all workers at once. The cluster therefore settles just under
+the upstream limit and stays there, instead of N workers each probing it.
+
+Without Redis (or when it is unreachable) the same buckets are kept per process.
+
+API:
+ - initialize(redis_client, rates): call once; installs the limiter used by the OrpheusDL module APIs.
+ - parse_rates(spec): "qobuz:metadata=8,tidal:transfer=6" -> {('qobuz', 'metadata'): 8.0, ...}, merged over DEFAULT_RATES
+ - limiter: the installed SharedRateLimiter (None before initialize).
+"""
+
+# Requests per second ceilings; a service/class not listed is not limited, but still pauses after a 429
+DEFAULT_RATES = {
+    ('qobuz', 'metadata'): 8.0,
+    ('qobuz', 'transfer'): 4.0,
+    ('tidal', 'metadata'): 8.0,
+    ('tidal', 'transfer'): 8.0,
+}
+# Bucket capacity, in seconds worth of the current rate
+BURST_SECONDS = 2.0
+# The rate never drops below this fraction of the ceiling
+MIN_RATE_FRACTION = 1 / 16
+# Multiplicative decrease on a 429, additive increase (as a fraction of the ceiling) per successful request
+DECREASE_FACTOR = 0.5
+INCREASE_FRACTION = 0.02
+# Pause after a 429 without Retry-After, and the longest single pause honoured
+DEFAULT_PAUSE = 1.0
+MAX_PAUSE = 300.0
+# Buckets idle for this long are dropped from Redis
+BUCKET_TTL = 3600
+
+# Both scripts run on Redis' clock, so workers on different hosts agree on time
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local ceiling, burst_seconds = tonumber(ARGV[1]), tonumber(ARGV[2])
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'rate', 'pause_until')
+local pause_until = tonumber(b[4]) or 0
+-- while paused the bucket is left alone, it refills from the end of the pause
+if now < pause_until then return tostring(pause_until - now) end
+local rate = tonumber(b[3]) or ceiling
+local capacity = math.max(1, rate * burst_seconds)
+local tokens = tonumber(b[1]) or capacity
+local ts = tonumber(b[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+else
+  wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now), 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[3]))
+return tostring(wait)
+"""
+
+_FEEDBACK_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local ceiling, throttled, pause = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local rate = tonumber(redis.call('HGET', KEYS[1], 'rate')) or ceiling
+if throttled == 1 then
+  rate = math.max(ceiling * tonumber(ARGV[4]), rate * tonumber(ARGV[5]))
+  local pause_end = now + pause
+  local current = tonumber(redis.call('HGET', KEYS[1], 'pause_until')) or 0
+  if pause_end > current then redis.call('HSET', KEYS[1], 'pause_until', tostring(pause_end)) end
+  -- start from an empty bucket after the pause, so workers resume gradually instead of in a burst
+  redis.call('HSET', KEYS[1], 'tokens', '0', 'ts', tostring(math.max(pause_end, current)))
+else
+  rate = math.min(ceiling, rate + ceiling * tonumber(ARGV[6]))
+end
+redis.call('HSET', KEYS[1], 'rate', tostring(rate))
+redis.call('EXPIRE', KEYS[1], tonumber(ARGV[7]))
+return tostring(rate)
+"""
+
+
+def parse_rates(spec):
+    rates = {}
+    for item in (spec or '').split(','):
+        if not item.strip(): continue
+        name, _, value = item.partition('=')
+        service, _, kind = name.strip().partition(':')
+        rates[(service.lower(), kind.lower() or 'metadata')] = float(value)
+    return rates
+
+
+class _LocalBucket:
+    # Same algorithm as the Redis scripts, for one process
+    def __init__(self, ceiling):
+        self.ceiling = ceiling
+        self.rate = ceiling
+        self.tokens = max(1.0, ceiling * BURST_SECONDS)
+        self.ts = time.monotonic()
+        self.pause_until = 0.0
+
+    def acquire(self, now):
+        if now < self.pause_until: return self.pause_until - now
+        self.tokens = min(max(1.0, self.rate * BURST_SECONDS), self.tokens + max(0.0, now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def feedback(self, now, throttled, pause):
+        if throttled:
+            self.rate = max(self.ceiling * MIN_RATE_FRACTION, self.rate * DECREASE_FACTOR)
+            self.pause_until = max(self.pause_until, now + pause)
+            self.tokens, self.ts = 0.0, self.pause_until
+        else:
+            self.rate = min(self.ceiling, self.rate + self.ceiling * INCREASE_FRACTION)
+        return self.rate
+
+
+class SharedRateLimiter(RateLimiter):
+    def __init__(self, redis_client=None, rates=None, prefix='ratelimit'):
+        self.redis = redis_client
+        # Configured rates override the defaults; 0 lifts the limit for that class
+        self.rates = {**DEFAULT_RATES, **(rates or {})}
+        self.prefix = prefix
+        self._local = {}
+        self._lock = threading.Lock()
+        self._acquire = redis_client.register_script(_ACQUIRE_SCRIPT) if redis_client is not None else None
+        self._feedback = redis_client.register_script(_FEEDBACK_SCRIPT) if redis_client is not None else None
+        self._redis_failed_at = None
+
+    def _key(self, service, kind):
+        return f'{self.prefix}:{service}:{kind}'
+
+    def _ceiling(self, service, kind):
+        ceiling = self.rates.get((service, kind))
+        # Unlisted classes get a bucket that never runs dry, so they still share 429 pauses
+        return ceiling if ceiling and ceiling > 0 else 1e6
+
+    def _use_redis(self):
+        # After a Redis error, stay on the per-process buckets for a while instead of failing every request
+        if self._acquire is None: return False
+        return self._redis_failed_at is None or time.monotonic() - self._redis_failed_at > 30
+
+    def _redis_error(self, e):
+        if self._redis_failed_at is None:
+            logging.warning(f'Rate limiter: Redis unavailable ({e}), limiting per process')
+        self._redis_failed_at = time.monotonic()
+
+    def _local_bucket(self, service, kind):
+        bucket = self._local.get((service, kind))
+        if bucket is None:
+            bucket = self._local[(service, kind)] = _LocalBucket(self._ceiling(service, kind))
+        return bucket
+
+    def acquire(self, service, kind):
+        ceiling = self._ceiling(service, kind)
+        while True:
+            wait = None
+            if self._use_redis():
+                try:
+                    wait = float(self._acquire(keys=[self._key(service, kind)], args=[ceiling, BURST_SECONDS, BUCKET_TTL]))
+                    self._redis_failed_at = None
+                except Exception as e:
+                    self._redis_error(e)
+            if wait is None:
+                with self._lock:
+                    wait = self._local_bucket(service, kind).acquire(time.monotonic())
+            if wait <= 0: return
+            self._pause(min(wait, MAX_PAUSE))
+
+    @staticmethod
+    def _pause(seconds):
+        # Slept in short steps: a pause after a Retry-After can be minutes, and a job cancelled meanwhile must give
+        # up its worker and slot right away
+        deadline = time.monotonic() + seconds
+        while True:
+            check_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return
+            time.sleep(min(remaining, CANCEL_POLL_INTERVAL))
+
+    def feedback(self, service, kind, status_code, retry_after=None, attempt=0):
+        throttled = status_code == 429
+        pause = min(MAX_PAUSE, retry_after if retry_after is not None else DEFAULT_PAUSE) if throttled else 0
+        ceiling = self._ceiling(service, kind)
+        rate = None
+        if self._use_redis():
+            try:
+                rate = float(self._feedback(keys=[self._key(service, kind)], args=[
+                    ceiling, int(throttled), pause, MIN_RATE_FRACTION, DECREASE_FACTOR, INCREASE_FRACTION, BUCKET_TTL]))
+            except Exception as e:
+                self._redis_error(e)
+        if rate is None:
+            with self._lock:
+                rate = self._local_bucket(service, kind).feedback(time.monotonic(), throttled, pause)
+        if throttled:
+            logging.info(f'Rate limiter: {service} {kind} throttled, pausing {pause:.1f}s, rate now {rate:.2f}/s')
+        # The bucket itself holds the pause, so the retry can go straight back to acquire()
+        return 0
+
+
+limiter = None
+
+
+def initialize(redis_client, rates=None):
+    """
+    Install the shared limiter for every OrpheusDL request made by this process.
+    Call from app initialization; pass redis_client=None to limit per process only.
+    """
+    global limiter
+    limiter = SharedRateLimiter(redis_client, rates)
+    set_rate_limiter(limiter)
+    return limiter
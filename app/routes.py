@@ -1,4 +1,4 @@
-from flask import Blueprint, request, jsonify, Response, render_template, session, send_file
+from flask import Blueprint, request, jsonify, Response, render_template, session, send_file, url_for
 from gevent import sleep
 from gevent.pool import Pool
 import time
@@ -10,14 +10,20 @@ import zipfile
 from io import BytesIO
 import uuid
 
-from OrpheusDL.orpheus.core import orpheus_core_download
 from OrpheusDL.utils.models import DownloadTypeEnum, MediaIdentification, CodecOptions, QualityEnum
+from OrpheusDL.utils.trace import waterfall
 
-from .orpheus_handler import get_module, construct_third_party_modules, orpheus_session, initialize_modules
+from .orpheus_handler import get_module, construct_third_party_modules, get_orpheus_session, initialize_modules
 from . import db
-from .models import Job, JobStatus
-from .tasks import download_task
+from .models import Job, JobStatus, JobTrace, Artifact
 from . import events
+from . import slots
+from . import scheduler
+from . import cancellation
+from . import metrics
+from . import library
+from . import preview
+from . import artifacts
 from . import files as files_module
 from flask import current_app
 from rq import Queue
@@ -43,6 +49,28 @@ def ensure_session_id():
     if 'user_id' not in session:
         session['user_id'] = str(uuid.uuid4())
 
+@main_bp.before_request
+def start_request_timer():
+    request.environ['flaccy.started'] = time.perf_counter()
+
+@main_bp.after_request
+def record_request_metrics(response):
+    started = request.environ.get('flaccy.started')
+    if started is not None:
+        # The URL rule, not the path, so ids and filenames do not become label values
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.inc('flaccy_http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+        metrics.observe('flaccy_http_request_duration_seconds', time.perf_counter() - started, endpoint=endpoint)
+    return response
+
+def _counted_stream(stream, name):
+    # Wraps an SSE generator so open streams show up in flaccy_sse_connections
+    metrics.gauge_add('flaccy_sse_connections', 1, stream=name)
+    try:
+        yield from stream
+    finally:
+        metrics.gauge_add('flaccy_sse_connections', -1, stream=name)
+
 @main_bp.route('/api/status')
 def status_stream():
     session_id = session['user_id']
@@ -65,7 +93,7 @@ def status_stream():
             except Exception as e:
                 print(f"SSE Error: {e}")
                 break
-    return Response(event_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive', 'X-Accel-Buffering': 'no'})
+    return Response(_counted_stream(event_stream(), 'status'), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive', 'X-Accel-Buffering': 'no'})
 
 @main_bp.route('/')
 def index():
@@ -105,7 +133,9 @@ def search():
                         'artist': {'name': album_info.artist if album_info else (item.artists[0] if item.artists else 'Unknown Artist')},
                         'image': {'small': album_info.cover_url if album_info else ''},
                         'duration': album_info.duration,
-                        'quality': album_info.quality
+                        'quality': album_info.quality,
+                        'track_count': len(album_info.tracks) if album_info and album_info.tracks else None,
+                        'upc': album_info.upc
                     }
                 except:
                     return {
@@ -131,16 +161,17 @@ def search():
                         'title': item.name,
                         'performer': {'name': item.artists[0] if item.artists else 'Unknown Artist'},
                         'album': {'title': album_data.get('title', 'Unknown Album')},
-                        'image': {'small': album_data.get('image', {}).get('small', '')}
+                        'image': {'small': album_data.get('image', {}).get('small', '')},
+                        'isrc': raw_data.get('isrc')
                     })
 
             elif service == 'tidal':
-                codec_settings = orpheus_session.settings['global']['codecs']
+                codec_settings = get_orpheus_session().settings['global']['codecs']
                 codec_options = CodecOptions(
                     proprietary_codecs=codec_settings['proprietary_codecs'],
                     spatial_codecs=codec_settings['spatial_codecs']
                 )
-                quality_str = orpheus_session.settings['global']['general']['download_quality']
+                quality_str = get_orpheus_session().settings['global']['general']['download_quality']
                 quality_tier = QualityEnum[quality_str.upper()]
 
                 def fetch_track_album_info(item):
@@ -156,7 +187,8 @@ def search():
                             'duration': track_info.duration,
                             'bit_depth': track_info.bit_depth,
                             'sample_rate': track_info.sample_rate,
-                            'codec': track_info.codec.name
+                            'codec': track_info.codec.name,
+                            'isrc': track_info.tags.isrc
                         }
                     except:
                         return {
@@ -185,6 +217,22 @@ def search():
                         'image': {'small': ''}
                     })
 
+        if search_type == DownloadTypeEnum.track and preview.enabled():
+            for result in results:
+                result['preview_url'] = url_for('main.preview_stream', service=service, track_id=result['id'])
+
+        # Mark what the music library already has (owned, or only at a lower quality)
+        if current_app.config.get('MUSIC_DIR'):
+            try:
+                codec = library.default_codec(get_orpheus_session().settings['global']['general']['download_quality'])
+                if search_type == DownloadTypeEnum.album:
+                    library.annotate_albums(results, codec)
+                else:
+                    library.annotate_tracks(results, codec)
+            except Exception as e:
+                db.session.rollback()
+                current_app.logger.error("Failed to look up search results in the library", error=str(e))
+
         return jsonify(results)
 
     except Exception as e:
@@ -195,6 +243,53 @@ def search():
 
 
 
+@main_bp.route('/api/preview', methods=['POST'])
+def preview_track():
+    """
+    Where the preview of a track streams from: {'preview_url': GET /api/preview/<service>/<track_id>}.
+    """
+    data = request.get_json(silent=True) or {}
+    service, track_id = data.get('service'), data.get('track_id')
+    if not service or not track_id:
+        return jsonify({'error': 'Missing service or track_id'}), 400
+    if not preview.enabled():
+        return jsonify({'error': 'Previews are disabled'}), 404
+    return jsonify({'preview_url': url_for('main.preview_stream', service=service, track_id=track_id)})
+
+@main_bp.route('/api/preview/<service>/<track_id>', methods=['GET'])
+def preview_stream(service, track_id):
+    """
+    The first PREVIEW_SECONDS of a track as MP3. A cached preview is sent as a file; otherwise it is streamed while
+    ffmpeg reads the track's stream, and cached once complete. A preview needs a free slot of its service and one of
+    the process's PREVIEW_MAX_CONCURRENT streams, or it gets a 503.
+    """
+    global modules_initialized
+    if not preview.enabled():
+        return jsonify({'error': 'Previews are disabled'}), 404
+    path = preview.cached(service, track_id)
+    if path:
+        response = send_file(path, mimetype='audio/mpeg', conditional=True)
+        response.headers['Cache-Control'] = 'private, max-age=86400'
+        return response
+    if not modules_initialized:
+        initialize_modules()
+        modules_initialized = True
+    try:
+        module = get_module(service)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 404
+    try:
+        chunks = preview.open_stream(module, service, track_id)
+    except preview.PreviewBusy as e:
+        # Every stream of the service is taken (by downloads), or this process streams as many previews as it may
+        return jsonify({'error': f"Preview unavailable: {e}, try again shortly"}), 503, {'Retry-After': '5'}
+    except preview.PreviewUnavailable as e:
+        return jsonify({'error': f"Preview unavailable: {e}"}), 503
+    except Exception as e:
+        current_app.logger.error("Preview failed", service=service, track_id=track_id, error=str(e))
+        return jsonify({'error': f"Preview failed: {e}"}), 502
+    return Response(chunks, mimetype='audio/mpeg', headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
 @main_bp.route('/jobs', methods=['POST'])
 def create_job():
     data = request.get_json()
@@ -207,19 +302,19 @@ def create_job():
         return jsonify({'error': 'Missing source'}), 400
 
     job_id = str(uuid.uuid4())
+    session_id = session.get('user_id')
     new_job = Job(
         id=job_id,
         status=JobStatus.QUEUED,
-        input={'source': source, 'options': options}
+        input={'source': source, 'options': options, 'session_id': session_id, 'queued_at': time.time()}
     )
     db.session.add(new_job)
     db.session.commit()
     current_app.logger.info("Created new job", job_id=job_id)
 
-    q = Queue(connection=current_app.redis)
-    # Enqueue with extended job timeout to allow zipping large albums (600s)
-    q.enqueue(download_task, new_job.id, job_timeout=600)
-    current_app.logger.info("Enqueued job", job_id=job_id, job_timeout=600)
+    # The scheduler hands the job to a worker when one is free, taking turns between lanes and sessions
+    lane = scheduler.submit(new_job.id, session_id, source)
+    current_app.logger.info("Submitted job", job_id=job_id, lane=lane, job_timeout=scheduler.job_timeout(source))
 
     return jsonify({'id': new_job.id, 'status': new_job.status.value}), 201
 
@@ -238,6 +333,67 @@ def get_job(job_id):
         'result': job.result
     })
 
+@main_bp.route('/jobs/<job_id>/trace', methods=['GET'])
+def get_job_trace(job_id):
+    """
+    Phase timings of a job's run as a waterfall: per-phase totals, job-level spans (initialize, download, store, zip)
+    and, per track, its spans (metadata, stream_url, transfer, artwork, lyrics, credits, conversion, tagging, ...)
+    in milliseconds from the start of the run. The trace is stored when the run ends.
+    """
+    job = Job.query.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    job_trace = JobTrace.query.get(job_id)
+    if not job_trace or not job_trace.data:
+        return jsonify({'error': 'No trace for this job', 'id': job.id, 'status': job.status.value}), 404
+    body = {'id': job.id, 'status': job.status.value, **waterfall(job_trace.data)}
+    if job_trace.data.get('profile'):
+        # Summary of a profiled run; the full profile is an artifact under /files
+        body['profile'] = {**job_trace.data['profile'], 'file': (job.result or {}).get('profile')}
+    return jsonify(body)
+
+def _cancel_job(job):
+    """
+    Cancel a queued or running job. A job still waiting in the scheduler is withdrawn and marked canceled here;
+    a running one is stopped by its worker, which sees the cancel flag within about a second.
+    """
+    if job.status not in (JobStatus.QUEUED, JobStatus.RUNNING):
+        return False
+    cancellation.request_cancel(job.id)
+    if job.status == JobStatus.QUEUED:
+        inp = job.input or {}
+        try:
+            scheduler.withdraw(job.id, inp.get('session_id'), inp.get('source'))
+        except Exception as e:
+            # If it is dispatched anyway, the worker skips it because of the flag
+            current_app.logger.error("Failed to withdraw job from scheduler", job_id=job.id, error=str(e))
+        job.status = JobStatus.CANCELED
+        job.step = "Canceled"
+        db.session.commit()
+        events.add_event(job.id, 'status', status=job.status.value, step=job.step)
+    current_app.logger.info("Job cancel requested", job_id=job.id)
+    return True
+
+@main_bp.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = Job.query.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    if not _cancel_job(job):
+        return jsonify({'error': f'Job already {job.status.value}', 'id': job.id, 'status': job.status.value}), 409
+    # A running job reports 'running' until its worker has stopped it
+    return jsonify({'id': job.id, 'status': job.status.value, 'cancel_requested': True}), 202
+
+@main_bp.route('/api/cancel-downloads', methods=['POST'])
+def cancel_downloads():
+    """
+    Cancel every queued or running job of the current session.
+    """
+    session_id = session['user_id']
+    active = Job.query.filter(Job.status.in_([JobStatus.QUEUED, JobStatus.RUNNING])).all()
+    canceled = [job.id for job in active if (job.input or {}).get('session_id') == session_id and _cancel_job(job)]
+    return jsonify({'success': True, 'canceled': canceled})
+
 @main_bp.route('/jobs/<job_id>/events', methods=['GET'])
 def job_events(job_id):
     """
@@ -264,7 +420,7 @@ def job_events(job_id):
             except Exception as e:
                 current_app.logger.error("SSE error", error=str(e))
                 break
-    return Response(event_stream(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive', 'X-Accel-Buffering': 'no'})
+    return Response(_counted_stream(event_stream(), 'job'), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'Connection': 'keep-alive', 'X-Accel-Buffering': 'no'})
 
 @main_bp.route('/api/health', methods=['GET'])
 def health():
@@ -305,14 +461,118 @@ def health():
     status_code = 200 if overall_ok else 503
     return jsonify({'status': 'ok' if overall_ok else 'degraded', 'checks': checks}), status_code
 
+@main_bp.route('/api/workers', methods=['GET'])
+def workers_status():
+    """
+    Worker pool and per-service slot utilization: the RQ workers with their state and current job,
+    queue length, and for every service its slot limit, slots in use, waiting jobs and holders.
+    """
+    from rq import Worker
+    workers = []
+    try:
+        for w in Worker.all(connection=current_app.redis):
+            workers.append({'name': w.name, 'state': w.get_state(), 'current_job': w.get_current_job_id(),
+                            'successful_jobs': w.successful_job_count, 'failed_jobs': w.failed_job_count})
+        queued = len(Queue(connection=current_app.redis))
+    except Exception as e:
+        current_app.logger.error("Failed to list workers", error=str(e))
+        queued = None
+    return jsonify({'workers': workers, 'queued': queued, 'slots': slots.status()})
+
+@main_bp.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Prometheus text exposition of the metrics aggregated from all web and worker processes, plus queue depth,
+    slot use and artifact store size read at scrape time.
+    """
+    collected = {}
+    try:
+        lanes = scheduler.stats()
+        collected['flaccy_queue_waiting_jobs'] = [({'lane': lane}, info['waiting']) for lane, info in lanes.items()]
+        collected['flaccy_rq_queued_jobs'] = [({}, len(Queue(connection=current_app.redis)))]
+    except Exception as e:
+        current_app.logger.error("Failed to read queue depth for metrics", error=str(e))
+    collected['flaccy_service_slots_in_use'] = [({'service': service}, info['in_use']) for service, info in slots.status().items()]
+    store_bytes, store_files = metrics.directory_usage(current_app.config['ARTIFACTS_DIR'])
+    collected['flaccy_artifact_store_bytes'] = [({}, store_bytes)]
+    collected['flaccy_artifact_store_files'] = [({}, store_files)]
+    return Response(metrics.render(collected), mimetype='text/plain; version=0.0.4')
+
+@main_bp.route('/api/queue', methods=['GET'])
+def queue_status():
+    """
+    Scheduler lanes: weight, waiting jobs and sessions, and queue wait percentiles (seconds) over recent jobs.
+    """
+    try:
+        return jsonify({'lanes': scheduler.stats()})
+    except Exception as e:
+        current_app.logger.error("Failed to read scheduler stats", error=str(e))
+        return jsonify({'error': 'Scheduler unavailable'}), 503
+
+@main_bp.route('/api/library', methods=['GET'])
+def library_status():
+    """
+    Music library index: files indexed, how many are lossless or could not be read, their total size, and the counts
+    of the last scan.
+    """
+    if not current_app.config.get('MUSIC_DIR'):
+        return jsonify({'error': 'No music library configured (MUSIC_DIR)'}), 404
+    body = library.stats()
+    try:
+        last_scan = current_app.redis.get(library.LAST_SCAN_KEY)
+        body['last_scan'] = json.loads(last_scan) if last_scan else None
+        body['scanning'] = bool(current_app.redis.exists(library.SCAN_LOCK_KEY))
+    except Exception as e:
+        current_app.logger.error("Failed to read library scan state", error=str(e))
+    return jsonify(body)
+
+@main_bp.route('/api/library/scan', methods=['POST'])
+def library_scan():
+    """
+    Queue an incremental scan of the music library; only new and changed files are read.
+    """
+    if not current_app.config.get('MUSIC_DIR'):
+        return jsonify({'error': 'No music library configured (MUSIC_DIR)'}), 404
+    rq_job = Queue(connection=current_app.redis).enqueue('app.tasks.library_scan_task', job_timeout=library.SCAN_TIMEOUT)
+    return jsonify({'queued': True, 'id': rq_job.id}), 202
+
+def _result_files(result):
+    # Every artifact a job result refers to: its files and, for a profiled job, the profile
+    files = list(result.get('files') or [])
+    if result.get('profile'):
+        files.append(result['profile'])
+    return files
+
+def _find_artifact(safe_name):
+    """
+    The artifact index entry of a stored file, or None when no job stored it. Artifacts stored before the index
+    existed are found in the job manifests once, and indexed then.
+    """
+    entry = artifacts.lookup(safe_name)
+    if entry is not None:
+        return entry
+    for j in Job.query.filter(Job.result != None).all():
+        if not j.result:
+            continue
+        for f in _result_files(j.result):
+            if f.get('filename') == safe_name:
+                try:
+                    artifacts.register(j.id, current_app.config['ARTIFACTS_DIR'], [f])
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                return artifacts.lookup(safe_name) or Artifact(filename=safe_name, job_id=j.id, name=f.get('name'))
+    return None
+
 @main_bp.route('/files/<filename>', methods=['GET'])
 def get_file(filename):
     """
-    Serve artifacts from the instance/artifacts directory via Nginx's X-Accel-Redirect.
+    Serve artifacts from the instance/artifacts directory via Nginx's X-Accel-Redirect, or directly (with
+    conditional and Range requests, see app.artifacts) when USE_X_ACCEL_REDIRECT is off.
 
     Access rules:
       - If a valid signed token is provided via ?token=..., serve the file (anonymous signed link).
-      - Otherwise, only serve when the filename exists in a job's result manifest (authenticated flow).
+      - Otherwise, only serve when the filename is in the artifact index, i.e. a job stored it (authenticated flow).
     """
     token = request.args.get('token')
     # Prevent path traversal by taking the basename
@@ -324,6 +584,12 @@ def get_file(filename):
     if not os.path.isfile(file_path):
         return jsonify({'error': 'File not found'}), 404
 
+    try:
+        entry = _find_artifact(safe_name)
+    except Exception:
+        # On DB errors, be conservative
+        entry = None
+
     # Authorization logic
     allowed = False
     if token:
@@ -331,84 +597,43 @@ def get_file(filename):
         if payload and payload.get('filename') == safe_name:
             allowed = True
     else:
-        # No token: require the filename appears in a job manifest
-        try:
-            jobs = Job.query.filter(Job.result != None).all()
-            for j in jobs:
-                if not j.result: continue
-                files = j.result.get('files', [])
-                if any(f.get('filename') == safe_name for f in files):
-                    allowed = True
-                    break
-        except Exception:
-            # On DB errors, be conservative
-            allowed = False
+        # No token: require the filename to be a job's artifact
+        allowed = entry is not None
 
     if not allowed:
         return jsonify({'error': 'Access denied'}), 403
 
-    # If allowed, send the redirect header to Nginx.
     # Prefer to suggest the original filename to the browser (for a nicer download name)
     # while still using the safe stored filename for on-disk storage and internal redirect.
-    display_name = safe_name
-    try:
-        # Try to find the original display name from job manifests
-        jobs = Job.query.filter(Job.result != None).all()
-        for j in jobs:
-            if not j.result:
-                continue
-            for f in j.result.get('files', []):
-                if f.get('filename') == safe_name:
-                    display_name = f.get('name') or safe_name
-                    break
-            if display_name != safe_name:
-                break
-    except Exception:
-        # If anything goes wrong, fall back to the safe filename
-        display_name = safe_name
+    if entry is None:
+        entry = Artifact(filename=safe_name, name=safe_name)
 
     # If configured to use Nginx's X-Accel-Redirect, send the redirect header.
-    # Otherwise, serve the file directly with Flask's send_file.
+    # Otherwise, serve the file directly.
     if current_app.config.get('USE_X_ACCEL_REDIRECT', False):
         internal_redirect_path = f'/internal/artifacts/{safe_name}'
         response = Response(status=200)
         response.headers['X-Accel-Redirect'] = internal_redirect_path
-        response.headers['Content-Disposition'] = f'attachment; filename="{display_name}"'
+        response.headers['Content-Disposition'] = f'attachment; filename="{entry.name or safe_name}"'
         return response
     else:
-        # Fallback for development: serve the file directly from the filesystem.
-        return send_file(
-            file_path,
-            as_attachment=True,
-            download_name=display_name
-        )
+        return artifacts.response(file_path, entry)
 
 
 @main_bp.route('/files/<filename>/sign', methods=['POST'])
 def sign_file(filename):
     """
     Return a signed URL for a given stored filename. Body may include {"ttl": seconds}.
-    The filename must be present in some job's result manifest.
+    The filename must be one of a job's artifacts.
     """
     data = request.get_json(force=True, silent=True) or {}
     ttl = int(data.get('ttl', 1800))  # default 30 minutes
 
     safe_name = os.path.basename(filename)
 
-    # Validate filename exists in a job manifest
-    allowed = False
+    # Validate filename is a job's artifact
     try:
-        jobs = Job.query.filter(Job.result != None).all()
-        for j in jobs:
-            if not j.result:
-                continue
-            files = j.result.get('files', [])
-            for f in files:
-                if f.get('filename') == safe_name:
-                    allowed = True
-                    break
-            if allowed:
-                break
+        allowed = _find_artifact(safe_name) is not None
     except Exception:
         allowed = False
 
@@ -0,0 +1,330 @@
+import json
+import logging
+
+from . import slots
+
+"""
+Scheduler module.
+
+Jobs do not go straight into the RQ queue. create_job files each one into a lane by estimated cost (track, album,
+playlist, artist) and, within the lane, into the submitting session's own list. The dispatcher (run by the worker
+supervisor) moves jobs into the RQ queue only when a worker is free to start them, so waiting jobs stay here where
+the order can still be chosen:
+ - lanes are picked by smooth weighted round-robin (LANE_WEIGHTS), so one-track requests keep moving while
+   playlists run, and big jobs still get their share;
+ - within a lane, sessions take turns, so one user's queue of albums does not hold up everybody else's;
+ - a job whose service has no free concurrency slot (see app/slots.py) is passed over and keeps its place: the pick
+   goes to the next session's job, or the session's next job of another service. The picked job's slot is reserved
+   in the same step, so it starts holding it and never has to wait in a worker.
+
+Each job gets an RQ timeout from its estimated size instead of a fixed 600 s. Queue waits (submission to start,
+including any wait for a service slot) are sampled per lane for percentiles.
+
+A picked job is moved to 'sched:dispatching' in the same step and removed from there once RQ has it. When the
+enqueue fails it goes straight back to the front of its lane; entries a dispatcher left behind (it died in between)
+are put back after DISPATCH_GRACE seconds by whichever dispatcher runs next.
+
+Redis keys: 'sched:{lane}:ring' (sessions with waiting jobs, in turn order), 'sched:{lane}:s:{session}' (that
+session's jobs), 'sched:credits' (round-robin state), 'sched:dispatching' (picked, not yet enqueued),
+'sched:waits:{lane}' (recent wait samples).
+
+API:
+ - initialize(redis_client, weights)
+ - lane_for(source), estimate_tracks(source), job_timeout(source)
+ - submit(job_id, session_id, source): returns the lane
+ - requeue(job_id, session_id, source): put a dispatched job back at the front of its lane (its slot was lost)
+ - withdraw(job_id, session_id, source): remove a job that is still waiting (cancelled)
+ - dispatch(queue, max_jobs, task): enqueue up to max_jobs waiting jobs, returns how many
+ - record_wait(lane, seconds), stats()
+"""
+
+LANES = ('track', 'album', 'playlist', 'artist')
+DEFAULT_WEIGHTS = {'track': 8, 'album': 4, 'playlist': 2, 'artist': 1}
+# Tracks assumed when the client does not say how many a release has
+DEFAULT_TRACKS = {'track': 1, 'album': 16, 'playlist': 60, 'artist': 150}
+# RQ timeout: a fixed allowance (module login, zipping) plus time per track, within bounds
+TIMEOUT_BASE = 300
+TIMEOUT_PER_TRACK = 60
+MIN_TIMEOUT = 600
+MAX_TIMEOUT = 6 * 3600
+# Wait samples kept per lane
+WAIT_SAMPLES = 1000
+# Key the dispatcher blocks on between rounds; submit() pushes to it so new jobs start right away
+WAKE_KEY = 'sched:wake'
+DISPATCHING_KEY = 'sched:dispatching'
+# A picked job not enqueued after this many seconds was left behind by a dispatcher that died, and is put back
+DISPATCH_GRACE = 30
+
+_redis = None
+_weights = dict(DEFAULT_WEIGHTS)
+
+_SUBMIT_SCRIPT = """
+redis.call('RPUSH', KEYS[2], ARGV[2])
+if redis.call('LLEN', KEYS[2]) == 1 then redis.call('RPUSH', KEYS[1], ARGV[1]) end
+redis.call('LPUSH', KEYS[3], 1)
+redis.call('LTRIM', KEYS[3], 0, 0)
+return 1
+"""
+
+# Finds the entry by its job id, so entries written with other fields (an older timeout...) can still be withdrawn
+_WITHDRAW_SCRIPT = """
+local removed = 0
+for _, entry in ipairs(redis.call('LRANGE', KEYS[2], 0, -1)) do
+  if cjson.decode(entry).job_id == ARGV[2] then
+    removed = redis.call('LREM', KEYS[2], 1, entry)
+    break
+  end
+end
+if removed > 0 and redis.call('LLEN', KEYS[2]) == 0 then redis.call('LREM', KEYS[1], 0, ARGV[1]) end
+return removed
+"""
+
+_REQUEUE_SCRIPT = """
+redis.call('LPUSH', KEYS[2], ARGV[2])
+if redis.call('LLEN', KEYS[2]) == 1 then redis.call('LPUSH', KEYS[1], ARGV[1]) end
+redis.call('LPUSH', KEYS[3], 1)
+redis.call('LTRIM', KEYS[3], 0, 0)
+return 1
+"""
+
+# KEYS: credits hash, dispatching hash, then one ring per lane; ARGV: lease seconds, lane count, lane names, their
+# weights, then service/slot limit pairs of the limited services
+_PICK_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local lease, n = tonumber(ARGV[1]), tonumber(ARGV[2])
+local limits, full = {}, {}
+for i = 3 + 2 * n, #ARGV, 2 do limits[ARGV[i]] = tonumber(ARGV[i + 1]) end
+local function is_full(service)
+  if not service or not limits[service] then return false end
+  if full[service] == nil then
+    -- the holders set of app/slots.py, leases that ran out dropped
+    local holders = 'slots:' .. service .. ':holders'
+    redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+    full[service] = redis.call('ZCARD', holders) >= limits[service]
+  end
+  return full[service]
+end
+-- the first session in turn order with a job that can start now, and that job
+local function startable(ring)
+  local prefix = ring:sub(1, -5) .. 's:'
+  for _, session in ipairs(redis.call('LRANGE', ring, 0, -1)) do
+    for _, entry in ipairs(redis.call('LRANGE', prefix .. session, 0, -1)) do
+      if not is_full(cjson.decode(entry).service) then return session, entry end
+    end
+  end
+  return nil
+end
+local best, best_credit, best_session, best_entry, total = nil, nil, nil, nil, 0
+for i = 1, n do
+  local session, entry = startable(KEYS[i + 2])
+  if session then
+    local lane, weight = ARGV[2 + i], tonumber(ARGV[2 + n + i])
+    local credit = tonumber(redis.call('HGET', KEYS[1], lane) or '0') + weight
+    redis.call('HSET', KEYS[1], lane, credit)
+    total = total + weight
+    if best == nil or credit > best_credit then
+      best, best_credit, best_session, best_entry = i, credit, session, entry
+    end
+  end
+end
+if best == nil then return nil end
+redis.call('HINCRBYFLOAT', KEYS[1], ARGV[2 + best], -total)
+local ring = KEYS[best + 2]
+local jobs = ring:sub(1, -5) .. 's:' .. best_session
+redis.call('LREM', jobs, 1, best_entry)
+redis.call('LREM', ring, 1, best_session)
+if redis.call('LLEN', jobs) > 0 then redis.call('RPUSH', ring, best_session) end
+local job = cjson.decode(best_entry)
+if job.service and limits[job.service] then
+  redis.call('ZADD', 'slots:' .. job.service .. ':holders', now + lease, job.job_id)
+end
+redis.call('HSET', KEYS[2], job.job_id, cjson.encode({lane = ARGV[2 + best], session = best_session,
+                                                      entry = best_entry, at = now}))
+return {ARGV[2 + best], best_session, best_entry}
+"""
+
+# KEYS: dispatching hash, wake key; ARGV: grace seconds, then optionally a job id to put back whatever its age.
+# Puts picked jobs back at the front of their lanes and gives up their slot reservations.
+_RESTORE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local restored = 0
+local items = redis.call('HGETALL', KEYS[1])
+for i = 1, #items, 2 do
+  local picked = cjson.decode(items[i + 1])
+  if items[i] == ARGV[2] or (ARGV[2] == nil and picked.at < now - tonumber(ARGV[1])) then
+    redis.call('HDEL', KEYS[1], items[i])
+    local ring = 'sched:' .. picked.lane .. ':ring'
+    local jobs = 'sched:' .. picked.lane .. ':s:' .. picked.session
+    redis.call('LPUSH', jobs, picked.entry)
+    if redis.call('LLEN', jobs) == 1 then redis.call('LPUSH', ring, picked.session) end
+    local service = cjson.decode(picked.entry).service
+    -- a job without a service has null there, which cjson decodes to a (truthy) userdata
+    if service and service ~= cjson.null then redis.call('ZREM', 'slots:' .. service .. ':holders', items[i]) end
+    restored = restored + 1
+  end
+end
+if restored > 0 then
+  redis.call('LPUSH', KEYS[2], 1)
+  redis.call('LTRIM', KEYS[2], 0, 0)
+end
+return restored
+"""
+
+
+def initialize(redis_client, weights=None):
+    """
+    Enable the scheduler on redis_client with lane weights (merged over DEFAULT_WEIGHTS).
+    Call from app initialization.
+    """
+    global _redis, _weights
+    _redis = redis_client
+    _weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+
+
+def parse_weights(spec):
+    weights = {}
+    for item in (spec or '').split(','):
+        if not item.strip(): continue
+        lane, _, value = item.partition('=')
+        weights[lane.strip().lower()] = max(1, int(value))
+    return weights
+
+
+def lane_for(source):
+    media_type = (source or {}).get('type', 'track')
+    return media_type if media_type in LANES else 'album'
+
+
+def estimate_tracks(source):
+    # The client may pass the release's track count along; otherwise a typical size for the lane
+    try:
+        count = int((source or {}).get('track_count') or 0)
+    except (TypeError, ValueError):
+        count = 0
+    return count if count > 0 else DEFAULT_TRACKS[lane_for(source)]
+
+
+def job_timeout(source):
+    return max(MIN_TIMEOUT, min(MAX_TIMEOUT, TIMEOUT_BASE + TIMEOUT_PER_TRACK * estimate_tracks(source)))
+
+
+def _ring_key(lane):
+    return f"sched:{lane}:ring"
+
+
+def _jobs_key(lane, session_id):
+    return f"sched:{lane}:s:{session_id}"
+
+
+def _entry(job_id, source):
+    service = ((source or {}).get('service') or '').lower() or None
+    return json.dumps({'job_id': job_id, 'timeout': job_timeout(source), 'service': service})
+
+
+def submit(job_id, session_id, source):
+    """
+    Put a job in its lane, behind the other waiting jobs of the same session.
+    """
+    lane = lane_for(source)
+    session_id = session_id or 'anonymous'
+    entry = _entry(job_id, source)
+    _redis.eval(_SUBMIT_SCRIPT, 3, _ring_key(lane), _jobs_key(lane, session_id), WAKE_KEY, session_id, entry)
+    return lane
+
+
+def requeue(job_id, session_id, source):
+    """
+    Put a dispatched job back in its lane, ahead of the other waiting jobs of its session, with the session's turn
+    next. For a job that could not start after all (its slot reservation ran out before a worker took it).
+    """
+    lane = lane_for(source)
+    session_id = session_id or 'anonymous'
+    entry = _entry(job_id, source)
+    _redis.eval(_REQUEUE_SCRIPT, 3, _ring_key(lane), _jobs_key(lane, session_id), WAKE_KEY, session_id, entry)
+    return lane
+
+
+def withdraw(job_id, session_id, source):
+    """
+    Take a job that has not been dispatched yet out of its lane. Returns False if it was no longer waiting there.
+    """
+    lane = lane_for(source)
+    session_id = session_id or 'anonymous'
+    return bool(_redis.eval(_WITHDRAW_SCRIPT, 2, _ring_key(lane), _jobs_key(lane, session_id), session_id, job_id))
+
+
+def _pick():
+    keys = ['sched:credits', DISPATCHING_KEY] + [_ring_key(lane) for lane in LANES]
+    limits = [value for service, limit in slots.limits().items() for value in (service, limit)]
+    picked = _redis.eval(_PICK_SCRIPT, len(keys), *keys, slots.LEASE_SECONDS, len(LANES), *LANES,
+                         *(_weights.get(lane, 1) for lane in LANES), *limits)
+    if not picked: return None
+    lane, session_id, entry = (v.decode() if isinstance(v, bytes) else v for v in picked)
+    return lane, session_id, json.loads(entry)
+
+
+def _restore(job_id=None):
+    args = [DISPATCH_GRACE] + ([job_id] if job_id else [])
+    return _redis.eval(_RESTORE_SCRIPT, 2, DISPATCHING_KEY, WAKE_KEY, *args)
+
+
+def dispatch(queue, max_jobs, task):
+    """
+    Move up to max_jobs waiting jobs into the RQ queue as task(job_id), in lane/session order, passing over jobs
+    whose service has no free slot. Jobs a dispatcher picked but never enqueued go back to their lanes first.
+    """
+    restored = _restore()
+    if restored:
+        logging.warning(f"Put back {restored} job(s) a dispatcher picked but did not enqueue")
+    dispatched = 0
+    while dispatched < max_jobs:
+        picked = _pick()
+        if picked is None: break
+        lane, session_id, entry = picked
+        try:
+            queue.enqueue(task, entry['job_id'], job_timeout=entry['timeout'], meta={'lane': lane, 'session_id': session_id})
+        except Exception:
+            _restore(entry['job_id'])
+            raise
+        _redis.hdel(DISPATCHING_KEY, entry['job_id'])
+        dispatched += 1
+        logging.info(f"Dispatched job {entry['job_id']} from lane {lane} (timeout {entry['timeout']}s)")
+    return dispatched
+
+
+def wait_for_work(timeout):
+    # Blocks until a job is submitted or timeout seconds pass
+    _redis.blpop(WAKE_KEY, timeout=timeout)
+
+
+def record_wait(lane, seconds):
+    try:
+        key = f"sched:waits:{lane}"
+        pipe = _redis.pipeline()
+        pipe.lpush(key, round(seconds, 3))
+        pipe.ltrim(key, 0, WAIT_SAMPLES - 1)
+        pipe.execute()
+    except Exception as e:
+        logging.warning(f"Scheduler: failed to record queue wait: {e}")
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def stats():
+    """
+    Per lane: weight, waiting jobs and sessions, and p50/p90/p99/max queue wait in seconds over recent jobs.
+    """
+    result = {}
+    for lane in LANES:
+        sessions = [s.decode() if isinstance(s, bytes) else s for s in _redis.lrange(_ring_key(lane), 0, -1)]
+        waiting = sum(_redis.llen(_jobs_key(lane, s)) for s in sessions)
+        waits = sorted(float(w) for w in _redis.lrange(f"sched:waits:{lane}", 0, -1))
+        result[lane] = {'weight': _weights.get(lane, 1), 'waiting': waiting, 'sessions': len(sessions), 'samples': len(waits)}
+        if waits:
+            result[lane].update({'wait_p50': _percentile(waits, 0.5), 'wait_p90': _percentile(waits, 0.9),
+                                 'wait_p99': _percentile(waits, 0.99), 'wait_max': waits[-1]})
+    return result
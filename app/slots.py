@@ -0,0 +1,222 @@
+import logging
+import threading
+import time
+
+"""
+Slots module.
+
+Per-service concurrency slots shared by all worker processes. A job takes a slot of its service before it starts
+downloading and gives it back when the download is done, so services that allow only a few simultaneous streams per
+account (Tidal) never see more than that, while services without a limit (Qobuz) run as many jobs as there are
+workers.
+
+Slots are leases: each holder is a member of a Redis sorted set scored by its lease expiry, renewed by a background
+thread while the job runs. A worker that dies without releasing its slot loses it once the lease runs out.
+Jobs that could not get a slot are remembered in arrival order, and a free slot goes to the longest waiting one.
+The scheduler reserves a slot for the job it dispatches (see app/scheduler.py) by adding it to the holders with a
+lease; the job's own try_acquire() then finds it holding the slot already.
+
+API:
+ - initialize(redis_client, limits): call once; without Redis, slots are counted per process.
+ - parse_limits(spec): "tidal=1,qobuz=0" -> {'tidal': 1, 'qobuz': 0}, merged over DEFAULT_LIMITS
+ - limits(): {service: limit} of the limited services
+ - try_acquire(service, holder, queue): a Slot (hold it until release()) or None when the service is at its limit.
+ - release(service, holder): give up a slot, also one the scheduler reserved and the job never took
+ - status(): {service: {'limit', 'in_use', 'waiting', 'holders'}} for every service seen recently.
+"""
+
+# Concurrent jobs per service; services not listed (or 0) are not limited
+DEFAULT_LIMITS = {'tidal': 1}
+# Lease length and renewal interval of a held slot
+LEASE_SECONDS = 60
+RENEW_SECONDS = 20
+# A waiting job that has not asked again for this long is dropped from the queue
+WAITER_TTL = 60
+
+_redis = None
+_limits = dict(DEFAULT_LIMITS)
+_holders = {}  # in-memory fallback: service -> {holder: lease expiry}
+_lock = threading.Lock()
+
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local holders, waiters, seen = KEYS[1], KEYS[2], KEYS[3]
+local holder, limit, lease, waiter_ttl = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+local queue = ARGV[5] == '1'
+redis.call('ZREMRANGEBYSCORE', holders, '-inf', now)
+if redis.call('ZSCORE', holders, holder) then
+  -- reserved for it by the scheduler
+  redis.call('ZREM', waiters, holder)
+  redis.call('ZREM', seen, holder)
+  redis.call('ZADD', holders, now + lease, holder)
+  return 1
+end
+local stale = redis.call('ZRANGEBYSCORE', seen, '-inf', now - waiter_ttl)
+for _, w in ipairs(stale) do redis.call('ZREM', waiters, w) redis.call('ZREM', seen, w) end
+local free = limit - redis.call('ZCARD', holders)
+if limit > 0 then
+  if free <= 0 then
+    if queue then
+      redis.call('ZADD', waiters, 'NX', now, holder)
+      redis.call('ZADD', seen, now, holder)
+    end
+    return 0
+  end
+  -- a free slot goes to the longest waiting jobs first
+  local rank = redis.call('ZRANK', waiters, holder)
+  if rank == false then rank = redis.call('ZCARD', waiters) end
+  if rank >= free then
+    if queue then
+      redis.call('ZADD', waiters, 'NX', now, holder)
+      redis.call('ZADD', seen, now, holder)
+    end
+    return 0
+  end
+end
+redis.call('ZREM', waiters, holder)
+redis.call('ZREM', seen, holder)
+redis.call('ZADD', holders, now + lease, holder)
+return 1
+"""
+
+_RENEW_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+if redis.call('ZSCORE', KEYS[1], ARGV[1]) == false then return 0 end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[2]), ARGV[1])
+return 1
+"""
+
+
+def initialize(redis_client, limits=None):
+    """
+    Enable Redis-backed slots shared by all processes using redis_client, with per-service limits.
+    Call from app initialization.
+    """
+    global _redis, _limits
+    _redis = redis_client
+    _limits = {**DEFAULT_LIMITS, **(limits or {})}
+
+
+def parse_limits(spec):
+    limits = {}
+    for item in (spec or '').split(','):
+        if not item.strip(): continue
+        service, _, value = item.partition('=')
+        limits[service.strip().lower()] = int(value)
+    return limits
+
+
+def limit_for(service):
+    limit = _limits.get((service or '').lower())
+    return limit if limit and limit > 0 else 0
+
+
+def limits():
+    return {service: limit for service, limit in _limits.items() if limit and limit > 0}
+
+
+def _keys(service):
+    return f"slots:{service}:holders", f"slots:{service}:waiters", f"slots:{service}:seen"
+
+
+class Slot:
+    """A held slot; renews its lease in the background until release() (also usable as a context manager)."""
+
+    def __init__(self, service, holder):
+        self.service = service
+        self.holder = holder
+        self._stop = threading.Event()
+        self._thread = None
+        if _redis is not None:
+            self._thread = threading.Thread(target=self._renew, name=f'slot-{service}', daemon=True)
+            self._thread.start()
+
+    def _renew(self):
+        while not self._stop.wait(RENEW_SECONDS):
+            try:
+                if not _redis.eval(_RENEW_SCRIPT, 1, _keys(self.service)[0], self.holder, LEASE_SECONDS):
+                    logging.warning(f"Slots: lease of {self.holder} on {self.service} was lost")
+                    return
+            except Exception as e:
+                logging.warning(f"Slots: failed to renew lease of {self.holder} on {self.service}: {e}")
+
+    def release(self):
+        if self._stop.is_set(): return
+        self._stop.set()
+        release(self.service, self.holder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def try_acquire(service, holder, queue=True):
+    """
+    Take a slot of `service` for `holder` (a job id) without waiting. Returns a Slot, or None when the service is at
+    its limit; asking again later keeps the holder's place in the queue. queue=False does not take a place (for
+    holders that give up instead of asking again, like previews).
+    """
+    service = (service or '').lower()
+    limit = limit_for(service)
+    if _redis is not None:
+        try:
+            granted = _redis.eval(_ACQUIRE_SCRIPT, 3, *_keys(service), holder, limit, LEASE_SECONDS, WAITER_TTL,
+                                 1 if queue else 0)
+        except Exception as e:
+            # Better to exceed a stream limit for a moment than to stall every job
+            logging.warning(f"Slots: Redis unavailable ({e}), not limiting {service}")
+            granted = 1
+        return Slot(service, holder) if granted else None
+    with _lock:
+        now = time.time()
+        holders = _holders.setdefault(service, {})
+        for h, expires in list(holders.items()):
+            if expires < now: del holders[h]
+        if limit and len(holders) >= limit: return None
+        holders[holder] = float('inf')
+    return Slot(service, holder)
+
+
+def release(service, holder):
+    service = (service or '').lower()
+    if _redis is not None:
+        try:
+            _redis.zrem(_keys(service)[0], holder)
+        except Exception as e:
+            # the lease runs out on its own
+            logging.warning(f"Slots: failed to release {holder} on {service}: {e}")
+    else:
+        with _lock:
+            _holders.get(service, {}).pop(holder, None)
+
+
+def status():
+    """
+    Slot utilization per service: configured limit (None when unlimited), slots in use, waiting jobs and holders.
+    """
+    services = set(_limits)
+    result = {}
+    if _redis is not None:
+        try:
+            for key in _redis.scan_iter(match='slots:*:holders'):
+                services.add((key.decode() if isinstance(key, bytes) else key).split(':')[1])
+            now = time.time()
+            for service in sorted(services):
+                holders_key, waiters_key, _ = _keys(service)
+                holders = [h.decode() if isinstance(h, bytes) else h for h in _redis.zrangebyscore(holders_key, now, '+inf')]
+                result[service] = {'limit': limit_for(service) or None, 'in_use': len(holders),
+                                   'waiting': _redis.zcard(waiters_key), 'holders': holders}
+            return result
+        except Exception as e:
+            logging.warning(f"Slots: failed to read status: {e}")
+            return {}
+    with _lock:
+        services.update(_holders)
+        for service in sorted(services):
+            holders = list(_holders.get(service, {}))
+            result[service] = {'limit': limit_for(service) or None, 'in_use': len(holders), 'waiting': 0, 'holders': holders}
+    return result
@@ -467,6 +467,13 @@ function displaySearchResults(results, append = false) {
             `;
         }
 
+        // Set when the music library already has this release
+        let libraryHTML = '';
+        if (item.library) {
+            const labels = { owned: 'In library', upgradeable: 'Upgrade available', partial: `${item.library.tracks} tracks in library` };
+            libraryHTML = `<p class="library-badge library-${item.library.status}">${labels[item.library.status] || ''}</p>`;
+        }
+
         let previewButtonHTML = '';
         if (currentSearchType === 'track' && item.preview_url) {
             previewButtonHTML = `<button class="preview-btn" data-preview-url="${item.preview_url}">Preview</button>`;
@@ -484,6 +491,7 @@ function displaySearchResults(results, append = false) {
                 <div class="track-info">
                     <p class="track-title">${title}</p>
                     <p class="track-artist">${artist}</p>
+                    ${libraryHTML}
                 </div>
                 <div class="mobile-download-container">
                     ${previewButtonHTML}
@@ -504,6 +512,7 @@ function displaySearchResults(results, append = false) {
                 <div class="track-info">
                     <p class="track-title">${title}</p>
                     <p class="track-artist">${artist}</p>
+                    ${libraryHTML}
                 </div>
             `;
         }
@@ -867,7 +876,9 @@ async function downloadAlbum(album) {
     const source = {
         service: service,
         id: album.id,
-        type: 'album'
+        type: 'album',
+        // lets the server size the job's timeout
+        track_count: album.track_count
     };
 
     fetch('/jobs', {
@@ -1117,8 +1128,10 @@ document.addEventListener('DOMContentLoaded', () => {
                     if (data.error) {
                         createErrorToast(data.error);
                     } else {
-                        const audio = new Audio(data.preview_url);
-                        audio.play();
+                        // One preview at a time
+                        if (window.previewAudio) window.previewAudio.pause();
+                        window.previewAudio = new Audio(data.preview_url);
+                        window.previewAudio.play();
                     }
                 })
                 .catch(error => {
@@ -1,17 +1,44 @@
 from app import create_app
-from app.models import Job, JobStatus
+from app.models import Job, JobStatus, JobTrace
 from app import db
 from OrpheusDL.orpheus.core import orpheus_core_download
 from OrpheusDL.utils.models import DownloadTypeEnum, MediaIdentification
-from .orpheus_handler import get_module, construct_third_party_modules, orpheus_session, initialize_modules
+from OrpheusDL.utils.cancellation import DownloadCancelled, cancellable
+from OrpheusDL.utils.trace import Trace, span, traced
+from .orpheus_handler import get_module, construct_third_party_modules, get_orpheus_session, initialize_modules
 import tempfile
+import json
 import os
 import shutil
 import uuid
 import re
 import subprocess
+import time
 
 from . import events
+from . import delivery
+from . import slots
+from . import scheduler
+from . import cancellation
+from . import metrics
+from . import profiling
+from . import library
+from . import artifacts
+
+def _defer_for_slot(job, service, log):
+    """
+    Put the job back in its lane because its service has no free slot after all (its reservation ran out before a
+    worker took it). The scheduler dispatches it again, ahead of its session's other jobs, once a slot is free.
+    """
+    inp = job.input or {}
+    scheduler.requeue(job.id, inp.get('session_id'), inp.get('source'))
+    step = f"Waiting for a free {service} slot"
+    if job.step != step:
+        job.step = step
+        db.session.commit()
+        events.add_event(job.id, 'status', status=job.status.value, step=job.step)
+    log.info("No free slot, job returned to the scheduler", service=service)
+
 
 def download_task(job_id):
     app = create_app()
@@ -25,6 +52,39 @@ def download_task(job_id):
 
         download_path = None
 
+        # Cancelled while it was waiting
+        service = ((job.input or {}).get('source') or {}).get('service')
+        if job.status == JobStatus.CANCELED or cancellation.is_requested(job.id):
+            # Free the slot the scheduler reserved for it
+            slots.release(service, job.id)
+            if job.status != JobStatus.CANCELED:
+                job.status = JobStatus.CANCELED
+                job.step = "Canceled"
+                db.session.commit()
+                events.add_event(job.id, 'status', status=job.status.value, step=job.step)
+            log.info("Job was canceled before it started")
+            return
+        if job.status != JobStatus.QUEUED:
+            # Dispatched twice: its dispatcher died after enqueueing it, before it could record that
+            slots.release(service, job.id)
+            log.warning("Job was already started, not running it again", status=job.status.value)
+            return
+        cancel_token = cancellation.token_for(job.id)
+
+        # Take the concurrency slot the scheduler reserved for the job's service; without one the job goes back to wait
+        slot = slots.try_acquire(service, job.id)
+        if slot is None:
+            _defer_for_slot(job, service, log)
+            return
+
+        # Time from submission to start, for the scheduler's per-lane queue wait percentiles
+        queued_at = (job.input or {}).get('queued_at')
+        lane = scheduler.lane_for(job.input.get('source'))
+        if queued_at:
+            scheduler.record_wait(lane, time.time() - queued_at)
+            metrics.observe('flaccy_queue_wait_seconds', time.time() - queued_at, lane=lane)
+        started = time.monotonic()
+
         # Mark running and emit event
         job.status = JobStatus.RUNNING
         job.step = "Initializing"
@@ -32,9 +92,17 @@ def download_task(job_id):
         db.session.commit()
         events.add_event(job.id, 'status', status=job.status.value, step=job.step)
         log.info("Job status updated to running")
+        # Phase timings of this run, served by GET /jobs/<id>/trace
+        trace = Trace()
+        profiler = None
+        if profiling.wanted((job.input or {}).get('options'), app.config.get('PROFILE_SAMPLE_RATE', 0)):
+            profiler = profiling.SamplingProfiler().start()
+            log.info("Profiling job")
 
         try:
+            initialize_started = time.monotonic()
             initialize_modules()
+            trace.add('initialize', initialize_started, time.monotonic())
             log.info("Modules initialized")
             
             source = job.input['source']
@@ -50,7 +118,11 @@ def download_task(job_id):
 
             module = get_module(service)
 
-            download_path = tempfile.mkdtemp(prefix="flaccy_job_")
+            # Stage on the same filesystem as the destination so delivery is a rename/hardlink, not a copy
+            staging_dir = app.config.get('STAGING_DIR')
+            if staging_dir:
+                os.makedirs(staging_dir, exist_ok=True)
+            download_path = tempfile.mkdtemp(prefix="flaccy_job_", dir=staging_dir)
 
             # Track how many files we've already stored and an estimated total to allow
             # smooth, per-track progress mapping during the download phase.
@@ -110,6 +182,13 @@ def download_task(job_id):
                     except Exception:
                         pass
 
+            # Tracks the music library already has at the quality they would be downloaded in are taken from it
+            # instead (options.skip_owned=false downloads them anyway); they are only delivered as artifacts
+            library_copies = {}
+            skip_track = None
+            if app.config.get('MUSIC_DIR') and options.get('skip_owned', True):
+                skip_track = library.skipper(app.config['MUSIC_DIR'], library_copies)
+
             media_to_download = {service: [MediaIdentification(media_id=media_id, media_type=media_type)]}
             third_party_modules = construct_third_party_modules(service)
 
@@ -127,14 +206,24 @@ def download_task(job_id):
 
             log.info("Calling orpheus_core_download", media=media_to_download, output_path=download_path)
             try:
-                rv = orpheus_core_download(
-                    orpheus_session=orpheus_session,
-                    media_to_download=media_to_download,
-                    third_party_modules=third_party_modules,
-                    separate_download_module=None,
-                    output_path=download_path,
-                    progress_callback=progress_callback
-                )
+                # The downloader checks the token between chunks and tracks and unwinds with DownloadCancelled
+                with cancellable(cancel_token), traced(trace), span('download'):
+                    rv = orpheus_core_download(
+                        orpheus_session=get_orpheus_session(),
+                        media_to_download=media_to_download,
+                        third_party_modules=third_party_modules,
+                        separate_download_module=None,
+                        output_path=download_path,
+                        progress_callback=progress_callback,
+                        scratch_dir=app.config.get('SCRATCH_DIR'),
+                        scratch_tmpfs_dir=app.config.get('SCRATCH_TMPFS_DIR'),
+                        scratch_tmpfs_max_bytes=app.config.get('SCRATCH_TMPFS_MAX_BYTES', 0),
+                        artwork_cache_dir=app.config.get('ARTWORK_CACHE_DIR'),
+                        artwork_cache_max_bytes=app.config.get('ARTWORK_CACHE_MAX_BYTES', 0),
+                        prefetch_depth=app.config.get('TRACK_PREFETCH_DEPTH', 0),
+                        transcode_workers=app.config.get('TRANSCODE_WORKERS'),
+                        skip_track=skip_track
+                    )
                 log.info("orpheus_core_download returned", result=rv)
                 # Emit a checkpoint event so frontends know the download step finished
                 events.add_event(job.id, 'checkpoint', message='download_complete')
@@ -207,8 +296,12 @@ def download_task(job_id):
                     log.exception("Failed to emit error event for job")
                 # Re-raise so outer exception handler marks job as failed and persists error
                 raise
+            finally:
+                # Storing and zipping need no upstream streams
+                slot.release()
 
             log.info("orpheus_core_download completed")
+            cancel_token.check()
 
             all_files = []
             for root, dirs, files in os.walk(download_path):
@@ -223,7 +316,14 @@ def download_task(job_id):
             artifacts_dir = app.config.get('ARTIFACTS_DIR') or os.path.join(app.instance_path, 'artifacts')
             os.makedirs(artifacts_dir, exist_ok=True)
 
+            library_dir = app.config.get('MUSIC_DIR') if app.config.get('DELIVER_TO_LIBRARY') else None
+            if not delivery.same_filesystem(download_path, library_dir or artifacts_dir):
+                log.warning("Staging directory is on a different filesystem than its destination, files will be copied",
+                            staging=download_path, destination=library_dir or artifacts_dir)
+
             stored_files = []
+            delivery_methods = {}
+            delivered_to_library = []
             # Prefer audio files first so the UI redirects to the primary audio (not sidecar files like .lrc).
             # Sort by extension priority (audio first) and by file size descending so the main audio file is chosen.
             def _ext_priority(p):
@@ -236,18 +336,38 @@ def download_task(job_id):
 
             total_files = len(all_files)
             stored_count = 0
+            store_started, stored_bytes = time.monotonic(), 0
 
             for file_path in all_files:
                 orig_filename = os.path.basename(file_path)
                 # ensure uniqueness and traceability
                 safe_filename = f"{job.id}_{uuid.uuid4().hex}_{orig_filename}"
                 new_path = os.path.join(artifacts_dir, safe_filename)
-                shutil.move(file_path, new_path)
-                # Ensure consistent ownership if configured (ARTIFACTS_OWNER_UID/GID)
+                library_path = None
+                # The library file the artifact is a link to, if any: taken from the library, or just delivered there
+                linked_library_file = os.path.normpath(file_path) in library_copies
+                if library_dir and os.path.normpath(file_path) not in library_copies:
+                    library_path = os.path.join(library_dir, os.path.relpath(file_path, download_path))
+                if library_path and not os.path.exists(library_path):
+                    # Library mode: the staged file becomes the library file, the artifact is a second link to it
+                    os.makedirs(os.path.dirname(library_path), exist_ok=True)
+                    delivery.deliver_file(file_path, library_path)
+                    delivered_to_library.append(library_path)
+                    method = delivery.deliver_file(library_path, new_path, keep_source=True)
+                    linked_library_file = os.path.samefile(library_path, new_path)
+                else:
+                    if library_path:
+                        log.info("File already present in library, not replacing it", path=library_path)
+                    method = delivery.deliver_file(file_path, new_path)
+                delivery_methods[method] = delivery_methods.get(method, 0) + 1
+                stored_bytes += os.path.getsize(new_path)
+                # Ensure consistent ownership if configured (ARTIFACTS_OWNER_UID/GID). An artifact linked to a library
+                # file (taken from the library, or delivered to it) shares its inode, whose owner (and ctime, which
+                # cleanup ages artifacts by) stays as it is.
                 try:
                     owner_uid = app.config.get('ARTIFACTS_OWNER_UID')
                     owner_gid = app.config.get('ARTIFACTS_OWNER_GID')
-                    if owner_uid is not None and owner_gid is not None:
+                    if owner_uid is not None and owner_gid is not None and not linked_library_file:
                         os.chown(new_path, int(owner_uid), int(owner_gid))
                 except Exception:
                     log.exception("Failed to set artifact ownership", path=new_path)
@@ -279,6 +399,15 @@ def download_task(job_id):
                     # Ignore best-effort notifications
                     pass
 
+            trace.add('store', store_started, time.monotonic(), stored_bytes)
+            log.info("Delivered files", methods=delivery_methods, library_dir=library_dir, from_library=len(library_copies))
+            if delivered_to_library:
+                try:
+                    library.index_files(library_dir, delivered_to_library)
+                except Exception:
+                    db.session.rollback()
+                    log.exception("Failed to index delivered files")
+
             # If this was an album download, create a zip archive containing all tracks
             # inside a folder named after the album (sanitized). Insert the zip as the primary
             # artifact so the UI will offer the full album download.
@@ -378,6 +507,7 @@ def download_task(job_id):
                     zip_name = f"{uuid.uuid4().hex}_{safe_album}.zip"
                     zip_path = os.path.join(artifacts_dir, zip_name)
                     import zipfile as _zipfile
+                    zip_started = time.monotonic()
                     try:
                         with _zipfile.ZipFile(zip_path, 'w', _zipfile.ZIP_DEFLATED) as zf:
                             for fmeta in stored_files:
@@ -385,6 +515,7 @@ def download_task(job_id):
                                 # Add into a folder inside the zip named after the album for clearer extraction
                                 arcname = os.path.join(safe_album, fmeta['name'])
                                 zf.write(stored_path, arcname)
+                        trace.add('zip', zip_started, time.monotonic(), os.path.getsize(zip_path))
                         # Ensure ownership of the created zip matches configured artifacts owner
                         try:
                             owner_uid = app.config.get('ARTIFACTS_OWNER_UID')
@@ -426,11 +557,24 @@ def download_task(job_id):
             job.step = "Completed"
             # Store metadata only (no absolute paths)
             job.result = {'files': stored_files}
+            if library_copies:
+                job.result['from_library'] = len(library_copies)
+            artifacts.register(job.id, artifacts_dir, stored_files)
             db.session.commit()
             events.add_event(job.id, 'status', status=job.status.value, step=job.step)
             events.add_event(job.id, 'result', files=stored_files)
             log.info("Job succeeded")
 
+        except DownloadCancelled:
+            log.info("Job canceled")
+            try:
+                job.status = JobStatus.CANCELED
+                job.step = "Canceled"
+                db.session.commit()
+                events.add_event(job.id, 'status', status=job.status.value, step=job.step)
+            except Exception:
+                log.exception("Failed to persist job cancel state")
+
         except Exception as e:
             log.error("Job failed", error=str(e))
             try:
@@ -443,8 +587,62 @@ def download_task(job_id):
                 log.exception("Failed to persist job failure state")
 
         finally:
+            slot.release()
+            job_labels = {'type': lane, 'service': service or 'unknown', 'status': job.status.value}
+            metrics.inc('flaccy_jobs_total', **job_labels)
+            metrics.observe('flaccy_job_duration_seconds', time.monotonic() - started, **job_labels)
+            # The work horse exits right after the job, before the background flush would run
+            metrics.flush()
+            trace_data = trace.to_dict()
+            if profiler is not None:
+                # The profile is an artifact next to the job's files; its hottest functions go into the trace
+                profiler.stop()
+                try:
+                    artifacts_dir = app.config.get('ARTIFACTS_DIR') or os.path.join(app.instance_path, 'artifacts')
+                    os.makedirs(artifacts_dir, exist_ok=True)
+                    profile_name = f"{job.id}_{uuid.uuid4().hex}_profile.folded"
+                    profiler.write(os.path.join(artifacts_dir, profile_name))
+                    job.result = {**(job.result or {}), 'profile': {'name': f"{job.id}_profile.folded", 'filename': profile_name}}
+                    artifacts.register(job.id, artifacts_dir, [job.result['profile']])
+                    trace_data['profile'] = profiler.summary()
+                except Exception:
+                    log.exception("Failed to store job profile")
+            try:
+                db.session.merge(JobTrace(job_id=job.id, data=trace_data))
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                log.exception("Failed to store job trace")
             if download_path and os.path.exists(download_path):
                 try:
                     shutil.rmtree(download_path)
                 except Exception:
                     log.exception("Failed to remove temporary download path")
+
+
+def library_scan_task():
+    """
+    Incremental scan of the music library (see app/library.py). A scan that is already running elsewhere makes this
+    one a no-op; the counts of the last scan are kept in Redis for GET /api/library.
+    """
+    app = create_app()
+    with app.app_context():
+        log = app.logger.bind(task='library_scan')
+        music_dir = app.config.get('MUSIC_DIR')
+        if not music_dir:
+            log.info("No music library configured, nothing to scan")
+            return None
+        lock = app.redis.lock(library.SCAN_LOCK_KEY, timeout=library.SCAN_TIMEOUT)
+        if not lock.acquire(blocking=False):
+            log.info("Library scan already running")
+            return None
+        try:
+            counts = library.scan(music_dir)
+            app.redis.set(library.LAST_SCAN_KEY, json.dumps({**counts, 'finished_at': time.time()}))
+            log.info("Library scanned", **counts)
+            return counts
+        finally:
+            try:
+                lock.release()
+            except Exception:
+                log.warning("Library scan lock expired before the scan finished")
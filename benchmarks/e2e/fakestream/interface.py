@@ -0,0 +1,112 @@
+import time
+from urllib.parse import urlencode
+from xml.etree import ElementTree
+
+from OrpheusDL.utils.models import *
+from OrpheusDL.utils.cancellation import check_cancelled
+from OrpheusDL.utils.ratelimit import METADATA, TRANSFER, limited_request
+from OrpheusDL.utils.telemetry import record_transfer
+from OrpheusDL.utils.utils import create_temp_filename, r_session, silentremove
+
+# Module for the benchmark's fake service (benchmarks/e2e/server.py). It is not installed in OrpheusDL/modules:
+# benchmarks/e2e/stack.py registers it in the benchmark's worker processes only.
+
+module_information = ModuleInformation(
+    service_name='Fake Stream',
+    module_supported_modes=ModuleModes.download | ModuleModes.covers | ModuleModes.lyrics | ModuleModes.credits,
+    flags=ModuleFlags.hidden,
+    session_settings={'base_url': ''},
+    netlocation_constant='fakestream',
+    login_behaviour=ManualEnum.manual
+)
+
+SERVICE = 'fakestream'
+
+
+class ModuleInterface:
+    def __init__(self, module_controller: ModuleController):
+        self.base_url = module_controller.module_settings['base_url'].rstrip('/')
+
+    def _get(self, path):
+        r = limited_request(r_session, 'GET', self.base_url + path, SERVICE, METADATA)
+        r.raise_for_status()
+        return r.json()
+
+    def search(self, query_type: DownloadTypeEnum, query: str, track_info: TrackInfo = None, limit: int = 10, offset: int = 0):
+        params = urlencode({'type': query_type.name, 'q': query, 'limit': limit, 'offset': offset})
+        items = self._get(f'/api/search?{params}')['items']
+        return [SearchResult(result_id=i['id'], name=i['title'], artists=[i['artist']], year=str(i['year'])) for i in items]
+
+    def get_album_info(self, album_id: str, data=None) -> AlbumInfo:
+        album = self._get(f'/api/album/{album_id}')
+        return AlbumInfo(
+            name=album['title'],
+            artist=album['artist'],
+            tracks=album['tracks'],
+            release_year=album['year'],
+            cover_url=album['cover_url'],
+            cover_type=ImageFileTypeEnum.jpg
+        )
+
+    def get_track_info(self, track_id: str, quality_tier: QualityEnum, codec_options: CodecOptions, data=None) -> TrackInfo:
+        track = self._get(f'/api/track/{track_id}')
+        tags = Tags(
+            album_artist=track['artist'],
+            track_number=track['number'],
+            total_tracks=track['total'],
+            disc_number=1,
+            total_discs=1,
+            genres=['Electronic'],
+            release_date=f"{track['year']}-01-01"
+        )
+        download_extra_kwargs = {'manifest_url': track['manifest_url']} if 'manifest_url' in track else {'file_url': track['file_url']}
+        return TrackInfo(
+            name=track['title'],
+            album=track['album'],
+            album_id=track['album_id'],
+            artists=[track['artist']],
+            tags=tags,
+            codec=CodecEnum.FLAC,
+            cover_url=track['cover_url'],
+            release_year=track['year'],
+            duration=track['duration'],
+            download_extra_kwargs=download_extra_kwargs
+        )
+
+    def get_track_download(self, file_url: str = None, manifest_url: str = None) -> TrackDownloadInfo:
+        if file_url:
+            return TrackDownloadInfo(download_type=DownloadEnum.URL, file_url=file_url)
+
+        # DASH: the segments are consecutive slices of the FLAC, so appending them in order gives the file; unlike
+        # TIDAL's fragmented MP4 there is no remux
+        r = limited_request(r_session, 'GET', manifest_url, SERVICE, METADATA)
+        r.raise_for_status()
+        urls = [s.get('media') for s in ElementTree.fromstring(r.content).iter('{urn:mpeg:dash:schema:mpd:2011}SegmentURL')]
+        location = create_temp_filename(large=True) + '.flac'
+        try:
+            with open(location, 'wb') as f:
+                for url in urls:
+                    r = limited_request(r_session, 'GET', url, SERVICE, TRANSFER, stream=True)
+                    r.raise_for_status()
+                    started, received = time.monotonic(), 0
+                    for chunk in r.iter_content(chunk_size=64 * 1024):
+                        check_cancelled()
+                        f.write(chunk)
+                        received += len(chunk)
+                    record_transfer(SERVICE, received, time.monotonic() - started)
+        except BaseException:
+            silentremove(location)
+            raise
+        return TrackDownloadInfo(download_type=DownloadEnum.TEMP_FILE_PATH, temp_file_path=location)
+
+    def get_track_cover(self, track_id: str, cover_options: CoverOptions, data=None) -> CoverInfo:
+        album_id = track_id.rpartition('.')[0]
+        return CoverInfo(url=f'{self.base_url}/cover/{album_id}.jpg', file_type=ImageFileTypeEnum.jpg)
+
+    def get_track_lyrics(self, track_id: str) -> LyricsInfo:
+        lyrics = self._get(f'/api/track/{track_id}/lyrics')
+        return LyricsInfo(embedded=lyrics['embedded'], synced=lyrics['synced'])
+
+    def get_track_credits(self, track_id: str) -> Optional[list]:
+        credits = self._get(f'/api/track/{track_id}/credits')
+        return [CreditsInfo(role, names) for role, names in credits.items()]
@@ -0,0 +1,250 @@
+"""
+End-to-end throughput benchmark: jobs go through the same path as in production, against a local fake streaming
+service instead of Qobuz/TIDAL.
+
+The driver starts the fake service (server.py) and a worker supervisor (workers.py, the regular worker.py with the
+fakestream module registered), submits jobs with POST /jobs, follows them with GET /jobs/<id> and fetches each
+result through GET /files/<filename>. The web side runs in this process on Flask's test client, so no web server is
+needed; the download path (scheduler, RQ, download_task, OrpheusDL) runs in real worker processes.
+
+Reported:
+ - jobs/min: finished jobs over the time from the first submission to the last finish;
+ - time to first byte: from submission of a job until the fake service sent the first audio byte for it;
+ - per-track latency percentiles, from the job traces (GET /jobs/<id>/trace), and where that time went by phase;
+ - peak RSS of the worker processes: the largest single process, and the sum over all of them at any one time.
+
+Needs a Redis server. A separate database is used (default redis://localhost:6379/15); it must be empty, or be
+emptied with --flush. --json writes the results, and --baseline compares against an earlier --json file, exiting
+with status 1 if throughput or track latency got worse than --max-regression allows.
+
+    python benchmarks/e2e/run.py [--jobs 12] [--type album] [--tracks 8] [--track-mb 30] [--format flac|dash|mixed]
+                                 [--latency 0.02] [--bandwidth-mb 0] [--throttle 0] [--workers 2]
+"""
+import json
+import os
+import resource
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import stack
+from stack import percentiles
+from server import FakeService, ServiceConfig
+
+FINISHED = ('succeeded', 'failed', 'canceled')
+
+
+class RssSampler:
+    """Samples the resident memory of a process tree from /proc (Linux); elsewhere it records nothing."""
+
+    def __init__(self, root_pid, interval=0.2):
+        self.root_pid = root_pid
+        self.interval = interval
+        self.peak_total = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        if os.path.isdir('/proc'): self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive(): self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak_total = max(self.peak_total, stack.tree_rss(self.root_pid))
+
+
+def run(args):
+    import redis
+    conn = redis.from_url(args.redis_url)
+    if conn.dbsize():
+        if not args.flush:
+            sys.exit(f'{args.redis_url} is not empty; use another database or pass --flush to empty it')
+        conn.flushdb()
+
+    config = ServiceConfig(latency=args.latency, bandwidth=args.bandwidth_mb * 1024 * 1024, throttle=args.throttle,
+                           retry_after=args.retry_after, tracks=args.tracks, track_bytes=int(args.track_mb * 1024 * 1024),
+                           format=args.format)
+    service = FakeService(config).start()
+    workdir = tempfile.mkdtemp(prefix='flaccy_bench_')
+    env = stack.environment(workdir, args.redis_url, service.url, args.workers)
+    os.environ.update(env)
+
+    # The web side: creates the database before the workers start
+    from app import create_app
+    app = create_app()
+    client = app.test_client()
+
+    log_path = os.path.join(workdir, 'workers.log')
+    with open(log_path, 'wb') as log:
+        workers = subprocess.Popen([sys.executable, os.path.join(stack.HERE, 'workers.py')], env={**os.environ, **env},
+                                   stdout=log, stderr=subprocess.STDOUT)
+    rss = RssSampler(workers.pid).start()
+    print(f'{args.jobs} {args.type} jobs, {args.tracks if args.type == "album" else 1} tracks of {args.track_mb:g} MiB '
+          f'({args.format}), {args.workers} workers; fake service {service.url}, logs in {log_path}')
+
+    try:
+        # Wait for the workers to register, so the first jobs are not timed waiting for start-up
+        from rq import Queue, Worker
+        deadline = time.monotonic() + 60
+        while len(Worker.all(queue=Queue('default', connection=conn))) < args.workers:
+            if workers.poll() is not None or time.monotonic() > deadline:
+                sys.exit(f'Workers did not start, see {log_path}')
+            time.sleep(0.2)
+
+        submitted = {}  # job id -> (album id, submission time)
+        for index in range(args.jobs):
+            album_id = f'bench{index}'
+            source = {'service': stack.SERVICE, 'type': args.type, 'track_count': args.tracks,
+                      'id': album_id if args.type == 'album' else f'{album_id}.1'}
+            r = client.post('/jobs', json={'source': source})
+            submitted[r.get_json()['id']] = (album_id, time.time())
+        started = min(t for _, t in submitted.values())
+
+        finished = {}  # job id -> (status json, finish time)
+        deadline = time.monotonic() + args.timeout
+        while len(finished) < len(submitted) and time.monotonic() < deadline:
+            for job_id in submitted.keys() - finished.keys():
+                job = client.get(f'/jobs/{job_id}').get_json()
+                if job['status'] in FINISHED: finished[job_id] = (job, time.time())
+            time.sleep(0.2)
+        elapsed = max((t for _, t in finished.values()), default=time.time()) - started
+
+        # The result as a user gets it, through /files
+        fetched_bytes, fetch_seconds = 0, 0.0
+        for job, _ in finished.values():
+            files = (job.get('result') or {}).get('files') or []
+            if job['status'] != 'succeeded' or not files: continue
+            fetch_started = time.monotonic()
+            r = client.get(f"/files/{files[0]['filename']}")
+            fetched_bytes += len(r.get_data())
+            fetch_seconds += time.monotonic() - fetch_started
+            r.close()
+
+        track_seconds, phases = [], {}
+        for job_id in finished:
+            r = client.get(f'/jobs/{job_id}/trace')
+            if r.status_code != 200: continue
+            trace = r.get_json()
+            track_seconds += [(t['end_ms'] - t['start_ms']) / 1000 for t in trace['tracks']]
+            for name, phase in trace['phases'].items():
+                total = phases.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+                total['count'] += phase['count']
+                total['seconds'] += phase['total_ms'] / 1000
+                total['bytes'] += phase['bytes']
+        ttfb = [service.stats.first_audio_byte[album_id] - submitted_at for album_id, submitted_at in submitted.values()
+                if album_id in service.stats.first_audio_byte]
+    finally:
+        workers.send_signal(signal.SIGTERM)
+        try:
+            workers.wait(timeout=60)
+        except subprocess.TimeoutExpired:
+            workers.send_signal(signal.SIGTERM)
+            workers.wait()
+        rss.stop()
+        service.stop()
+
+    statuses = {}
+    for job, _ in finished.values():
+        statuses[job['status']] = statuses.get(job['status'], 0) + 1
+    statuses['unfinished'] = len(submitted) - len(finished)
+    results = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('json', 'baseline', 'flush', 'keep', 'redis_url')},
+        'jobs': statuses,
+        'elapsed_s': round(elapsed, 3),
+        'jobs_per_min': round(statuses.get('succeeded', 0) / elapsed * 60, 3) if elapsed > 0 else 0,
+        'ttfb_s': {k: round(v, 3) for k, v in percentiles(ttfb).items()},
+        'track_latency_s': {k: round(v, 3) for k, v in percentiles(track_seconds).items()},
+        'phases': {name: {**p, 'seconds': round(p['seconds'], 3)} for name, p in sorted(phases.items())},
+        'files_fetched_mb_s': round(fetched_bytes / fetch_seconds / 1024 ** 2, 1) if fetch_seconds else None,
+        # ru_maxrss is in KiB on Linux: the largest worker process that has exited (all of them, after shutdown)
+        'peak_rss_process_mb': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+        'peak_rss_total_mb': round(rss.peak_total / 1024 ** 2, 1) if rss.peak_total else None,
+        'service': {'requests': service.stats.requests, 'throttled': service.stats.throttled,
+                    'sent_mb': round(service.stats.bytes_sent / 1024 ** 2, 1)},
+    }
+    if args.keep:
+        print(f'Kept {workdir}')
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def report(results):
+    jobs = results['jobs']
+    print(f"jobs: {', '.join(f'{n} {s}' for s, n in jobs.items() if n)} in {results['elapsed_s']:.1f}s"
+          f" = {results['jobs_per_min']:.2f} jobs/min")
+    for name, key in (('time to first byte', 'ttfb_s'), ('track latency', 'track_latency_s')):
+        p = results[key]
+        if p: print(f"{name:19} p50 {p['p50']:7.2f}s  p90 {p['p90']:7.2f}s  p99 {p['p99']:7.2f}s  max {p['max']:7.2f}s")
+    print('phases (summed over jobs; the track phases overlap each other):')
+    for name, p in results['phases'].items():
+        size = f"  {p['bytes'] / 1024 ** 2:10.1f} MiB" if p['bytes'] else ''
+        print(f"  {name:12} {p['count']:6}x {p['seconds']:10.2f}s{size}")
+    if results['files_fetched_mb_s']: print(f"/files: {results['files_fetched_mb_s']} MiB/s")
+    total = f", all workers together {results['peak_rss_total_mb']} MiB" if results['peak_rss_total_mb'] else ''
+    print(f"peak RSS: largest process {results['peak_rss_process_mb']} MiB{total}")
+    service = results['service']
+    print(f"fake service: {sum(service['requests'].values())} requests, {service['throttled']} answered 429, "
+          f"{service['sent_mb']} MiB sent")
+
+
+def compare(results, baseline, tolerance):
+    # Regressions beyond the tolerance: lower throughput, or slower tracks at the median or p90
+    failures = []
+    old, new = baseline.get('jobs_per_min') or 0, results['jobs_per_min']
+    if old and new < old * (1 - tolerance):
+        failures.append(f'jobs/min {new:.2f} < {old:.2f}')
+    for key in ('p50', 'p90'):
+        old, new = (baseline.get('track_latency_s') or {}).get(key), results['track_latency_s'].get(key)
+        if old and new and new > old * (1 + tolerance):
+            failures.append(f'track latency {key} {new:.2f}s > {old:.2f}s')
+    return failures
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure download throughput end to end against a fake service.')
+    parser.add_argument('--jobs', type=int, default=12, help='Jobs to submit at once (default 12)')
+    parser.add_argument('--type', choices=('album', 'track'), default='album')
+    parser.add_argument('--tracks', type=int, default=8, help='Tracks per album (default 8)')
+    parser.add_argument('--track-mb', type=float, default=30, help='Size of every track in MiB (default 30)')
+    parser.add_argument('--format', choices=('flac', 'dash', 'mixed'), default='flac',
+                        help='Plain FLAC files, DASH segments, or both in turn (default flac)')
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds before every response (default 0.02)')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='MiB/s per connection, 0: unlimited (default)')
+    parser.add_argument('--throttle', type=float, default=0, help='Share of requests answered 429 (default 0)')
+    parser.add_argument('--retry-after', type=float, default=1, help='Retry-After of those answers (default 1)')
+    parser.add_argument('--workers', type=int, default=2, help='Worker processes (default 2)')
+    parser.add_argument('--timeout', type=float, default=1800, help='Seconds to wait for the jobs (default 1800)')
+    parser.add_argument('--redis-url', default=os.environ.get('BENCH_REDIS_URL', 'redis://localhost:6379/15'))
+    parser.add_argument('--flush', action='store_true', help='Empty the Redis database first')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory (database, artifacts, logs)')
+    parser.add_argument('--json', help='Write the results to this file')
+    parser.add_argument('--baseline', help='Results of an earlier run (--json) to compare against')
+    parser.add_argument('--max-regression', type=float, default=0.15, help='Tolerated slowdown (default 0.15)')
+    args = parser.parse_args()
+
+    results = run(args)
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            failures = compare(results, json.load(f), args.max_regression)
+        for failure in failures: print(f'REGRESSION: {failure}')
+        if failures: sys.exit(1)
+    if results['jobs'].get('succeeded', 0) < args.jobs:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+"""
+Local stand-in for a streaming service, used by the end-to-end benchmark (run.py) through the fakestream module.
+
+It serves a small JSON API (search, albums, tracks, lyrics, credits), synthetic FLAC files (valid metadata blocks with a
+random audio payload, enough for transfer, padding and tagging), MPEG-DASH style manifests whose segments are
+slices of the same FLAC, and JPEG covers. Latency before each response, a per-connection bandwidth cap and a share
+of requests answered 429 Too Many Requests can be injected. Every album id is its own release: albums have
+`tracks` tracks with ids "<album id>.<number>".
+
+It also records what a client cannot see from outside: request and 429 counts, bytes sent, and when the first
+audio byte of each album went out (the benchmark's time to first byte).
+
+    python benchmarks/e2e/server.py [--port 8765] [--latency 0.02] [--bandwidth-mb 0] [--throttle 0]
+"""
+import io
+import json
+import random
+import re
+import threading
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+from PIL import Image
+
+CHUNK = 64 * 1024
+
+
+@dataclass
+class ServiceConfig:
+    latency: float = 0.02  # seconds before every response
+    bandwidth: float = 0  # bytes per second per connection for file bodies, 0: unlimited
+    throttle: float = 0  # share of requests answered 429
+    retry_after: float = 1
+    tracks: int = 8  # per album
+    track_bytes: int = 30 * 1024 * 1024
+    format: str = 'flac'  # flac, dash, or mixed (even track numbers are DASH)
+    segment_bytes: int = 1024 * 1024
+    cover_resolution: int = 1400
+    seed: int = 0
+
+
+@dataclass
+class ServiceStats:
+    requests: dict = field(default_factory=dict)  # kind -> count
+    throttled: int = 0
+    bytes_sent: int = 0
+    first_audio_byte: dict = field(default_factory=dict)  # album id -> unix time
+
+
+def make_flac(size, seed=0):
+    # STREAMINFO (16 bit stereo 44.1 kHz), a vendor-only VORBIS_COMMENT and libFLAC's default 8 KiB padding
+    streaminfo = (4096).to_bytes(2, 'big') * 2 + bytes(6)
+    streaminfo += ((44100 << 44) | (1 << 41) | (15 << 36) | (size // 4)).to_bytes(8, 'big') + bytes(16)
+    vendor = b'reference libFLAC 1.4.3 20230623'
+    comment = len(vendor).to_bytes(4, 'little') + vendor + bytes(4)
+    header = b'fLaC' + bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+    header += bytes([4]) + len(comment).to_bytes(3, 'big') + comment
+    header += bytes([0x80 | 1]) + (8192).to_bytes(3, 'big') + bytes(8192)
+    return header + random.Random(seed).randbytes(size)
+
+
+def make_cover(resolution, seed=1):
+    # A photo-like cover: smooth gradients plus grain, so the JPEG is about as large as a real one
+    y, x = np.mgrid[0:resolution, 0:resolution] / resolution
+    rgb = np.stack([np.sin(6 * x + 3 * y), np.cos(5 * y - 2 * x), np.sin(4 * (x + y))], axis=-1) * 100 + 128
+    rgb += np.random.default_rng(seed).normal(0, 12, rgb.shape)
+    out = io.BytesIO()
+    Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).save(out, 'JPEG', quality=90)
+    return out.getvalue()
+
+
+class FakeService:
+    def __init__(self, config=None, host='127.0.0.1', port=0):
+        self.config = config or ServiceConfig()
+        self.stats = ServiceStats()
+        self.flac = make_flac(self.config.track_bytes, self.config.seed)
+        self.cover = make_cover(self.config.cover_resolution)
+        self._lock = threading.Lock()
+        self._random = random.Random(self.config.seed)
+        self._server = ThreadingHTTPServer((host, port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name='fake-service', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def count(self, kind):
+        with self._lock:
+            self.stats.requests[kind] = self.stats.requests.get(kind, 0) + 1
+            if self.config.throttle and self._random.random() < self.config.throttle:
+                self.stats.throttled += 1
+                return True
+        return False
+
+    def sent(self, nbytes, album_id=None):
+        with self._lock:
+            self.stats.bytes_sent += nbytes
+            if album_id is not None and album_id not in self.stats.first_audio_byte:
+                self.stats.first_audio_byte[album_id] = time.time()
+
+    def track_format(self, number):
+        if self.config.format == 'mixed': return 'dash' if number % 2 == 0 else 'flac'
+        return self.config.format
+
+    def segments(self):
+        return max(1, -(-len(self.flac) // self.config.segment_bytes))
+
+    def album(self, album_id):
+        return {'id': album_id, 'title': f'Album {album_id}', 'artist': 'Benchmark Artist', 'year': 2024,
+                'cover_url': f'{self.url}/cover/{album_id}.jpg',
+                'tracks': [f'{album_id}.{n}' for n in range(1, self.config.tracks + 1)]}
+
+    def track(self, track_id):
+        album_id, _, number = track_id.rpartition('.')
+        number = int(number)
+        data = {'id': track_id, 'title': f'Track {number}', 'album': f'Album {album_id}', 'album_id': album_id,
+                'artist': 'Benchmark Artist', 'number': number, 'total': self.config.tracks, 'year': 2024,
+                'duration': len(self.flac) // (44100 * 4), 'cover_url': f'{self.url}/cover/{album_id}.jpg'}
+        if self.track_format(number) == 'dash':
+            data['manifest_url'] = f'{self.url}/dash/{track_id}.mpd'
+        else:
+            data['file_url'] = f'{self.url}/file/{track_id}.flac'
+        return data
+
+    def search(self, query):
+        # Results are made-up releases, one album id per result; track results are their first track
+        kind, limit, offset = query.get('type', ['album'])[0], int(query.get('limit', [10])[0]), int(query.get('offset', [0])[0])
+        term = re.sub(r'\W+', '', query.get('q', [''])[0])[:20] or 'x'
+        items = []
+        for n in range(offset, offset + limit):
+            album_id = f'{term}{n}'
+            items.append({'id': album_id if kind == 'album' else f'{album_id}.1', 'title': f'Result {n} for {term}',
+                          'artist': 'Benchmark Artist', 'year': 2024})
+        return {'items': items}
+
+    def manifest(self, track_id):
+        segments = ''.join(f'<SegmentURL media="{self.url}/dash/{track_id}/{n}.m4s"/>' for n in range(self.segments()))
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static"><Period><AdaptationSet mimeType="audio/mp4">'
+                f'<Representation id="flac" codecs="flac" bandwidth="1411200"><SegmentList>{segments}</SegmentList>'
+                '</Representation></AdaptationSet></Period></MPD>').encode()
+
+
+_ROUTES = [
+    ('search', re.compile(r'^/api/search$')),
+    ('album', re.compile(r'^/api/album/([^/]+)$')),
+    ('track', re.compile(r'^/api/track/([^/]+)$')),
+    ('lyrics', re.compile(r'^/api/track/([^/]+)/lyrics$')),
+    ('credits', re.compile(r'^/api/track/([^/]+)/credits$')),
+    ('file', re.compile(r'^/file/([^/]+)\.flac$')),
+    ('manifest', re.compile(r'^/dash/([^/]+)\.mpd$')),
+    ('segment', re.compile(r'^/dash/([^/]+)/(\d+)\.m4s$')),
+    ('cover', re.compile(r'^/cover/([^/]+)\.jpg$')),
+]
+
+
+def _handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            for kind, pattern in _ROUTES:
+                match = pattern.match(self.path.split('?')[0])
+                if match: break
+            else:
+                return self._reply(404, b'{"error": "not found"}', 'application/json')
+
+            if service.config.latency: time.sleep(service.config.latency)
+            if service.count(kind):
+                retry_after = f'{service.config.retry_after:g}'
+                return self._reply(429, b'{"error": "too many requests"}', 'application/json', {'Retry-After': retry_after})
+
+            if kind == 'search':
+                return self._json(service.search(parse_qs(urlsplit(self.path).query)))
+            item = match.group(1)
+            if kind == 'album':
+                return self._json(service.album(item))
+            if kind == 'track':
+                return self._json(service.track(item))
+            if kind == 'lyrics':
+                lines = [f'[{n // 60:02}:{n % 60:02}.00]Line {n} of the lyrics' for n in range(0, 180, 3)]
+                return self._json({'embedded': '\n'.join(l[10:] for l in lines), 'synced': '\n'.join(lines)})
+            if kind == 'credits':
+                return self._json({'Composer': ['Someone'], 'Producer': ['Someone Else']})
+            if kind == 'manifest':
+                return self._reply(200, service.manifest(item), 'application/dash+xml')
+            if kind == 'cover':
+                return self._reply(200, service.cover, 'image/jpeg', throttled=True)
+            album_id = item.rpartition('.')[0]
+            if kind == 'file':
+                return self._reply(200, service.flac, 'audio/flac', throttled=True, album_id=album_id)
+            index, size = int(match.group(2)), service.config.segment_bytes
+            if index >= service.segments():
+                return self._reply(404, b'{"error": "no such segment"}', 'application/json')
+            segment = memoryview(service.flac)[index * size:(index + 1) * size]
+            return self._reply(200, segment, 'video/mp4', throttled=True, album_id=album_id)
+
+        def _json(self, data):
+            self._reply(200, json.dumps(data).encode(), 'application/json')
+
+        def _reply(self, status, body, content_type, headers=None, throttled=False, album_id=None):
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            bandwidth = service.config.bandwidth if throttled else 0
+            started, sent = time.monotonic(), 0
+            try:
+                for start in range(0, len(body), CHUNK):
+                    piece = body[start:start + CHUNK]
+                    self.wfile.write(piece)
+                    sent += len(piece)
+                    service.sent(len(piece), album_id)
+                    if bandwidth:
+                        ahead = sent / bandwidth - (time.monotonic() - started)
+                        if ahead > 0: time.sleep(ahead)
+            except ConnectionError:
+                # The client went away, e.g. a cancelled download
+                self.close_connection = True
+
+    return Handler
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Run the fake streaming service on its own.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.02, help='Seconds before every response (default 0.02)')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='MiB/s per connection, 0: unlimited (default)')
+    parser.add_argument('--throttle', type=float, default=0, help='Share of requests answered 429 (default 0)')
+    parser.add_argument('--tracks', type=int, default=8, help='Tracks per album (default 8)')
+    parser.add_argument('--track-mb', type=float, default=30, help='Size of every track in MiB (default 30)')
+    parser.add_argument('--format', choices=('flac', 'dash', 'mixed'), default='flac')
+    args = parser.parse_args()
+    config = ServiceConfig(latency=args.latency, bandwidth=args.bandwidth_mb * 1024 * 1024, throttle=args.throttle,
+                           tracks=args.tracks, track_bytes=int(args.track_mb * 1024 * 1024), format=args.format)
+    service = FakeService(config, port=args.port).start()
+    print(f'Fake service on {service.url}, Ctrl-C to stop')
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt:
+        service.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Wiring shared by the benchmark drivers (run.py, web_load.py) and the processes they start (workers.py, wsgi.py):
+import paths, the environment the app reads its configuration from, registration of the fakestream module with the
+app's Orpheus session, and measurements of process trees. The repository root goes first on sys.path, so modules of
+this directory cannot be imported by a name the root also has (run, worker).
+"""
+import copy
+import importlib
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(os.path.dirname(HERE))
+
+for path in (os.path.join(ROOT, 'vendor'), ROOT):
+    if path not in sys.path: sys.path.insert(0, path)
+
+SERVICE = 'fakestream'
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def environment(workdir, redis_url, service_url, worker_processes):
+    # Everything the app writes goes below workdir; the database is SQLite like in docker-compose
+    return {
+        'REDIS_URL': redis_url,
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'flaccy.db')}",
+        'ARTIFACTS_DIR': os.path.join(workdir, 'artifacts'),
+        'ARTWORK_CACHE_DIR': os.path.join(workdir, 'artwork_cache'),
+        'USE_X_ACCEL_REDIRECT': 'false',
+        'SECRET_KEY': 'benchmark',
+        'WORKER_PROCESSES': str(worker_processes),
+        'FAKESTREAM_URL': service_url,
+    }
+
+
+def install_module(service_url):
+    """
+    Make the fakestream module loadable as OrpheusDL.modules.fakestream and load it as the only service. OrpheusDL
+    runs with its default settings, so a local settings.json neither logs in to real services nor changes results.
+    """
+    from OrpheusDL import modules
+    if HERE not in modules.__path__: modules.__path__.append(HERE)
+    from app.orpheus_handler import orpheus_session, loaded_modules
+
+    interface = importlib.import_module(f'OrpheusDL.modules.{SERVICE}.interface')
+    orpheus_session.module_list.add(SERVICE)
+    orpheus_session.module_settings[SERVICE] = interface.module_information
+    orpheus_session.settings['global'] = copy.deepcopy(orpheus_session.default_global_settings)
+    orpheus_session.settings['modules'] = {SERVICE: {'base_url': service_url}}
+    loaded_modules.clear()
+    loaded_modules[SERVICE] = orpheus_session.load_module(SERVICE)
+
+
+def percentiles(values):
+    if not values: return {}
+    ordered = sorted(values)
+    pick = lambda fraction: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99), 'max': ordered[-1]}
+
+
+def process_tree(root_pid):
+    # root_pid and all its descendants, from /proc (Linux); empty elsewhere
+    parents = {}
+    if not os.path.isdir('/proc'): return set()
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit(): continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # the command name may contain spaces, the fields after it do not
+                parents[int(entry)] = int(f.read().rpartition(')')[2].split()[1])
+        except (OSError, IndexError, ValueError):
+            pass
+    tree, added = {root_pid}, True
+    while added:
+        children = {pid for pid, ppid in parents.items() if ppid in tree} - tree
+        tree |= children
+        added = bool(children)
+    return tree
+
+
+def tree_rss(root_pid):
+    # Resident bytes of the process tree
+    total = 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
+
+
+def tree_cpu_seconds(root_pid):
+    # User plus system CPU time of the processes of the tree that are running now
+    ticks = os.sysconf('SC_CLK_TCK')
+    total = 0.0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rpartition(')')[2].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError, ValueError):
+            pass
+    return total
@@ -0,0 +1,465 @@
+"""
+Web-tier load benchmark: how many browsers one gunicorn setup carries, for sizing workers and threads.
+
+The app runs under gunicorn with the production config (config/gunicorn.conf.py, gevent), against a local Redis
+and SQLite, with the fakestream module as its service (wsgi.py). The driver simulates browsers the way the UI
+(static/script.js) behaves: each one keeps an EventSource open on /jobs/<id>/events for each of its --streams
+active jobs, polls GET /jobs/<id> for each of them every --poll-interval seconds, searches with POST /api/search
+every --search-interval seconds and fetches a finished result through GET /files/<filename> every
+--download-interval seconds. Jobs are not run: running jobs get an event every --event-interval seconds from a
+producer in this process, which writes to Redis like a worker does, and finished jobs point at --file-mb artifacts.
+
+Browsers are added in steps (--browsers 25,50,100,200); connections of earlier steps stay open. Per step:
+ - idle: only the event streams are open. CPU of the gunicorn process tree per open stream, and its resident
+   memory per stream over the tree's memory before the first browser connected;
+ - active: the full browser behaviour plus events. Event delivery latency (from add_event until the browser read
+   the event), request latency per endpoint, errors and file throughput.
+A step is healthy when every stream connected, under 1% of requests failed and the p99 latencies are within
+--max-event-latency and --max-request-latency; the capacity is the largest healthy step. Job streams look for new
+events every 15 seconds, so event latency is up to 15 seconds by design and the default limit allows for that.
+
+The client is a single asyncio process with plain sockets and HTTP/1.0 (responses are closed, not chunked); at the
+largest steps check that its own CPU is not the limit (it is reported as client_cpu).
+
+Needs a Redis server. A separate database is used (default redis://localhost:6379/15); it must be empty, or be
+emptied with --flush. --json writes the results.
+
+    python benchmarks/e2e/web_load.py [--browsers 25,50,100,200] [--streams 3] [--workers 1] [--threads 4]
+                                      [--worker-class gevent] [--idle-seconds 20] [--active-seconds 60]
+"""
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import stack
+from stack import percentiles
+from server import FakeService, ServiceConfig
+
+SEARCH_TERMS = ('miles davis', 'kind of blue', 'radiohead', 'bach cello', 'daft punk', 'nina simone', 'low')
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class Stats:
+    """Samples of the current phase; reset between phases."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = {}  # endpoint -> latencies in seconds
+        self.errors = {}  # endpoint -> count
+        self.event_latency = []
+        self.events = 0
+        self.downloaded = 0
+        self.download_seconds = 0.0
+
+    def ok(self, endpoint, seconds):
+        self.requests.setdefault(endpoint, []).append(seconds)
+
+    def error(self, endpoint):
+        self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def summary(self):
+        total = sum(len(v) for v in self.requests.values())
+        failed = sum(self.errors.values())
+        return {
+            'requests': total,
+            'errors': dict(self.errors),
+            'error_rate': round(failed / (total + failed), 4) if total + failed else 0,
+            'request_latency_s': {name: {k: round(v, 4) for k, v in percentiles(values).items()}
+                                  for name, values in sorted(self.requests.items())},
+            'events': self.events,
+            'event_latency_s': {k: round(v, 3) for k, v in percentiles(self.event_latency).items()},
+            'files_mb_s': round(self.downloaded / self.download_seconds / 1024 / 1024, 1) if self.download_seconds else None,
+        }
+
+
+class Browser:
+    def __init__(self, host, port, jobs, files, args, stats):
+        self.host, self.port = host, port
+        self.jobs = jobs  # ids of the running jobs this browser follows
+        self.files = files  # filenames of finished results
+        self.args = args
+        self.stats = stats
+        self.cookie = None
+        self.connected = 0  # event streams with a response
+        self.stream_tasks = []
+        self.active_tasks = []
+
+    async def _send(self, method, path, body=None, accept='*/*'):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        head = [f'{method} {path} HTTP/1.0', f'Host: {self.host}:{self.port}', f'Accept: {accept}']
+        if self.cookie: head.append(f'Cookie: {self.cookie}')
+        if body is not None:
+            body = json.dumps(body).encode()
+            head += ['Content-Type: application/json', f'Content-Length: {len(body)}']
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + (body or b''))
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''): break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'set-cookie' and value.strip().startswith('session='):
+                self.cookie = value.strip().split(';')[0]
+        return status, reader, writer
+
+    async def request(self, endpoint, method, path, body=None):
+        started = time.monotonic()
+        writer = None
+        try:
+            async with asyncio.timeout(self.args.request_timeout):
+                status, reader, writer = await self._send(method, path, body)
+                size = 0
+                while chunk := await reader.read(256 * 1024):
+                    size += len(chunk)
+        except (OSError, EOFError, ValueError, IndexError, TimeoutError):
+            self.stats.error(endpoint)
+            return None
+        finally:
+            if writer is not None: writer.close()
+        seconds = time.monotonic() - started
+        if status >= 400:
+            self.stats.error(endpoint)
+            return None
+        self.stats.ok(endpoint, seconds)
+        return size, seconds
+
+    async def start(self):
+        # The page load sets the session cookie, like in a browser, before anything else
+        await self.request('search', 'POST', '/api/search', self._search_body())
+        self.stream_tasks = [asyncio.create_task(self._events(job_id)) for job_id in self.jobs]
+
+    async def _events(self, job_id):
+        while True:
+            writer = None
+            try:
+                status, reader, writer = await self._send('GET', f'/jobs/{job_id}/events', accept='text/event-stream')
+                if status != 200: raise ValueError(status)
+                self.connected += 1
+                try:
+                    while line := await reader.readline():
+                        if not line.startswith(b'data: '): continue
+                        event = json.loads(line[6:])
+                        if event.get('type') == 'bench':
+                            self.stats.events += 1
+                            self.stats.event_latency.append(time.time() - event['timestamp'])
+                finally:
+                    self.connected -= 1
+            except (OSError, EOFError, ValueError, IndexError):
+                self.stats.error('events')
+            finally:
+                if writer is not None: writer.close()
+            # Like EventSource: reconnect after a moment
+            await asyncio.sleep(3)
+
+    def _search_body(self):
+        return {'service': stack.SERVICE, 'type': 'album', 'query': random.choice(SEARCH_TERMS), 'limit': 10}
+
+    async def _every(self, interval, action):
+        # The first call at a random point of the interval, so browsers do not act in lockstep
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            started = time.monotonic()
+            await action()
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - started)))
+
+    async def _poll(self):
+        await asyncio.gather(*(self.request('job', 'GET', f'/jobs/{job_id}') for job_id in self.jobs))
+
+    async def _search(self):
+        await self.request('search', 'POST', '/api/search', self._search_body())
+
+    async def _download(self):
+        result = await self.request('file', 'GET', f'/files/{random.choice(self.files)}')
+        if result:
+            self.stats.downloaded += result[0]
+            self.stats.download_seconds += result[1]
+
+    def activate(self):
+        a = self.args
+        self.active_tasks = [asyncio.create_task(self._every(a.poll_interval, self._poll)),
+                             asyncio.create_task(self._every(a.search_interval, self._search))]
+        if self.files and a.download_interval:
+            self.active_tasks.append(asyncio.create_task(self._every(a.download_interval, self._download)))
+
+    async def deactivate(self):
+        for task in self.active_tasks: task.cancel()
+        await asyncio.gather(*self.active_tasks, return_exceptions=True)
+        self.active_tasks = []
+
+    async def close(self):
+        await self.deactivate()
+        for task in self.stream_tasks: task.cancel()
+        await asyncio.gather(*self.stream_tasks, return_exceptions=True)
+
+
+class EventProducer:
+    """Adds an event to each followed job every `interval` seconds, spread over the interval, as workers would."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.jobs = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, jobs):
+        from app import events
+        self.jobs = list(jobs)
+        self._stop.clear()
+
+        def run():
+            n = 0
+            while not self._stop.is_set():
+                for job_id in self.jobs:
+                    if self._stop.wait(self.interval / len(self.jobs)): return
+                    events.add_event(job_id, 'bench', n=n)
+                n += 1
+
+        self._thread = threading.Thread(target=run, name='events', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread: self._thread.join()
+
+
+def _make_jobs(app, running, finished, file_bytes, artifacts_dir):
+    from app import db
+    from app.models import Job, JobStatus
+    running_ids = [str(uuid.uuid4()) for _ in range(running)]
+    filenames = []
+    os.makedirs(artifacts_dir, exist_ok=True)
+    payload = random.Random(0).randbytes(file_bytes)
+    with app.app_context():
+        source = {'service': stack.SERVICE, 'type': 'album', 'id': 'load0'}
+        for job_id in running_ids:
+            db.session.add(Job(id=job_id, status=JobStatus.RUNNING, progress=40, step='downloading',
+                               input={'source': source, 'options': {}, 'queued_at': time.time()}))
+        for n in range(finished):
+            job_id = str(uuid.uuid4())
+            filename = f'{job_id}_{uuid.uuid4().hex}.flac'
+            with open(os.path.join(artifacts_dir, filename), 'wb') as f:
+                f.write(payload)
+            filenames.append(filename)
+            db.session.add(Job(id=job_id, status=JobStatus.SUCCEEDED, progress=100, step='done',
+                               input={'source': source, 'options': {}},
+                               result={'files': [{'name': f'Track {n}.flac', 'filename': filename}]}))
+        db.session.commit()
+    return running_ids, filenames
+
+
+def _healthy(step, args):
+    active = step['active']
+    event_p99 = active['event_latency_s'].get('p99')
+    request_p99 = max((v['p99'] for v in active['request_latency_s'].values()), default=None)
+    problems = []
+    if step['streams_connected'] < step['streams']: problems.append('streams did not all connect')
+    if active['error_rate'] > 0.01: problems.append(f"error rate {active['error_rate']:.1%}")
+    if event_p99 is None: problems.append('no events delivered')
+    elif event_p99 > args.max_event_latency: problems.append(f'event p99 {event_p99:.1f}s')
+    if request_p99 is None: problems.append('no requests answered')
+    elif request_p99 > args.max_request_latency: problems.append(f'request p99 {request_p99:.2f}s')
+    return problems
+
+
+async def _drive(args, host, port, running_ids, filenames, server_pid, stats, producer):
+    steps, browsers = [], []
+    client_cpu = lambda: sum(resource.getrusage(resource.RUSAGE_SELF)[:2])
+    rss_before = stack.tree_rss(server_pid)
+    for target in args.browsers:
+        new = [Browser(host, port, running_ids[i * args.streams:(i + 1) * args.streams], filenames, args, stats)
+               for i in range(len(browsers), target)]
+        await asyncio.gather(*(b.start() for b in new))
+        browsers += new
+        streams = len(browsers) * args.streams
+        deadline = time.monotonic() + args.connect_timeout
+        while sum(b.connected for b in browsers) < streams and time.monotonic() < deadline:
+            await asyncio.sleep(0.2)
+        connected = sum(b.connected for b in browsers)
+        print(f'{len(browsers)} browsers: {connected}/{streams} event streams open')
+
+        # Idle: streams only, nothing happening
+        await asyncio.sleep(2)
+        stats.reset()
+        cpu_started, client_started, started = stack.tree_cpu_seconds(server_pid), client_cpu(), time.monotonic()
+        await asyncio.sleep(args.idle_seconds)
+        idle_seconds = time.monotonic() - started
+        idle_cpu = (stack.tree_cpu_seconds(server_pid) - cpu_started) / idle_seconds
+        rss = stack.tree_rss(server_pid)
+        idle = {
+            'server_cpu': round(idle_cpu, 4),
+            'cpu_ms_per_s_per_stream': round(idle_cpu * 1000 / connected, 4) if connected else None,
+            'server_rss_mb': round(rss / 1024 / 1024, 1),
+            'rss_kb_per_stream': round((rss - rss_before) / 1024 / connected, 1) if connected else None,
+            'client_cpu': round((client_cpu() - client_started) / idle_seconds, 3),
+            'errors': dict(stats.errors),
+        }
+
+        # Active: the full browser behaviour and job events
+        stats.reset()
+        producer.start(running_ids[:streams])
+        for b in browsers: b.activate()
+        cpu_started, client_started, started = stack.tree_cpu_seconds(server_pid), client_cpu(), time.monotonic()
+        await asyncio.sleep(args.active_seconds)
+        active_seconds = time.monotonic() - started
+        active_cpu = stack.tree_cpu_seconds(server_pid) - cpu_started
+        await asyncio.gather(*(b.deactivate() for b in browsers))
+        producer.stop()
+        active = {**stats.summary(), 'server_cpu': round(active_cpu / active_seconds, 3),
+                  'client_cpu': round((client_cpu() - client_started) / active_seconds, 3),
+                  'requests_per_s': round(sum(len(v) for v in stats.requests.values()) / active_seconds, 1),
+                  'server_rss_mb': round(stack.tree_rss(server_pid) / 1024 / 1024, 1)}
+
+        step = {'browsers': len(browsers), 'streams': streams, 'streams_connected': connected, 'idle': idle,
+                'active': active}
+        step['problems'] = _healthy(step, args)
+        step['healthy'] = not step['problems']
+        steps.append(step)
+        _report_step(step)
+        if not step['healthy'] and not args.keep_going: break
+
+    await asyncio.gather(*(b.close() for b in browsers))
+    return steps
+
+
+def _report_step(step):
+    idle, active = step['idle'], step['active']
+    print(f"  idle:   server CPU {idle['server_cpu']:.1%}, {idle['cpu_ms_per_s_per_stream']} ms/s and "
+          f"{idle['rss_kb_per_stream']} KiB per stream, RSS {idle['server_rss_mb']} MiB")
+    print(f"  active: {active['requests_per_s']} req/s, server CPU {active['server_cpu']:.0%}, "
+          f"client CPU {active['client_cpu']:.0%}, errors {active['errors'] or 0}")
+    print(f"          event latency {active['event_latency_s']} over {active['events']} events")
+    for name, latency in active['request_latency_s'].items():
+        print(f'          {name:<7} {latency}')
+    if active['files_mb_s']: print(f"          files {active['files_mb_s']} MiB/s per download")
+    print(f"  {'healthy' if step['healthy'] else 'unhealthy: ' + ', '.join(step['problems'])}")
+
+
+def run(args):
+    import redis
+    conn = redis.from_url(args.redis_url)
+    if conn.dbsize():
+        if not args.flush:
+            sys.exit(f'{args.redis_url} is not empty; use another database or pass --flush to empty it')
+        conn.flushdb()
+
+    # Every open stream is a socket on both ends
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard: resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    service = FakeService(ServiceConfig(latency=args.latency, track_bytes=1024 * 1024, cover_resolution=600)).start()
+    workdir = tempfile.mkdtemp(prefix='flaccy_web_')
+    env = stack.environment(workdir, args.redis_url, service.url, 1)
+    os.environ.update(env)
+
+    from app import create_app
+    app = create_app()
+    running_ids, filenames = _make_jobs(app, max(args.browsers) * args.streams, args.files,
+                                        int(args.file_mb * 1024 * 1024), env['ARTIFACTS_DIR'])
+
+    port = _free_port()
+    command = [sys.executable, '-m', 'gunicorn', '--config', os.path.join(stack.ROOT, 'config', 'gunicorn.conf.py'),
+               '--bind', f'127.0.0.1:{port}', '--pythonpath', stack.HERE]
+    for option in ('workers', 'threads', 'worker_class', 'worker_connections'):
+        value = getattr(args, option)
+        if value is not None: command += [f"--{option.replace('_', '-')}", str(value)]
+    log_path = os.path.join(workdir, 'gunicorn.log')
+    with open(log_path, 'wb') as log:
+        server = subprocess.Popen(command + ['wsgi:app'], cwd=stack.ROOT, env={**os.environ, **env},
+                                  stdout=log, stderr=subprocess.STDOUT)
+    print(f"gunicorn {' '.join(command[3:])}; logs in {log_path}")
+
+    stats, producer = Stats(), EventProducer(args.event_interval)
+    try:
+        deadline = time.monotonic() + 60
+        while True:
+            if server.poll() is not None or time.monotonic() > deadline:
+                sys.exit(f'gunicorn did not start, see {log_path}')
+            try:
+                with socket.create_connection(('127.0.0.1', port), timeout=1) as s:
+                    s.sendall(b'GET /api/health HTTP/1.0\r\n\r\n')
+                    if b' 200 ' in s.recv(64): break
+            except OSError:
+                pass
+            time.sleep(0.5)
+        steps = asyncio.run(_drive(args, '127.0.0.1', port, running_ids, filenames, server.pid, stats, producer))
+    finally:
+        producer.stop()
+        server.send_signal(signal.SIGTERM)
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+            server.wait()
+        service.stop()
+
+    healthy = [s['browsers'] for s in steps if s['healthy']]
+    results = {
+        'config': {k: v for k, v in vars(args).items() if k not in ('json', 'flush', 'keep', 'redis_url')},
+        'steps': steps,
+        'capacity_browsers': max(healthy) if healthy else 0,
+    }
+    print(f"Capacity: {results['capacity_browsers']} browsers ({results['capacity_browsers'] * args.streams} event "
+          f"streams) within the limits")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.keep:
+        print(f'Kept {workdir}')
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    conn.flushdb()
+    return results
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Load benchmark of the web tier: event streams, polling, search, files.')
+    parser.add_argument('--browsers', type=lambda s: sorted(int(n) for n in s.split(',')), default=[25, 50, 100, 200],
+                        help='Comma-separated browser counts to step through (default 25,50,100,200)')
+    parser.add_argument('--streams', type=int, default=3, help='Active jobs, so event streams, per browser (default 3)')
+    parser.add_argument('--poll-interval', type=float, default=2, help='Seconds between job polls, as in the UI')
+    parser.add_argument('--search-interval', type=float, default=30, help='Seconds between searches per browser')
+    parser.add_argument('--download-interval', type=float, default=60,
+                        help='Seconds between file downloads per browser, 0: none (default 60)')
+    parser.add_argument('--event-interval', type=float, default=5, help='Seconds between events per job (default 5)')
+    parser.add_argument('--files', type=int, default=10, help='Finished results to download from (default 10)')
+    parser.add_argument('--file-mb', type=float, default=30, help='Size of each result file in MiB (default 30)')
+    parser.add_argument('--latency', type=float, default=0.05, help="Fake service's latency for search (default 0.05)")
+    parser.add_argument('--idle-seconds', type=float, default=20)
+    parser.add_argument('--active-seconds', type=float, default=60)
+    parser.add_argument('--connect-timeout', type=float, default=30)
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--max-event-latency', type=float, default=20, help='Healthy p99 event latency (default 20s)')
+    parser.add_argument('--max-request-latency', type=float, default=2, help='Healthy p99 request latency (default 2s)')
+    parser.add_argument('--keep-going', action='store_true', help='Continue with the next step after an unhealthy one')
+    parser.add_argument('--workers', type=int, help='Override the gunicorn config')
+    parser.add_argument('--threads', type=int, help='Override the gunicorn config')
+    parser.add_argument('--worker-class', help='Override the gunicorn config')
+    parser.add_argument('--worker-connections', type=int, help='Override the gunicorn config')
+    parser.add_argument('--redis-url', default=os.environ.get('BENCH_REDIS_URL', 'redis://localhost:6379/15'))
+    parser.add_argument('--flush', action='store_true', help='Empty the Redis database first if it is not empty')
+    parser.add_argument('--keep', action='store_true', help='Keep the working directory (database, logs)')
+    parser.add_argument('--json', help='Write the results to this file')
+    run(parser.parse_args())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""
+Worker launcher for the end-to-end benchmark: registers the fakestream module, then runs the regular worker
+supervisor (worker.py), whose processes inherit the registration. Started by run.py with the environment from
+stack.environment().
+
+    python benchmarks/e2e/workers.py
+"""
+import logging
+import os
+
+import stack
+
+stack.install_module(os.environ['FAKESTREAM_URL'])
+
+import worker  # noqa: E402  (after the module registration, so forked workers have it)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s supervisor: %(message)s')
+    worker.Supervisor(worker.WORKER_PROCESSES).run()
@@ -0,0 +1,16 @@
+"""
+WSGI entry point for the web-tier load benchmark (web_load.py): the regular app with the fakestream module
+registered as its only service, so /api/search goes to the fake service. Served by gunicorn with the production
+config (config/gunicorn.conf.py) and the environment from stack.environment().
+
+    gunicorn --config config/gunicorn.conf.py --pythonpath benchmarks/e2e wsgi:app
+"""
+import os
+
+import stack
+
+stack.install_module(os.environ['FAKESTREAM_URL'])
+
+from app import create_app  # noqa: E402
+
+app = create_app()
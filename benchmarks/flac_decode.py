@@ -0,0 +1,275 @@
+"""
+Bundled FLAC decoder: sample-exact validation and benchmark of the buffered decoder (flac_fast) against the
+original bit-at-a-time decoder (flac).
+
+Fixtures are produced by a small FLAC encoder below, so no external tools are needed. It covers 16 and 24 bit
+stereo, independent / left-side / side-right / mid-side channel assignments, constant, verbatim, fixed (orders 0-4)
+and LPC subframes, wasted bits, both Rice parameter widths, escaped partitions and odd final block sizes. FLAC files
+encoded by other tools can be passed on the command line as additional fixtures.
+
+    python benchmarks/flac_decode.py [--seconds 1] [--repeat 1] [files...]
+"""
+import io
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vendor'))
+
+from OrpheusDL.modules.tidal.mqa_identifier_python.mqa_identifier_python import mqa_identifier  # noqa: E402,F401
+import flac  # noqa: E402  (made importable by mqa_identifier)
+import flac_fast  # noqa: E402
+
+
+class BitWriter:
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.nbits = 0
+
+    def write(self, value, n):
+        if n == 0:
+            return
+        self.acc = (self.acc << n) | (value & ((1 << n) - 1))
+        self.nbits += n
+        while self.nbits >= 8:
+            self.nbits -= 8
+            self.out.append((self.acc >> self.nbits) & 0xFF)
+        self.acc &= (1 << self.nbits) - 1
+
+    def write_signed(self, value, n):
+        self.write(value & ((1 << n) - 1), n)
+
+    def write_rice(self, values, param):
+        for v in values.tolist():
+            u = (v << 1) ^ (v >> 63)
+            q = u >> param
+            self.write(0, q)
+            self.write(1, 1)
+            self.write(u, param)
+
+    def align(self):
+        if self.nbits:
+            self.write(0, 8 - self.nbits)
+
+
+def _crc(data, width, poly):
+    crc = 0
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    for byte in data:
+        crc ^= byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & mask if crc & top else (crc << 1) & mask
+    return crc
+
+
+def _write_residuals(w, residuals, blocksize, warmup, variant):
+    # 5 bit Rice parameters on every other subframe, and whenever 4 bit ones cannot fit the residuals
+    method = 1 if variant % 2 or np.abs(residuals).max(initial=0) >= 1 << 15 else 0
+    w.write(method, 2)
+    order = 2 if blocksize % 4 == 0 else 0
+    w.write(order, 4)
+    parambits, escape = (4, 0xF) if method == 0 else (5, 0x1F)
+    count = blocksize >> order
+    offset = 0
+    for i in range(1 << order):
+        part = residuals[offset:offset + count - (warmup if i == 0 else 0)]
+        offset += len(part)
+        if variant % 7 == 3 and i == 1:  # escaped partition
+            numbits = max(int(np.abs(part).max()).bit_length() + 1, 1) if len(part) else 1
+            w.write(escape, parambits)
+            w.write(numbits, 5)
+            for v in part.tolist():
+                w.write_signed(v, numbits)
+            continue
+        mean = float(np.abs(part).mean()) if len(part) else 0.0
+        param = min(escape - 1, max(0, int(np.log2(mean + 1))))
+        w.write(param, parambits)
+        w.write_rice(part, param)
+
+
+def _encode_subframe(w, x, depth, variant):
+    wasted = 0
+    if variant % 5 == 4 and x.any():
+        # shift out common zero low bits (only present when the signal was built that way)
+        while not (x & ((1 << (wasted + 1)) - 1)).any():
+            wasted += 1
+    if wasted:
+        x = x >> wasted
+        depth -= wasted
+
+    kind = variant % 4
+    if not x.any() or (x == x[0]).all():
+        w.write(0, 1); w.write(0, 6); w.write(1 if wasted else 0, 1)
+        if wasted: w.write(1, wasted)
+        w.write_signed(int(x[0]), depth)
+        return
+    w.write(0, 1)
+    if kind == 0 and variant % 3 == 0:  # verbatim
+        w.write(1, 6); w.write(1 if wasted else 0, 1)
+        if wasted: w.write(1, wasted)
+        for v in x.tolist():
+            w.write_signed(v, depth)
+    elif kind in (0, 1):  # fixed
+        order = variant % 5
+        w.write(8 + order, 6); w.write(1 if wasted else 0, 1)
+        if wasted: w.write(1, wasted)
+        for v in x[:order].tolist():
+            w.write_signed(v, depth)
+        _write_residuals(w, np.diff(x, n=order), len(x), order, variant)
+    else:  # LPC with least squares coefficients, quantized
+        order = (8, 12, 3, 32)[variant % 4]
+        precision, shift = 13, 10
+        rows = np.stack([x[order - 1 - j:len(x) - 1 - j] for j in range(order)], axis=1).astype(np.float64)
+        coefs = np.linalg.lstsq(rows, x[order:].astype(np.float64), rcond=None)[0]
+        limit = (1 << (precision - 1)) - 1
+        q = np.clip(np.round(coefs * (1 << shift)), -limit, limit).astype(np.int64)
+        prediction = sum(q[j] * x[order - 1 - j:len(x) - 1 - j] for j in range(order))
+        residuals = x[order:] - (prediction >> shift)
+        w.write(32 + order - 1, 6); w.write(1 if wasted else 0, 1)
+        if wasted: w.write(1, wasted)
+        for v in x[:order].tolist():
+            w.write_signed(v, depth)
+        w.write(precision - 1, 4)
+        w.write_signed(shift, 5)
+        for c in q.tolist():
+            w.write_signed(c, precision)
+        _write_residuals(w, residuals, len(x), order, variant)
+
+
+def encode_flac(samples, samplerate, depth, blocksize=4096):
+    """Encode an int array of shape (n, 2) to FLAC bytes."""
+    out = bytearray(b'fLaC')
+    info = BitWriter()
+    info.write(blocksize, 16); info.write(blocksize, 16); info.write(0, 24); info.write(0, 24)
+    info.write(samplerate, 20); info.write(samples.shape[1] - 1, 3); info.write(depth - 1, 5)
+    info.write(len(samples), 36); info.write(0, 128)
+    out += bytes([0]) + (34).to_bytes(3, 'big') + info.out
+    out += bytes([0x80 | 1]) + (1000).to_bytes(3, 'big') + bytes(1000)  # padding block, last
+
+    for number, first in enumerate(range(0, len(samples), blocksize)):
+        block = samples[first:first + blocksize].astype(np.int64)
+        size = len(block)
+        left, right = block[:, 0], block[:, 1]
+        assignment = (1, 8, 9, 10)[number % 4]
+        if assignment == 1:
+            channels = [(left, depth), (right, depth)]
+        elif assignment == 8:
+            channels = [(left, depth), (left - right, depth + 1)]
+        elif assignment == 9:
+            channels = [(left - right, depth + 1), (right, depth)]
+        else:
+            channels = [((left + right) >> 1, depth), (left - right, depth + 1)]
+
+        w = BitWriter()
+        w.write(0x3FFE, 14); w.write(0, 2)
+        w.write(12 if size == 4096 else 7, 4)
+        w.write(0, 4); w.write(assignment, 4); w.write(0, 3); w.write(0, 1)
+        for byte in chr(number).encode('utf-8'):
+            w.write(byte, 8)
+        if size != 4096:
+            w.write(size - 1, 16)
+        w.write(_crc(bytes(w.out), 8, 0x07), 8)
+        for index, (x, channel_depth) in enumerate(channels):
+            _encode_subframe(w, x, channel_depth, number * 2 + index)
+        w.align()
+        w.write(_crc(bytes(w.out), 16, 0x8005), 16)
+        out += w.out
+    return bytes(out)
+
+
+def make_fixture(seed, depth, samplerate, seconds):
+    rng = np.random.default_rng(seed)
+    n = int(samplerate * seconds)
+    t = np.arange(n) / samplerate
+    peak = (1 << (depth - 1)) - 1
+    base = 0.4 * np.sin(2 * np.pi * 440 * t) + 0.2 * np.sin(2 * np.pi * 1234.5 * t + 1)
+    left = base + 0.05 * rng.standard_normal(n)
+    right = 0.9 * base + 0.05 * rng.standard_normal(n)
+    samples = np.clip(np.stack([left, right], axis=1) * peak, -peak, peak).astype(np.int64)
+    # a silent stretch (constant subframes) and a stretch with wasted low bits
+    samples[4096:8192] = 0
+    samples[8192:12288] &= ~0xFF
+    return samples
+
+
+def reference_decode(data, seconds):
+    # The original decoder, exactly as MqaIdentifier used it: decode to WAV, ignore truncation
+    out = io.BytesIO()
+    with flac.BitInputStream(io.BytesIO(data)) as bf:
+        try:
+            flac.decode_file(bf, out, seconds=seconds)
+        except EOFError:
+            pass
+    raw = out.getvalue()
+    channels, depth = int.from_bytes(raw[22:24], 'little'), int.from_bytes(raw[34:36], 'little')
+    pcm = np.frombuffer(raw[44:], dtype=np.uint8)
+    width = depth // 8
+    pcm = pcm[:len(pcm) - len(pcm) % (width * channels)].reshape(-1, width).astype(np.int64)
+    values = sum(pcm[:, b] << (8 * b) for b in range(width))
+    values -= (values >> (depth - 1)) << depth
+    return values.reshape(-1, channels)
+
+
+def _best(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Validate and time the buffered FLAC decoder.')
+    parser.add_argument('--seconds', type=int, default=1, help='Audio to decode per file, like MQA detection (default 1)')
+    parser.add_argument('--repeat', type=int, default=1, help='Timing repetitions, best is reported (default 1)')
+    parser.add_argument('files', nargs='*', help='Extra FLAC files to include')
+    args = parser.parse_args()
+
+    fixtures = []
+    for seed, (depth, rate) in enumerate([(16, 44100), (24, 48000), (24, 96000), (16, 48000)]):
+        samples = make_fixture(seed, depth, rate, args.seconds + 0.3)
+        data = encode_flac(samples, rate, depth)
+        fixtures.append((f'synthetic {depth}/{rate}', data, samples))
+        # Truncated copy, like the header chunk Tidal's MQA check downloads
+        fixtures.append((f'synthetic {depth}/{rate} truncated', data[:len(data) * 2 // 5], None))
+    for path in args.files:
+        with open(path, 'rb') as f:
+            fixtures.append((os.path.basename(path), f.read(), None))
+
+    reference_total = fast_total = 0.0
+    for name, data, source in fixtures:
+        reference_time, expected = _best(lambda: reference_decode(data, args.seconds), args.repeat)
+        fast_time, (decoded, _, _) = _best(lambda: flac_fast.decode_samples(data, seconds=args.seconds), args.repeat)
+        if decoded.shape != expected.shape or not np.array_equal(decoded, expected):
+            print(f'MISMATCH {name}: fast {decoded.shape} vs reference {expected.shape}')
+            sys.exit(1)
+        if source is not None and not np.array_equal(decoded, source[:len(decoded)]):
+            print(f'MISMATCH {name}: decoded samples differ from the encoded source')
+            sys.exit(1)
+
+        # Through a file as well, the way MqaIdentifier reads it
+        with tempfile.NamedTemporaryFile(suffix='.flac') as f:
+            f.write(data)
+            f.flush()
+            if not np.array_equal(flac_fast.decode_file_samples(f.name, seconds=args.seconds)[0], expected):
+                print(f'MISMATCH {name}: decode_file_samples')
+                sys.exit(1)
+
+        reference_total += reference_time
+        fast_total += fast_time
+        print(f'{name:32} {len(decoded):7} frames  reference {reference_time * 1000:9.1f} ms  fast {fast_time * 1000:7.1f} ms')
+
+    print(f'{len(fixtures)} files, all samples identical')
+    print(f'total: reference {reference_total * 1000:.1f} ms, fast {fast_total * 1000:.1f} ms '
+          f'({reference_total / fast_total:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""
+MQA sync word detection: equivalence check and microbenchmark.
+
+Builds a corpus of synthetic one-second stereo clips (16 and 24 bit, 44.1-192 kHz), some with an MQA sync word,
+originalSampleRate and provenance bits planted at a random position and bit shift, some without. Both detectors
+must agree on every clip (and on any real FLAC/WAV files passed on the command line) before they are timed.
+
+    python benchmarks/mqa_detect.py [--clips 24] [--repeat 3] [files...]
+"""
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+import wave
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vendor'))
+
+from OrpheusDL.modules.tidal.mqa_identifier_python.mqa_identifier_python import mqa_identifier as mqa  # noqa: E402
+
+SAMPLE_RATES = (44100, 48000, 88200, 96000, 176400, 192000)
+
+
+def _plant(left, right, start, shift, bits):
+    # Make bit `shift` of left ^ right equal `bits` from `start` on, by flipping that bit of the right channel
+    for n, b in enumerate(bits):
+        current = ((int(left[start + n]) ^ int(right[start + n])) >> shift) & 1
+        if current != b:
+            right[start + n] ^= 1 << shift
+
+
+def make_clip(rng, sample_width, rate, mqa_position=None, shift=16, org=0, provenance=0):
+    """Return (wav bytes, expected find_sync_word result)."""
+    bits = 8 * sample_width
+    low, high = -(1 << (bits - 1)), (1 << (bits - 1)) - 1
+    left = rng.integers(low, high, rate, dtype=np.int64)
+    right = rng.integers(low, high, rate, dtype=np.int64)
+    expected = None
+    if mqa_position is not None:
+        # Samples are scaled to int32 by the decoder, so bit `shift` of the int32 is bit `shift - (32 - bits)` here
+        local_shift = shift - (32 - bits)
+        sync = [(mqa.MAGIC >> (mqa.MAGIC_BITS - 1 - m)) & 1 for m in range(mqa.MAGIC_BITS)]
+        end = mqa_position + mqa.MAGIC_BITS - 1
+        _plant(left, right, mqa_position, local_shift, sync)
+        _plant(left, right, end + 3, local_shift, [(org >> (3 - n)) & 1 for n in range(4)])
+        _plant(left, right, end + 29, local_shift, [(provenance >> (4 - n)) & 1 for n in range(5)])
+        expected = end
+
+    frames = np.empty(2 * rate, dtype=np.int64)
+    frames[0::2], frames[1::2] = left, right
+    raw = frames.astype('<i4').view(np.uint8).reshape(-1, 4)[:, :sample_width].tobytes()
+
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wf:
+        wf.setnchannels(2)
+        wf.setsampwidth(sample_width)
+        wf.setframerate(rate)
+        wf.writeframes(raw)
+    return buffer.getvalue(), expected
+
+
+def build_corpus(count, seed=1234):
+    rng = np.random.default_rng(seed)
+    r = random.Random(seed)
+    corpus = []
+    for n in range(count):
+        sample_width = (2, 3)[n % 2]
+        rate = SAMPLE_RATES[n % len(SAMPLE_RATES)]
+        if n % 3 == 2:
+            corpus.append(make_clip(rng, sample_width, rate))
+        else:
+            corpus.append(make_clip(rng, sample_width, rate, mqa_position=r.randrange(0, rate - 200),
+                                    shift=r.choice(mqa.SHIFTS), org=r.randrange(16), provenance=r.randrange(32)))
+    return corpus
+
+
+def _samples(path):
+    identifier = mqa.MqaIdentifier.__new__(mqa.MqaIdentifier)
+    identifier.bit_depth = 16
+    samples = identifier._decode_flac_samples(path)
+    return np.asarray(samples, dtype=np.int32)
+
+
+def _time(fn, arg, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(arg)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Compare and time the MQA sync word detectors.')
+    parser.add_argument('--clips', type=int, default=24, help='Synthetic clips to generate (default 24)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repetitions, best is reported (default 3)')
+    parser.add_argument('files', nargs='*', help='Extra FLAC/WAV files to include')
+    args = parser.parse_args()
+
+    inputs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        for n, (data, expected) in enumerate(build_corpus(args.clips)):
+            path = os.path.join(tmp, f'clip{n}.wav')
+            with open(path, 'wb') as f:
+                f.write(data)
+            inputs.append((path, expected))
+        inputs += [(path, 'unknown') for path in args.files]
+
+        python_total = numpy_total = 0.0
+        for path, expected in inputs:
+            samples = _samples(path)
+            as_list = samples.tolist()
+            python_result = mqa.find_sync_word_python(as_list)
+            numpy_result = mqa.find_sync_word_numpy(samples)
+            if python_result != numpy_result or (expected != 'unknown' and (numpy_result or (None,))[0] != expected):
+                print(f'MISMATCH {os.path.basename(path)}: python={python_result} numpy={numpy_result} expected end={expected}')
+                sys.exit(1)
+
+            # Full detector results (MQA, studio, original sample rate) must match as well
+            detected = mqa.MqaIdentifier(path)
+            saved_np, mqa.np = mqa.np, None
+            try:
+                reference = mqa.MqaIdentifier(path)
+            finally:
+                mqa.np = saved_np
+            fields = ('is_mqa', 'is_mqa_studio', 'original_sample_rate', 'bit_depth')
+            if any(getattr(detected, f) != getattr(reference, f) for f in fields):
+                print(f'MISMATCH {os.path.basename(path)}: ' + ', '.join(
+                    f'{f}={getattr(detected, f)}/{getattr(reference, f)}' for f in fields))
+                sys.exit(1)
+
+            python_total += _time(mqa.find_sync_word_python, as_list, args.repeat)
+            numpy_total += _time(mqa.find_sync_word_numpy, samples, args.repeat)
+
+    print(f'{len(inputs)} inputs, all results identical')
+    print(f'python: {python_total * 1000:9.1f} ms')
+    print(f'numpy:  {numpy_total * 1000:9.1f} ms  ({python_total / numpy_total:.0f}x faster)')
+
+
+if __name__ == '__main__':
+    main()
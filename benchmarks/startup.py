@@ -0,0 +1,98 @@
+"""
+Start-up cost: how long importing the app's entry points takes in a fresh interpreter, and which packages it goes to.
+
+Each target is imported in its own subprocess under `python -X importtime`, --repeat times, and the median import
+time is reported with the packages that took longest (own import time of their modules, summed per top-level
+package). Targets:
+ - OrpheusDL.orpheus.core, which everything below imports;
+ - app.orpheus_handler, which also builds the Orpheus session (module manifest, settings, login storage);
+ - app.routes and app.tasks, what a gunicorn worker and an RQ worker import at boot;
+ - every installed module's interface, measured on top of the core: what a module manifest miss, or the first use
+   of that module, adds.
+
+--cold removes the module manifest (vendor/OrpheusDL/config/module_manifest.bin) before every run, so the session
+reads module information from the interfaces as without the manifest; the last run leaves a fresh manifest behind.
+
+    python benchmarks/startup.py [--repeat 5] [--top 8] [--cold] [--json startup.json]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+VENDOR = os.path.join(ROOT, 'vendor')
+MANIFEST = os.path.join(VENDOR, 'OrpheusDL', 'config', 'module_manifest.bin')
+MARK = '-- start of target --'
+
+# What runs in the subprocess: an optional prelude, whose imports are not counted, then the timed import
+PROGRAM = """
+import sys, time
+{prelude}
+sys.stderr.write({mark!r} + '\\n')
+sys.stderr.flush()
+started = time.perf_counter()
+import {target}
+print(time.perf_counter() - started)
+"""
+
+
+def targets():
+    found = [('OrpheusDL.orpheus.core', ''), ('app.orpheus_handler', ''), ('app.routes', ''), ('app.tasks', '')]
+    modules_dir = os.path.join(VENDOR, 'OrpheusDL', 'modules')
+    for name in sorted(os.listdir(modules_dir)):
+        if os.path.exists(os.path.join(modules_dir, name, 'interface.py')):
+            found.append((f'OrpheusDL.modules.{name}.interface', 'import OrpheusDL.orpheus.core'))
+    return found
+
+
+def measure(target, prelude, cold):
+    if cold and os.path.exists(MANIFEST): os.remove(MANIFEST)
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([ROOT, VENDOR, os.environ.get('PYTHONPATH', '')])}
+    program = PROGRAM.format(prelude=prelude, mark=MARK, target=target)
+    run = subprocess.run([sys.executable, '-X', 'importtime', '-c', program], cwd=ROOT, env=env,
+                         capture_output=True, text=True)
+    if run.returncode != 0:
+        raise RuntimeError(f'import {target} failed:\n{run.stderr[-2000:]}')
+    packages = {}
+    lines = run.stderr.splitlines()
+    for line in lines[lines.index(MARK) + 1:]:
+        # "import time: <self us> | <cumulative us> | <indented module name>"
+        if not line.startswith('import time:') or 'self [us]' in line: continue
+        own, _, name = line[len('import time:'):].split('|')
+        package = name.strip().split('.')[0]
+        packages[package] = packages.get(package, 0) + int(own)
+    return float(run.stdout.split()[-1]), packages
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Import time of the app entry points and of each OrpheusDL module.')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--top', type=int, default=8, help='Packages listed per target (default 8)')
+    parser.add_argument('--cold', action='store_true', help='Remove the module manifest before every run')
+    parser.add_argument('--json', help='Write the results to this file')
+    args = parser.parse_args()
+
+    results = {}
+    print(f"{'target':<42} {'median':>9} {'min':>9}   heaviest packages (ms, last run)")
+    for target, prelude in targets():
+        seconds, packages = [], {}
+        for _ in range(args.repeat):
+            elapsed, packages = measure(target, prelude, args.cold)
+            seconds.append(elapsed)
+        top = sorted(packages.items(), key=lambda item: -item[1])[:args.top]
+        results[target] = {'median_ms': round(statistics.median(seconds) * 1000, 1),
+                           'min_ms': round(min(seconds) * 1000, 1),
+                           'packages_ms': {name: round(us / 1000, 1) for name, us in top}}
+        r = results[target]
+        heaviest = ', '.join(f'{name} {ms:g}' for name, ms in r['packages_ms'].items())
+        print(f"{target:<42} {r['median_ms']:>7.1f}ms {r['min_ms']:>7.1f}ms   {heaviest}")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'cold': args.cold, 'repeat': args.repeat, 'targets': results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+"""
+FLAC tagging: bytes written and time per tagged track, with and without padding reserved at download time.
+
+Each track is a synthetic FLAC (valid metadata, random audio payload) "downloaded" by copying it in chunks, the way
+download_file writes it, then tagged with a cover, credits and lyrics like download_track does. Without reserved
+padding the cover does not fit the encoder's default 8 KiB padding and mutagen rewrites the whole file; with it only
+the metadata header is rewritten. Bytes written are the write() totals of this process (Linux /proc/self/io).
+
+    python benchmarks/tagging.py [--tracks 8] [--size-mb 40] [--resolution 1400]
+"""
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'vendor'))
+
+from OrpheusDL.orpheus import tagging  # noqa: E402
+from OrpheusDL.utils.flac_padding import FlacPaddingWriter, read_padding, tag_padding  # noqa: E402
+from OrpheusDL.utils.models import ContainerEnum, CodecEnum, CreditsInfo, Tags, TrackInfo  # noqa: E402
+
+CHUNK = 1024
+
+
+def written_bytes():
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('wchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def make_flac(size):
+    # STREAMINFO (16 bit stereo 44.1 kHz), a vendor-only VORBIS_COMMENT and libFLAC's default 8 KiB padding
+    streaminfo = (4096).to_bytes(2, 'big') * 2 + bytes(6)
+    streaminfo += ((44100 << 44) | (1 << 41) | (15 << 36) | (size // 4)).to_bytes(8, 'big') + bytes(16)
+    vendor = b'reference libFLAC 1.4.3 20230623'
+    comment = len(vendor).to_bytes(4, 'little') + vendor + bytes(4)
+    header = b'fLaC' + bytes([0]) + len(streaminfo).to_bytes(3, 'big') + streaminfo
+    header += bytes([4]) + len(comment).to_bytes(3, 'big') + comment
+    header += bytes([0x80 | 1]) + (8192).to_bytes(3, 'big') + bytes(8192)
+    return header + np.random.default_rng(0).integers(0, 256, size, dtype=np.uint8).tobytes()
+
+
+def make_cover(path, resolution):
+    # A photo-like cover: smooth gradients plus grain, so the JPEG is about as large as a real one
+    y, x = np.mgrid[0:resolution, 0:resolution] / resolution
+    rgb = np.stack([np.sin(6 * x + 3 * y), np.cos(5 * y - 2 * x), np.sin(4 * (x + y))], axis=-1) * 100 + 128
+    rgb += np.random.default_rng(1).normal(0, 12, rgb.shape)
+    Image.fromarray(np.clip(rgb, 0, 255).astype(np.uint8)).save(path, 'JPEG', quality=90)
+
+
+def track_info(number, total):
+    return TrackInfo(
+        name=f'Track {number}', album='Benchmark Album', album_id='1', artists=['Artist', 'Featured'],
+        tags=Tags(album_artist='Artist', track_number=number, total_tracks=total, disc_number=1, total_discs=1,
+                  isrc=f'XX0000000{number:03}', upc='0000000000000', genres=['Electronic'], release_date='2024-01-01',
+                  copyright='(P) 2024 Label', label='Label', replay_gain=-7.5, replay_peak=0.98),
+        codec=CodecEnum.FLAC, cover_url='', release_year=2024)
+
+
+def download(data, path, padding):
+    # Chunked write like download_file, through the padding writer when padding is reserved
+    with open(path, 'wb') as file:
+        f = FlacPaddingWriter(file, padding) if padding else file
+        for start in range(0, len(data), CHUNK):
+            f.write(data[start:start + CHUNK])
+        f.flush()
+
+
+def run(data, cover, tracks, reserve, directory):
+    credits_list = [CreditsInfo('Composer', ['Someone']), CreditsInfo('Producer', ['Someone Else'])]
+    lyrics = '\n'.join(f'Line {n} of the lyrics' for n in range(60))
+    padding = tag_padding(os.path.getsize(cover)) if reserve else None
+    saved_padding = tagging._keep_padding
+    if not reserve:
+        # the previous behaviour: mutagen's default padding policy and the cover re-read for every track
+        tagging._keep_padding = None
+    written = elapsed = 0
+    try:
+        for number in range(1, tracks + 1):
+            path = os.path.join(directory, f'{number:02}.flac')
+            download(data, path, padding)
+            if not reserve: tagging._cover_cache.clear()
+            before, start = written_bytes(), time.perf_counter()
+            tagging.tag_file(path, cover, track_info(number, tracks), credits_list, lyrics, ContainerEnum.flac)
+            elapsed += time.perf_counter() - start
+            written += written_bytes() - before
+            os.remove(path)
+    finally:
+        tagging._keep_padding = saved_padding
+    return written / tracks, elapsed / tracks
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Measure bytes written per tagged FLAC track.')
+    parser.add_argument('--tracks', type=int, default=8, help='Tracks per album (default 8)')
+    parser.add_argument('--size-mb', type=float, default=40, help='Audio size per track in MiB (default 40)')
+    parser.add_argument('--resolution', type=int, default=1400, help='Cover resolution (default 1400)')
+    args = parser.parse_args()
+
+    audio_size = int(args.size_mb * 1024 * 1024)
+    data = make_flac(audio_size)
+    with tempfile.TemporaryDirectory() as tmp:
+        cover = os.path.join(tmp, 'cover.jpg')
+        make_cover(cover, args.resolution)
+        print(f'{args.tracks} tracks of {args.size_mb:g} MiB, cover {os.path.getsize(cover) / 1024:.0f} KiB')
+
+        # Sanity check: a reserved file keeps its padding after tagging (so the audio was not moved)
+        path = os.path.join(tmp, 'check.flac')
+        download(data, path, tag_padding(os.path.getsize(cover)))
+        tagging.tag_file(path, cover, track_info(1, 1), [], 'lyrics', ContainerEnum.flac)
+        with open(path, 'rb') as f:
+            audio = f.read()[-audio_size:]
+        if audio != data[-audio_size:] or read_padding(path) <= 0:
+            print('FAILED: audio changed or padding used up')
+            sys.exit(1)
+        os.remove(path)
+
+        for name, reserve in (('default padding', False), ('reserved padding', True)):
+            written, elapsed = run(data, cover, args.tracks, reserve, tmp)
+            print(f'{name:17} {written / 1024:12.0f} KiB written per track   {elapsed * 1000:8.1f} ms per track')
+
+
+if __name__ == '__main__':
+    main()
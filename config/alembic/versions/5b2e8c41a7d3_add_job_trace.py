@@ -0,0 +1,34 @@
+"""add job trace
+
+Revision ID: 5b2e8c41a7d3
+Revises: d269eff430cc
+Create Date: 2026-10-19 10:12:40.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '5b2e8c41a7d3'
+down_revision: Union[str, Sequence[str], None] = 'd269eff430cc'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Phase timings of a job run, based on app.models.JobTrace
+    op.create_table(
+        'job_trace',
+        sa.Column('job_id', sa.String(length=36), sa.ForeignKey('job.id', ondelete='CASCADE'), primary_key=True, nullable=False),
+        sa.Column('data', sa.JSON(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=True),
+    )
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_table('job_trace')
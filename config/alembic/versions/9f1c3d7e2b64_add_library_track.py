@@ -0,0 +1,54 @@
+"""add library track
+
+Revision ID: 9f1c3d7e2b64
+Revises: 5b2e8c41a7d3
+Create Date: 2026-10-19 11:05:12.604317
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9f1c3d7e2b64'
+down_revision: Union[str, Sequence[str], None] = '5b2e8c41a7d3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Index of the music library, based on app.models.LibraryTrack
+    op.create_table(
+        'library_track',
+        sa.Column('path', sa.String(length=1024), primary_key=True, nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('mtime_ns', sa.BigInteger(), nullable=True),
+        sa.Column('isrc', sa.String(length=16), nullable=True),
+        sa.Column('upc', sa.String(length=20), nullable=True),
+        sa.Column('title', sa.String(length=512), nullable=True),
+        sa.Column('artist', sa.String(length=512), nullable=True),
+        sa.Column('album_artist', sa.String(length=512), nullable=True),
+        sa.Column('album', sa.String(length=512), nullable=True),
+        sa.Column('track_key', sa.String(length=512), nullable=True),
+        sa.Column('album_key', sa.String(length=512), nullable=True),
+        sa.Column('codec', sa.String(length=10), nullable=True),
+        sa.Column('lossless', sa.Boolean(), nullable=True),
+        sa.Column('spatial', sa.Boolean(), nullable=True),
+        sa.Column('bit_depth', sa.Integer(), nullable=True),
+        sa.Column('sample_rate', sa.Integer(), nullable=True),
+        sa.Column('bitrate', sa.Integer(), nullable=True),
+        sa.Column('duration', sa.Integer(), nullable=True),
+        sa.Column('scanned_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=True),
+    )
+    for column in ('isrc', 'upc', 'track_key', 'album_key'):
+        op.create_index(f'ix_library_track_{column}', 'library_track', [column])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    for column in ('isrc', 'upc', 'track_key', 'album_key'):
+        op.drop_index(f'ix_library_track_{column}', table_name='library_track')
+    op.drop_table('library_track')
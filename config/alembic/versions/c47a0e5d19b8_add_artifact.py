@@ -0,0 +1,40 @@
+"""add artifact
+
+Revision ID: c47a0e5d19b8
+Revises: 9f1c3d7e2b64
+Create Date: 2026-10-19 15:42:37.118524
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c47a0e5d19b8'
+down_revision: Union[str, Sequence[str], None] = '9f1c3d7e2b64'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    # Index of the artifact store, based on app.models.Artifact
+    op.create_table(
+        'artifact',
+        sa.Column('filename', sa.String(length=512), primary_key=True, nullable=False),
+        sa.Column('job_id', sa.String(length=36), sa.ForeignKey('job.id', ondelete='CASCADE'), nullable=True),
+        sa.Column('name', sa.String(length=512), nullable=True),
+        sa.Column('size', sa.BigInteger(), nullable=True),
+        sa.Column('mtime_ns', sa.BigInteger(), nullable=True),
+        sa.Column('etag', sa.String(length=64), nullable=True),
+        sa.Column('created_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'), nullable=True),
+    )
+    op.create_index('ix_artifact_job_id', 'artifact', ['job_id'])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    op.drop_index('ix_artifact_job_id', table_name='artifact')
+    op.drop_table('artifact')
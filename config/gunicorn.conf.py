@@ -6,3 +6,10 @@ worker_class = "gevent"
 timeout = 60
 keepalive = 5
 preload_app = False
+
+
+def post_worker_init(worker):
+    # gevent sends files through user space by default; /files and cached previews go out with os.sendfile() instead
+    if worker_class == "gevent":
+        from app.artifacts import install_sendfile
+        install_sendfile()
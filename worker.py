@@ -1,17 +1,162 @@
+"""
+Worker supervisor.
+
+Runs a pool of RQ worker processes on the job queues and keeps it at size: a worker that dies is restarted (with
+a growing delay if it keeps dying right away). SIGTERM/SIGINT is a graceful shutdown: every worker finishes its
+current job, then exits; a second signal stops the running jobs as well, and workers still busy after
+WORKER_SHUTDOWN_TIMEOUT seconds are killed.
+
+The supervisor also runs the scheduler's dispatcher (see app/scheduler.py): submitted jobs wait in their lanes and
+are moved into the RQ queue only as workers become idle, so the lane weights and per-session turns decide what
+runs next. Jobs of one service are kept within that service's concurrency slots (see app/slots.py): a job whose
+service is at its limit stays in its lane, keeping its turn, while other services' jobs go ahead.
+
+With a music library (MUSIC_DIR), the supervisor also queues an incremental scan of it (see app/library.py) at start
+and every LIBRARY_SCAN_INTERVAL seconds.
+
+    python worker.py [--processes N]
+"""
+import logging
+import multiprocessing
 import os
-import redis
-import os
+import signal
+import socket
+import sys
+import time
+
+# Add the vendor directory to the Python path (the jobs import OrpheusDL)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), 'vendor')))
+
 import redis
 from rq import Worker, Queue
-from app import create_app
+
+from app import library, scheduler, slots
 
 listen = ['default']
 
 redis_url = os.environ.get('REDIS_URL', 'redis://localhost:6379')
 
-conn = redis.from_url(redis_url)
+# Worker processes, and how long a graceful shutdown may wait for running jobs
+WORKER_PROCESSES = int(os.environ.get('WORKER_PROCESSES', 2))
+SHUTDOWN_TIMEOUT = float(os.environ.get('WORKER_SHUTDOWN_TIMEOUT', 660))
+# A worker that exits within this many seconds of starting is restarted after an increasing delay
+MIN_UPTIME = 10
+MAX_RESTART_DELAY = 60
+# Seconds between library scans (0: only on request, POST /api/library/scan)
+LIBRARY_SCAN_INTERVAL = float(os.environ.get('LIBRARY_SCAN_INTERVAL', 3600))
 
-if __name__ == '__main__':
+
+def run_worker(index, processes):
+    # Child process: the supervisor's handlers must not leak into the worker, which installs its own. Its own process
+    # group keeps a terminal's Ctrl-C from reaching it directly, so the supervisor decides between warm and cold shutdown.
+    os.setpgrp()
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Share the cores between the workers' encodes unless configured
+    if not os.environ.get('TRANSCODE_WORKERS'):
+        from OrpheusDL.orpheus.transcode import available_cores
+        os.environ['TRANSCODE_WORKERS'] = str(max(1, available_cores() // processes))
+    # RQ forks a work horse per job: importing the job module and building the Orpheus session here, once, spares
+    # every job both. The session is built after create_app(), which installs the session store it reads.
+    import app.tasks  # noqa: F401
+    from app import create_app
+    from app.orpheus_handler import get_orpheus_session
+    create_app()
+    get_orpheus_session()
+    conn = redis.from_url(redis_url)
     queues = [Queue(name, connection=conn) for name in listen]
-    worker = Worker(queues, connection=conn)
-    worker.work(with_scheduler=True)
+    worker = Worker(queues, connection=conn, name=f'{socket.gethostname()}.{os.getpid()}.{index}')
+    worker.work()
+
+
+def dispatch(queue):
+    # Hands waiting jobs to the workers that are idle right now (across all supervisors), minus jobs already queued
+    idle = sum(1 for w in Worker.all(queue=queue) if w.get_state() == 'idle')
+    free = idle - len(queue)
+    if free > 0:
+        scheduler.dispatch(queue, free, 'app.tasks.download_task')
+
+
+class Supervisor:
+    def __init__(self, processes):
+        self.processes = max(1, processes)
+        self.children = {}  # index -> (process, started at)
+        self.restart_delay = {}
+        self.stopping = False
+        self.context = multiprocessing.get_context('fork')
+
+    def start(self, index):
+        process = self.context.Process(target=run_worker, args=(index, self.processes), name=f'worker-{index}')
+        process.start()
+        self.children[index] = (process, time.monotonic())
+        logging.info(f'Started worker {index} (pid {process.pid})')
+
+    def stop(self, signum, frame):
+        # First signal: warm shutdown (finish the current job); second: cold shutdown
+        if self.stopping:
+            logging.info('Stopping workers now')
+        else:
+            logging.info(f'Shutting down {len(self.children)} workers after their current jobs')
+        self.stopping = True
+        for process, _ in self.children.values():
+            if process.is_alive(): os.kill(process.pid, signal.SIGTERM)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for index in range(self.processes):
+            self.start(index)
+
+        conn = redis.from_url(redis_url)
+        slots.initialize(conn, slots.parse_limits(os.environ.get('SERVICE_SLOTS')))
+        scheduler.initialize(conn, scheduler.parse_weights(os.environ.get('LANE_WEIGHTS')))
+        queue = Queue(listen[0], connection=conn)
+
+        pending_restart = {}
+        next_scan = time.monotonic() if os.environ.get('MUSIC_DIR') and LIBRARY_SCAN_INTERVAL > 0 else None
+        while not self.stopping:
+            if next_scan is not None and time.monotonic() >= next_scan:
+                try:
+                    queue.enqueue('app.tasks.library_scan_task', job_timeout=library.SCAN_TIMEOUT)
+                except Exception as e:
+                    logging.warning(f'Could not queue a library scan: {e}')
+                next_scan = time.monotonic() + LIBRARY_SCAN_INTERVAL
+            try:
+                dispatch(queue)
+                # Wakes up early when a job is submitted
+                scheduler.wait_for_work(1)
+            except Exception as e:
+                logging.warning(f'Dispatch failed: {e}')
+                time.sleep(1)
+            now = time.monotonic()
+            for index, (process, started) in list(self.children.items()):
+                if process.is_alive() or self.stopping or index in pending_restart: continue
+                process.join()
+                delay = self.restart_delay.get(index, 0)
+                delay = min(MAX_RESTART_DELAY, max(1, delay * 2)) if now - started < MIN_UPTIME else 0
+                self.restart_delay[index] = delay
+                logging.warning(f'Worker {index} exited with code {process.exitcode}, restarting in {delay}s')
+                pending_restart[index] = now + delay
+            for index, when in list(pending_restart.items()):
+                if now >= when and not self.stopping:
+                    del pending_restart[index]
+                    self.start(index)
+
+        deadline = time.monotonic() + SHUTDOWN_TIMEOUT
+        for index, (process, _) in self.children.items():
+            process.join(max(0, deadline - time.monotonic()))
+            if process.is_alive():
+                logging.warning(f'Worker {index} still busy after {SHUTDOWN_TIMEOUT:g}s, killing it')
+                # the whole group, so a job's work-horse process goes too
+                os.killpg(process.pid, signal.SIGKILL)
+                process.join()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Run a pool of download workers.')
+    parser.add_argument('--processes', type=int, default=WORKER_PROCESSES,
+                        help=f'Worker processes (default WORKER_PROCESSES or {WORKER_PROCESSES})')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s supervisor: %(message)s')
+    Supervisor(args.processes).run()